@@ -16,9 +16,9 @@ Log "Starting auto-update..."
 try {
     Set-Location $WorkDir
     
-    # 1. 运行 Python 脚本更新数据
+    # 1. 运行 Python 脚本更新数据 (--if-stale: 休市且收盘后已更新过时跳过，不请求 Yahoo)
     Log "Running main.py..."
-    & $PythonPath main.py 2>&1 | Out-File -FilePath $LogFile -Append
+    & $PythonPath main.py --if-stale 2>&1 | Out-File -FilePath $LogFile -Append
     
     # 2. 检查 Git 状态
     $GitStatus = git status --porcelain
@@ -2,197 +2,389 @@
 Vercel Serverless Function: Portfolio Real-Time API
 前端调用 /api/index 获取实时投资组合数据
 一劳永逸方案：每次访问都实时获取最新数据，无需定时任务
+
+冷启动优化:
+  - numpy / 估值模块 / 行情源在第一次计算时才导入和创建，直接返回缓存快照的请求不需要它们
+  - 默认使用 chart 行情源 (标准库 urllib + json)，不导入 pandas / yfinance
+  - 快照和行情缓存保存在模块级状态中，warm 调用之间复用
+  - 冷启动时先返回部署时预计算的 data.json / history.json，同时在后台计算最新快照
 """
 from http.server import BaseHTTPRequestHandler
-import json
-from datetime import datetime, timedelta
-
-# 延迟导入
-try:
-    import yfinance as yf
-    import pandas as pd
-    HAS_YF = True
-except ImportError:
-    HAS_YF = False
-
-# 持仓配置 (硬编码以便在Vercel环境运行)
-TOTAL_CASH = 0.00
-POSITIONS = [
-    {"symbol": "TSLA", "quantity": 881,  "cost_basis": 220.50}, 
-    {"symbol": "NVDA", "quantity": 628,  "cost_basis": 45.30},
-    {"symbol": "QQQM", "quantity": 414,  "cost_basis": 180.00},
-    {"symbol": "META", "quantity": 30,   "cost_basis": 330.00},
-    {"symbol": "AMZN", "quantity": 50,   "cost_basis": 145.00},
-    {"symbol": "PLTR", "quantity": 50,   "cost_basis": 25.00},
-    {"symbol": "TSM",  "quantity": 200,  "cost_basis": 0.00},
-    {"symbol": "QQQ",  "quantity": 30,   "cost_basis": 0.00},
-    {"symbol": "IBKR", "quantity": 64,   "cost_basis": 0.00},
-]
-
-
-def generate_snapshot():
-    """生成投资组合快照数据"""
-    if not HAS_YF:
+import os
+import sys
+from datetime import datetime
+from urllib.parse import parse_qs, urlsplit
+
+# 共享引擎位于仓库根目录 (engine/)。Vercel 项目的根目录就是仓库根目录，根目录的 vercel.json
+# 把 engine/ 和 manual_portfolio.py 打包进本函数 (includeFiles)，部署后的目录结构与仓库相同
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+# Serverless 默认走不依赖 pandas 的 chart 行情源 (可用 QUOTE_PROVIDER 覆盖)
+os.environ.setdefault("QUOTE_PROVIDER", "chart")
+# Serverless 环境通常不支持进程池 (没有 /dev/shm)，情景模拟默认在当前进程内计算
+os.environ.setdefault("SCENARIO_WORKERS", "0")
+
+from engine import artifacts, holdings, metrics, quotes, schedule, versions
+
+# 盘中的快照保鲜期 (秒)：warm 实例在此期间直接复用上次结果；
+# 盘前盘后按 REFRESH_EXTENDED，休市时收盘后的快照一直有效 (不再请求上游)
+SNAPSHOT_TTL = float(os.environ.get("SNAPSHOT_TTL", "60"))
+# 预计算快照所在目录 (main.py 生成的 data.json / history.json)，设为 off 关闭
+SNAPSHOT_ARTIFACT = os.environ.get("SNAPSHOT_ARTIFACT", os.path.join(ROOT_DIR, "dashboard"))
+# 快照和历史共用一次 3mo 下载 (第二次命中缓存)，冷启动只阻塞一轮上游请求
+HISTORY_PERIOD = "3mo"
+
+# 行情源: 第一次使用时创建，模块级缓存在 warm 调用之间复用
+provider = None
+# 快照状态 (stale-while-revalidate)，第一次请求时创建
+state = None
+# 最近一次响应的 (快照对象, ETag, PreparedBody)：同一快照只计算一次摘要 / 序列化 / 压缩
+prepared = None
+# 持仓配置: 仓库根目录的 manual_portfolio.py (部署时一并包含)，按修改时间 + 内容哈希热加载
+source = holdings.PositionSource()
+# /api/history 的预聚合级别缓存 (engine.history 依赖 numpy，第一次查询时才导入)
+history_cache = None
+# /api/risk 的增量风险模型 (warm 实例只处理新增的K线)
+risk_model = None
+# /api/scenarios 的结果缓存 (按快照版本)，第一次查询时创建
+scenario_cache = None
+
+
+def get_provider():
+    global provider
+    if provider is None:
+        provider = quotes.get_provider()
+    return provider
+
+
+def get_holdings():
+    """当前持仓配置 (与 main.py / server.py 共用同一个 manual_portfolio.py)"""
+    return source.current()
+
+
+def config_changed():
+    """配置文件在上次加载之后被修改过 (修改时间变化且内容哈希不同)"""
+    return source.holdings is not None and source.changed()
+
+
+def generate_snapshot(config=None):
+    """
+    生成投资组合快照数据 (config: holdings.Holdings，默认读取当前配置)
+    与 main.generate_snapshot_data 相同: lot 按标的聚合 (engine.lots.LotBook)，每个标的一行，并输出账户汇总
+    """
+    import numpy as np
+    from engine import fallback, fx
+    from engine.lots import LotBook
+
+    provider = get_provider()
+    if not provider.available:
         return None, "yfinance not available"
     
-    symbols = [p["symbol"] for p in POSITIONS]
+    config = config or get_holdings()
+    book = LotBook.from_positions(config.positions)
+    # 多账户持有的同一标的只请求一次；期权 (OCC 代码) 按标的价格理论定价: 请求标的而不是合约本身
+    chain = book.option_chain()
+    symbols = book.quote_symbols()
+    if chain is not None:
+        symbols = list(dict.fromkeys(symbols + chain.underlyings))
     
     try:
-        hist = yf.download(symbols, period="5d", progress=False, group_by='ticker')
+        bars_map = provider.fetch(symbols, HISTORY_PERIOD)
     except Exception as e:
         return None, f"Failed to fetch data: {str(e)}"
     
-    positions_data = []
-    total_value = TOTAL_CASH
-    total_day_pnl = 0.0
-    total_cost = 0.0
-    
-    for pos in POSITIONS:
-        symbol = pos["symbol"]
-        qty = pos["quantity"]
-        cost = pos["cost_basis"]
-        
-        try:
-            if len(symbols) == 1:
-                close_col = hist['Close']
-            else:
-                close_col = hist[symbol]['Close']
-            
-            closes = close_col.dropna()
-            current_price = float(closes.iloc[-1])
-            prev_close = float(closes.iloc[-2]) if len(closes) > 1 else current_price
-        except:
-            continue
-        
-        market_value = current_price * qty
-        day_pnl = (current_price - prev_close) * qty
-        day_pnl_pct = ((current_price - prev_close) / prev_close * 100) if prev_close > 0 else 0.0
-        pnl_pct = ((current_price - cost) / cost * 100) if cost > 0 else 0.0
-        
-        total_value += market_value
-        total_day_pnl += day_pnl
-        total_cost += cost * qty
-        
-        positions_data.append({
-            "symbol": symbol,
-            "quantity": qty,
-            "cost_basis": cost,
-            "current_price": current_price,
-            "market_value": market_value,
-            "pnl_percent": pnl_pct,
-            "day_pnl": day_pnl,
-            "day_pnl_percent": day_pnl_pct,
-            "allocation_percent": 0
-        })
+    # 批量结果缺失的标的并发重试，仍失败的在快照中标注
+    missing = [sym for sym in symbols if not bars_map.get(sym)]
+    retried, failed = fallback.fetch_fallbacks(provider, missing)
+    metrics.set_gauge("failed_symbols", len(failed), help="Symbols without a price in the last snapshot")
     
-    # 计算配置比例
-    for p in positions_data:
-        p["allocation_percent"] = (p["market_value"] / total_value * 100) if total_value > 0 else 0
+    last, prev = {}, {}
+    for sym in symbols:
+        closes = [b.close for b in bars_map.get(sym, [])]
+        if closes:
+            last[sym] = float(closes[-1])
+            prev[sym] = float(closes[-2]) if len(closes) > 1 else last[sym]
+        elif sym in retried:
+            last[sym], prev[sym] = retried[sym]
+    # 全部合约一次向量化定价 (标的缺失的合约没有报价)
+    greeks = None
+    if chain is not None:
+        greeks, prev_theo = chain.value(last, prev)
+        for j, sym in enumerate(chain.symbols):
+            if np.isnan(greeks["price"][j]):
+                failed[sym] = "no underlying price"
+                continue
+            last[sym] = float(greeks["price"][j])
+            if not np.isnan(prev_theo[j]):
+                prev[sym] = float(prev_theo[j])
     
-    # 按市值排序
-    positions_data.sort(key=lambda x: x["market_value"], reverse=True)
+    # 非基准币种: 汇率批量取一次 (warm 实例在 TTL 内复用)，取不到汇率的标的标注为失败
+    rates = fx.get_rates()
+    fx_rates = None
+    if any(c != rates.base for c in book.currency):
+        fx_rates = rates.vector(book.currency)
+        for k in np.flatnonzero(np.isnan(fx_rates)).tolist():
+            failed[book.symbols[k]] = f"no FX rate for {book.currency[k]}"
+        fx_rates = np.nan_to_num(fx_rates)
     
-    total_pnl_val = total_value - total_cost - TOTAL_CASH
-    total_pnl_pct = (total_pnl_val / total_cost * 100) if total_cost > 0 else 0.0
+    # 每个标的定价一次，lot 按标的 / 账户汇总 (手动定价优先)
+    book.set_prices(last, prev, failed, fx_rates)
+    cash = config.cash
+    market_value, total_day_pnl, total_cost = book.market_value, book.day_pnl, book.total_cost
+    total_value = cash + market_value
+    yesterday_value = total_value - total_day_pnl
+    total_pnl_val = market_value - total_cost
     
-    return {
+    snapshot = {
         "updated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         "portfolio": {
             "total_value": total_value,
-            "cash": TOTAL_CASH,
+            "cash": cash,
             "day_pnl": total_day_pnl,
-            "day_pnl_pct": (total_day_pnl / (total_value - total_day_pnl) * 100) if total_value > total_day_pnl else 0,
+            "day_pnl_pct": (total_day_pnl / yesterday_value * 100) if yesterday_value else 0,
             "total_pnl_val": total_pnl_val,
-            "total_pnl_pct": total_pnl_pct
+            "total_pnl_pct": (total_pnl_val / total_cost * 100) if total_cost else 0
         },
-        "positions": positions_data
-    }, None
+        "positions": book.to_positions(),
+        "accounts": book.account_rollup(),
+        "failed_symbols": sorted(failed)
+    }
+    if fx_rates is not None:
+        snapshot["fx"] = rates.snapshot(book.currency)
+    if chain is not None:
+        index = {sym: j for j, sym in enumerate(chain.symbols)}
+        for p in snapshot["positions"]:
+            j = index.get(p["symbol"])
+            if j is not None:
+                p["multiplier"] = float(book.multiplier[book.symbol_index[p["symbol"]]])
+                p["option"] = chain.describe(j, greeks)
+    return snapshot, None
+
 
+def generate_history(positions, cash, current_total, period=HISTORY_PERIOD, snapshot_positions=None):
+    """生成历史数据（基于当前持仓回溯）；/api/history 用更长的 period 生成日线序列"""
+    import numpy as np
+    from engine import fx, options, valuation
 
-def generate_history(positions, cash, current_total):
-    """生成历史数据（基于当前持仓回溯）"""
-    if not HAS_YF:
+    provider = get_provider()
+    if not provider.available:
         return []
     
+    # 期权 / 手动定价的持仓没有日线: 按快照中的当前市值视为常数 (与现金相同)；快照每个标的一行，多账户只计一次
+    quoted = {p["symbol"]: p for p in (snapshot_positions or [])}
+    constant = {p["symbol"] for p in positions if options.is_option(p["symbol"]) or "manual_price" in p}
+    if constant:
+        cash = cash + sum(quoted.get(sym, {}).get("market_value", 0.0) for sym in constant)
+        positions = [p for p in positions if p["symbol"] not in constant]
     symbols = [p["symbol"] for p in positions]
-    quantities = {p["symbol"]: p["quantity"] for p in positions}
     
     try:
-        end = datetime.now()
-        start = end - timedelta(days=90)
-        hist = yf.download(symbols, start=start.strftime("%Y-%m-%d"), end=end.strftime("%Y-%m-%d"), 
-                          progress=False, group_by='ticker')
+        # 过去 period (默认约90天) 日线
+        bars_map = provider.fetch(symbols, period)
     except:
         return []
     
     history = []
     
     try:
-        if len(symbols) == 1:
-            dates = hist.index.tolist()
-            closes = hist['Close'].tolist()
-            for i, dt in enumerate(dates):
-                val = closes[i] * quantities[symbols[0]] + cash
-                if not pd.isna(val):
-                    history.append({
-                        "date": dt.strftime("%Y-%m-%d"),
-                        "value": round(val, 2)
-                    })
-        else:
-            dates = hist.index.tolist()
-            for dt in dates:
-                daily_val = cash
-                valid = True
-                for sym in symbols:
-                    try:
-                        price = hist[sym]['Close'].loc[dt]
-                        if pd.isna(price):
-                            valid = False
-                            break
-                        daily_val += float(price) * quantities[sym]
-                    except:
-                        valid = False
-                        break
-                if valid:
-                    history.append({
-                        "date": dt.strftime("%Y-%m-%d"),
-                        "value": round(daily_val, 2)
-                    })
+        # 对齐成 dates × positions 价格矩阵，任一标的缺失的日期跳过
+        matrix = valuation.PriceMatrix.from_bars(bars_map, symbols)
+        valid = matrix.complete_rows()
+        quantities = np.array([p["quantity"] for p in positions], dtype=float)
+        # 非基准币种按当前汇率换算 (取不到汇率的持仓不计入)
+        currency = [fx.position_currency(p) for p in positions]
+        rates = fx.get_rates()
+        if any(c != rates.base for c in currency):
+            quantities = quantities * np.nan_to_num(rates.vector(currency))
+        values = valuation.history_values(matrix.values[valid], quantities, cash)
+        dates = [d for d, ok in zip(matrix.dates, valid) if ok]
+        history = [{"date": d, "value": round(float(v), 2)} for d, v in zip(dates, values)]
     except Exception as e:
         print(f"History generation error: {e}")
     
     return history
 
 
+def compute_response():
+    """计算最新快照 + 历史 (前端期望的格式)，失败时抛异常"""
+    config = get_holdings()
+    with metrics.span("api.snapshot"):
+        snapshot, error = generate_snapshot(config)
+    if error:
+        raise RuntimeError(error)
+    with metrics.span("api.history"):
+        history = generate_history(config.positions, config.cash, snapshot["portfolio"]["total_value"],
+                                   snapshot_positions=snapshot["positions"])
+    return {"data": snapshot, "history": history}
+
+
+def snapshot_ttl(updated_at):
+    return schedule.snapshot_ttl(updated_at, regular=SNAPSHOT_TTL)
+
+
+def get_state():
+    """模块级快照状态；冷启动时用预计算文件作为初始快照 (按文件修改时间计算 age)"""
+    global state
+    if state is None:
+        from engine.state import SnapshotState
+
+        state = SnapshotState(compute_response, ttl=snapshot_ttl)
+        if SNAPSHOT_ARTIFACT.lower() not in ("off", "none", "0"):
+            state.load_files(os.path.join(SNAPSHOT_ARTIFACT, "data.json"),
+                             os.path.join(SNAPSHOT_ARTIFACT, "history.json"))
+    return state
+
+
 class handler(BaseHTTPRequestHandler):
     def do_GET(self):
-        # 生成实时快照
-        snapshot, error = generate_snapshot()
-        
-        if error:
-            self.send_response(500)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
+        # /api/metrics (vercel.json 路由到本函数): 本实例的 Prometheus 指标
+        url = urlsplit(self.path)
+        if url.path.rstrip('/').endswith('/metrics') or 'metrics' in parse_qs(url.query):
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Cache-Control', 'no-cache')
             self.end_headers()
-            self.wfile.write(json.dumps({"error": error}).encode())
+            self.wfile.write(body)
             return
-        
-        # 生成历史数据
-        history = generate_history(
-            POSITIONS, 
-            TOTAL_CASH, 
-            snapshot["portfolio"]["total_value"]
-        )
-        
-        # 返回前端期望的格式
-        response = {
-            "data": snapshot,
-            "history": history
-        }
-        
-        self.send_response(200)
+
+        # /api/history (vercel.json 路由到本函数): 任意时间范围的历史，降采样到 max_points 个点
+        if url.path.rstrip('/').endswith('/history') or 'range' in parse_qs(url.query):
+            with metrics.span("api.history_query"):
+                self.send_history(parse_qs(url.query))
+            return
+
+        # /api/risk (vercel.json 路由到本函数): beta / 波动率 / 最大回撤 / 相关系数矩阵
+        if url.path.rstrip('/').endswith('/risk') or 'risk' in parse_qs(url.query):
+            with metrics.span("api.risk"):
+                self.send_risk()
+            return
+
+        # /api/scenarios (vercel.json 路由到本函数): 蒙特卡洛 VaR / CVaR 和压力测试
+        if url.path.rstrip('/').endswith('/scenarios') or 'scenarios' in parse_qs(url.query):
+            with metrics.span("api.scenarios"):
+                self.send_scenarios(parse_qs(url.query))
+            return
+
+        with metrics.span("api.request"):
+            self.send_snapshot(wait=parse_qs(url.query).get('wait', ['0'])[0] in ('1', 'true'))
+
+    def send_history(self, query):
+        global history_cache
+        from datetime import date
+        from engine import history
+
+        range_text = query.get('range', [None])[0]
+        max_points = query.get('max_points', [None])[0]
+        try:
+            days = history.parse_range(range_text)
+            history.parse_max_points(max_points)
+        except ValueError as e:
+            self.send_json({"error": str(e)}, status=400)
+            return
+
+        state = get_state()
+        try:
+            response = state.result if state.result is not None else state.refresh()[0]
+        except Exception as e:
+            self.send_json({"error": str(e)}, status=500)
+            return
+        total = response["data"]["portfolio"]["total_value"]
+        config = get_holdings()
+        if history_cache is None:
+            history_cache = history.LevelCache()
+        levels = history_cache.get(
+            (config.digest, date.today()), days,
+            lambda period: generate_history(config.positions, config.cash, total, period,
+                                            snapshot_positions=response["data"]["positions"]))
+        levels.update_last(total)
+        self.send_json(history.query(levels, range_text, max_points))
+
+    def send_risk(self):
+        global risk_model
+        from engine import risk
+
+        state = get_state()
+        try:
+            response = state.result if state.result is not None else state.refresh()[0]
+            data = response["data"]
+            risk_model, report = risk.compute(data["positions"], data["portfolio"]["cash"], get_provider(), risk_model)
+        except Exception as e:
+            self.send_json({"error": str(e)}, status=500)
+            return
+        self.send_json(report, status=500 if "error" in report else 200)
+
+    def send_scenarios(self, query):
+        global scenario_cache
+        from engine import scenarios
+
+        try:
+            params = scenarios.parse_params(query)
+        except ValueError as e:
+            self.send_json({"error": str(e)}, status=400)
+            return
+        state = get_state()
+        try:
+            if state.result is None:
+                state.refresh()
+            version, result, _, _ = state.get()
+            if scenario_cache is None:
+                scenario_cache = scenarios.ScenarioCache()
+            report = scenario_cache.report(version, result["data"], get_provider(), params)
+        except Exception as e:
+            self.send_json({"error": str(e)}, status=500)
+            return
+        self.send_json(report)
+
+    def send_json(self, payload, status=200, headers=None):
+        self.send_body(artifacts.dumps(payload), status=status, headers=headers)
+
+    def send_body(self, body, status=200, headers=None, encoding=None):
+        self.send_response(status)
         self.send_header('Content-type', 'application/json')
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+        # no-cache (而非 no-store): 允许浏览器带 If-None-Match 重新验证
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
         self.end_headers()
-        self.wfile.write(json.dumps(response).encode())
+        self.wfile.write(body)
+
+    def send_snapshot(self, wait=False):
+        state = get_state()
+        # 持仓配置被修改: 已有快照作废，同步重算 (未变化标的的行情命中 warm 实例的缓存)
+        if config_changed():
+            wait = True
+        if wait or state.result is None:
+            # 没有可用快照 (或 ?wait=1): 同步计算
+            try:
+                response, _ = state.refresh()
+            except Exception as e:
+                self.send_json({"error": str(e)}, status=500)
+                return
+            age, fresh = 0.0, True
+        else:
+            # 立即返回已有快照 (warm 缓存或预计算文件)，过期时后台刷新
+            _, response, age, fresh = state.get()
+        
+        # 内容未变化 (不含 updated_at) 时返回 304，客户端复用本地缓存
+        global prepared
+        if prepared is None or prepared[0] is not response:
+            prepared = (response, f'"{versions.content_digest(response)}"', artifacts.PreparedBody(response))
+        _, etag, body = prepared
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            return
+        
+        gzip_ok = 'gzip' in artifacts.accepted_encodings(self.headers.get('Accept-Encoding'))
+        body, encoding = body.render({"fresh": fresh, "age": round(age or 0.0, 1)}, "gzip" if gzip_ok else None)
+        self.send_body(body, headers={'ETag': etag}, encoding=encoding)
@@ -11,12 +11,94 @@ document.addEventListener('DOMContentLoaded', () => {
         privacyBtn.onclick = togglePrivacy;
     }
 
-    // 每一分钟自动刷新一次
-    setInterval(fetchData, 60000);
+    // 优先使用服务器推送；推送不可用时每一分钟轮询一次 (休市时每 10 分钟)
+    connectPush();
+    let pollTicks = 0;
+    setInterval(() => {
+        if (pushConnected) return;
+        pollTicks++;
+        if (marketSession === 'closed' && pollTicks % 10) return;
+        fetchData();
+    }, 60000);
 });
 
 // 全局数据缓存
 window.chartHistory = [];
+// 最近一次快照及其版本号 (本地 server.py 支持按版本拉取增量)
+window.lastSnapshot = null;
+window.snapshotVersion = null;
+let deltaSupported = true;
+// 当前交易时段 (updateMarketStatus 更新)，休市时放慢轮询
+let marketSession = 'trading';
+let staleRetries = 0;
+
+// 增量拉取: 304 表示无变化，否则把变化的持仓 / 汇总 / 历史点合并进缓存
+// 返回合并后的 { snapshot, history, fresh }，不支持或失败时返回 null
+async function fetchDelta() {
+    if (!deltaSupported || !window.snapshotVersion || !window.lastSnapshot) return null;
+    try {
+        const res = await fetch('/api/delta?since=' + encodeURIComponent(window.snapshotVersion), { cache: 'no-store' });
+        if (res.status === 304) {
+            return { snapshot: window.lastSnapshot, history: window.chartHistory, fresh: true };
+        }
+        if (!res.ok) {
+            if (res.status === 404) deltaSupported = false; // Vercel 等无增量接口的环境
+            return null;
+        }
+        return mergeDelta(await res.json());
+    } catch (e) {
+        console.log('Delta fetch failed:', e.message);
+        return null;
+    }
+}
+
+// 把一条增量 (或完整快照) 合并进缓存，返回 { snapshot, history, fresh }
+function mergeDelta(delta) {
+    window.snapshotVersion = delta.version;
+    if (delta.full || !window.lastSnapshot) {
+        return { snapshot: delta.data, history: delta.history, fresh: delta.fresh };
+    }
+
+    const snapshot = window.lastSnapshot;
+    const bySymbol = new Map(snapshot.positions.map(p => [p.symbol, p]));
+    delta.positions.forEach(p => bySymbol.set(p.symbol, p));
+    delta.removed.forEach(sym => bySymbol.delete(sym));
+    snapshot.positions = [...bySymbol.values()].sort((a, b) => b.market_value - a.market_value);
+    // 占比不在增量中下发，按市值重新计算
+    const totalMv = snapshot.positions.reduce((acc, p) => acc + (p.market_value || 0), 0);
+    snapshot.positions.forEach(p => { p.allocation_percent = totalMv ? p.market_value / totalMv * 100 : 0; });
+    snapshot.portfolio = delta.portfolio;
+    snapshot.updated_at = delta.updated_at;
+    snapshot.failed_symbols = delta.failed_symbols;
+    snapshot.accounts = delta.accounts;
+
+    const byDate = new Map(window.chartHistory.map(h => [h.date, h]));
+    delta.history.forEach(h => byDate.set(h.date, h));
+    const history = [...byDate.values()]
+        .filter(h => !delta.history_start || h.date >= delta.history_start)
+        .sort((a, b) => a.date.localeCompare(b.date));
+    return { snapshot, history, fresh: delta.fresh };
+}
+
+// 服务器推送 (SSE): 连接成功后停止轮询；连接不可用 (如 Vercel) 时回退到轮询
+let pushConnected = false;
+
+function connectPush() {
+    if (!window.EventSource) return;
+    const source = new EventSource('/api/stream');
+    source.addEventListener('delta', (e) => {
+        pushConnected = true;
+        const merged = mergeDelta(JSON.parse(e.data));
+        renderDashboard(merged.snapshot, merged.history, { isApi: true, isStale: merged.fresh === false });
+    });
+    source.onerror = () => {
+        // CLOSED 表示服务器不支持推送，浏览器不会再重连
+        if (source.readyState === EventSource.CLOSED) {
+            pushConnected = false;
+            console.log('Push channel unavailable, falling back to polling');
+        }
+    };
+}
 
 async function fetchData() {
     const status = document.getElementById('update-status');
@@ -28,6 +110,16 @@ async function fetchData() {
         let snapshot, history;
         let isDemo = false;
         let isApi = false;
+        let isStale = false;
+
+        // 0. 已有快照时先尝试增量更新
+        const delta = await fetchDelta();
+        if (delta) {
+            snapshot = delta.snapshot;
+            history = delta.history;
+            isApi = true;
+            isStale = delta.fresh === false;
+        }
 
         // 1. 优先尝试 Vercel Serverless API (实时数据)
         // 冷启动可能需要较长时间，使用25秒超时 + 自动重试
@@ -39,7 +131,8 @@ async function fetchData() {
 
                 if (status && attempt > 1) status.textContent = `Retrying (${attempt}/${maxRetries})...`;
 
-                const res = await fetch('/api/index?t=' + Date.now(), { signal: controller.signal });
+                // no-cache: 浏览器带 If-None-Match 重新验证，内容未变时服务器返回 304
+                const res = await fetch('/api/index', { signal: controller.signal, cache: 'no-cache' });
                 clearTimeout(timeoutId);
 
                 if (res.ok) {
@@ -48,6 +141,9 @@ async function fetchData() {
                         snapshot = json.data;
                         history = json.history;
                         isApi = true;
+                        window.snapshotVersion = json.version || null;
+                        // 本地 server.py 返回旧快照时会在后台刷新
+                        isStale = json.fresh === false;
                         console.log(`Loaded data from Serverless API (attempt ${attempt})`);
                     }
                 }
@@ -63,8 +159,8 @@ async function fetchData() {
         if (!snapshot) {
             try {
                 const [dataRes, historyRes] = await Promise.all([
-                    fetch('data.json?t=' + Date.now()),
-                    fetch('history.json?t=' + Date.now())
+                    fetch('data.json', { cache: 'no-cache' }),
+                    fetch('history.json', { cache: 'no-cache' })
                 ]);
 
                 if (dataRes.ok && historyRes.ok) {
@@ -90,20 +186,14 @@ async function fetchData() {
 
         // 渲染数据
         if (snapshot && history) {
-            updateKPIs(snapshot);
-            updateTable(snapshot.positions);
-            updateAllocationChart(snapshot.positions);
-
-            // 缓存并更新图表
-            window.chartHistory = history;
-            filterChartHistory(); // 使用缓存更新图表
-
-            // 更新时间标签
-            const timeLabel = document.getElementById('update-time');
-            if (timeLabel) {
-                timeLabel.textContent = `Last updated: ${snapshot.updated_at || new Date().toLocaleTimeString()}`;
-                if (isDemo) timeLabel.textContent += " (DEMO)";
-                if (isApi) timeLabel.textContent += " (LIVE)";
+            renderDashboard(snapshot, history, { isDemo, isApi, isStale });
+
+            // 服务器先返回了旧快照 (冷启动 / 后台刷新中) 且没有推送通道: 稍后再取一次
+            if (isStale && !pushConnected && staleRetries < 3) {
+                staleRetries++;
+                setTimeout(fetchData, 5000);
+            } else if (!isStale) {
+                staleRetries = 0;
             }
 
             if (status) {
@@ -120,6 +210,29 @@ async function fetchData() {
     }
 }
 
+function renderDashboard(snapshot, history, { isDemo = false, isApi = false, isStale = false } = {}) {
+    updateKPIs(snapshot);
+    updateTable(snapshot.positions);
+    updateAllocationChart(snapshot.positions);
+
+    // 缓存并更新图表
+    window.lastSnapshot = snapshot;
+    window.chartHistory = history;
+    window.historyApi = isApi;
+    showChartHistory(); // 使用缓存更新图表
+
+    // 更新时间标签
+    const timeLabel = document.getElementById('update-time');
+    if (timeLabel) {
+        timeLabel.textContent = `Last updated: ${snapshot.updated_at || new Date().toLocaleTimeString()}`;
+        if (isDemo) timeLabel.textContent += " (DEMO)";
+        if (isApi) timeLabel.textContent += isStale ? " (UPDATING)" : " (LIVE)";
+        // 取价失败的标的 (按 0 计入市值)
+        const failed = snapshot.failed_symbols || [];
+        if (failed.length) timeLabel.textContent += ` ⚠️ No price: ${failed.join(', ')}`;
+    }
+}
+
 // 刷新功能现在只是重新调用 fetchData
 function refreshData() {
     fetchData();
@@ -153,12 +266,60 @@ function setupTimeSelector() {
             buttons.forEach(b => b.classList.remove('active'));
             btn.classList.add('active');
             currentTimeRange = parseInt(btn.dataset.days);
-            filterChartHistory(); // 从内存过滤，不重新请求
+            showChartHistory();
         });
     });
 }
 setupTimeSelector();
 
+// 服务器端历史: 快照只带最近一个月的日线，1D / 更长区间向 /api/history 请求降采样后的序列
+// (点数按图表宽度取，10 年与 30 天的响应大小相同)；同一区间 1 分钟内复用上次结果
+const LOCAL_HISTORY_DAYS = 30;
+const RANGE_HISTORY_TTL = 60000;
+let historyApiSupported = true;
+let rangeHistory = { range: null, time: 0, history: null };
+
+function historyRangeParam() {
+    return currentTimeRange === 0 ? 'max' : `${currentTimeRange}d`;
+}
+
+function chartMaxPoints() {
+    const ctx = document.getElementById('trendChart');
+    const width = ctx ? ctx.clientWidth : 0;
+    // 约每 3 像素一个点
+    return Math.max(60, Math.min(600, Math.round((width || 600) / 3)));
+}
+
+async function fetchRangeHistory() {
+    const range = historyRangeParam();
+    if (rangeHistory.range === range && Date.now() - rangeHistory.time < RANGE_HISTORY_TTL) {
+        return rangeHistory.history;
+    }
+    const res = await fetch(`/api/history?range=${range}&max_points=${chartMaxPoints()}`, { cache: 'no-cache' });
+    if (res.status === 404) historyApiSupported = false;
+    if (!res.ok) throw new Error(`HTTP ${res.status}`);
+    const json = await res.json();
+    if (!json.history || json.history.length === 0) throw new Error('empty history');
+    rangeHistory = { range, time: Date.now(), history: json.history };
+    return json.history;
+}
+
+async function showChartHistory() {
+    const needsServer = currentTimeRange === 0 || currentTimeRange === 1 || currentTimeRange > LOCAL_HISTORY_DAYS;
+    if (window.historyApi && historyApiSupported && needsServer) {
+        const range = currentTimeRange;
+        try {
+            const history = await fetchRangeHistory();
+            // 请求期间切换了区间时丢弃结果
+            if (range === currentTimeRange) updateTrendChart(history);
+            return;
+        } catch (e) {
+            console.log('History API failed, filtering local history:', e.message);
+        }
+    }
+    filterChartHistory(); // 从内存过滤，不重新请求
+}
+
 function filterChartHistory() {
     if (!window.chartHistory || window.chartHistory.length === 0) return;
 
@@ -210,10 +371,15 @@ function togglePrivacy() {
     refreshData();
 }
 
-function formatCurrency(num) {
+function formatCurrency(num, currency = 'USD') {
     if (isPrivacyMode) return "****";
     if (num === undefined || num === null) return "$0.00";
-    return new Intl.NumberFormat('en-US', { style: 'currency', currency: 'USD' }).format(num);
+    try {
+        return new Intl.NumberFormat('en-US', { style: 'currency', currency }).format(num);
+    } catch (e) {
+        // 辅币报价 (如伦敦的 GBp 便士) 不是 ISO 币种代码
+        return `${num.toFixed(2)} ${currency}`;
+    }
 }
 
 // function getStockColor(symbol) { ... } // Deprecated in favor of ranked colors for chart
@@ -302,7 +468,7 @@ function updateTable(positions) {
                     </div>
                 </td>
                 <td class="col-shares">${p.quantity}</td>
-                <td class="col-price">${formatCurrency(p.current_price)}</td>
+                <td class="col-price">${p.price_missing ? 'N/A' : formatCurrency(p.current_price, p.currency)}</td>
                 <td class="col-alloc" style="color:#a0a0a0">${(p.allocation_percent || 0).toFixed(1)}%</td>
                 <td class="${pnlClass}">
                     <div style="font-weight:500">${sign}${formatCurrency(dayPnl)}</div>
@@ -447,7 +613,6 @@ function updateTrendChart(history) {
 
 function updateMarketStatus() {
     const statusEl = document.getElementById('market-status');
-    if (!statusEl) return;
     const now = new Date();
     const options = { timeZone: 'America/New_York', hour: 'numeric', minute: 'numeric', hour12: false };
     const etTime = new Intl.DateTimeFormat('en-US', options).format(now);
@@ -461,6 +626,8 @@ function updateMarketStatus() {
         else if (totalMinutes >= 570 && totalMinutes < 960) { status = 'trading'; emoji = '🟢'; text = 'Trading'; }
         else if (totalMinutes >= 960 && totalMinutes < 1200) { status = 'after-hours'; emoji = '🟠'; text = 'After-Hours'; }
     }
+    marketSession = status;
+    if (!statusEl) return;
     statusEl.textContent = emoji + ' ' + text;
     statusEl.className = 'market-status ' + status;
 }
@@ -0,0 +1,4 @@
+"""
+Portfolio Engine - 共享计算层
+main.py / server.py / dashboard/api/index.py 共用的行情与估值模块。
+"""
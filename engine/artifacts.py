@@ -0,0 +1,243 @@
+"""
+快照产物的序列化与写入
+  - dumps: 紧凑 JSON (无缩进 / 无多余空格，浮点数按 JSON_FLOAT_DIGITS 位小数取整)；JSON_FORMAT=pretty 保留缩进便于调试
+  - write_artifact: 原子写入 (临时文件 + os.replace，读者不会看到写了一半的文件)，
+    同时生成 .gz / .br 预压缩版本，server.py 按 Accept-Encoding 直接返回；
+    配合 iter_dumps 分块写入，峰值内存与单个持仓同量级
+  - PreparedBody: API 响应主体只序列化 / 压缩一次，每个请求只追加 fresh / age 等少量字段
+brotli 为可选依赖 (pip install brotli)，未安装时只生成 .gz。
+"""
+import gzip
+import json
+import os
+import tempfile
+import zlib
+
+try:
+    import brotli
+    HAS_BROTLI = True
+except ImportError:
+    HAS_BROTLI = False
+
+JSON_FORMAT = os.environ.get("JSON_FORMAT", "compact")
+FLOAT_DIGITS = int(os.environ.get("JSON_FLOAT_DIGITS", "6"))
+GZIP_LEVEL = 6
+# brotli 11 级对几 MB 的快照要数秒，刷新时用中等级别
+BROTLI_QUALITY = 6
+
+# 预压缩版本: 编码 -> 文件后缀 (按优先级)
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def round_floats(obj, digits=FLOAT_DIGITS):
+    """递归把浮点数取整到 digits 位小数 (去掉 0.30000000000000004 这类尾数)"""
+    if isinstance(obj, float):
+        return round(obj, digits)
+    if isinstance(obj, dict):
+        return {k: round_floats(v, digits) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [round_floats(v, digits) for v in obj]
+    return obj
+
+
+def dumps(obj, fmt=None):
+    """序列化为 UTF-8 bytes；fmt 为 compact (默认) 或 pretty"""
+    if (fmt or JSON_FORMAT) == "pretty":
+        return json.dumps(obj, indent=2).encode("utf-8")
+    return json.dumps(round_floats(obj), separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def iter_dumps(obj, depth=2, fmt=None):
+    """
+    分块序列化: 顶层 depth 层的 dict / list 逐个元素编码 (positions 每个持仓一块)，
+    写大文件时不需要整份 bytes 或取整后的完整副本。拼接结果与 dumps 相同。
+    """
+    if (fmt or JSON_FORMAT) == "pretty" or not depth or not isinstance(obj, (dict, list, tuple)):
+        yield dumps(obj, fmt)
+        return
+    if isinstance(obj, dict):
+        yield b"{"
+        for i, (k, v) in enumerate(obj.items()):
+            key = json.dumps(str(k), ensure_ascii=False).encode("utf-8")
+            yield (b"," + key if i else key) + b":"
+            yield from iter_dumps(v, depth - 1, fmt)
+        yield b"}"
+    else:
+        yield b"["
+        for i, v in enumerate(obj):
+            if i:
+                yield b","
+            yield from iter_dumps(v, depth - 1, fmt)
+        yield b"]"
+
+
+class AtomicFile:
+    """
+    写入同目录的临时文件，commit() 时 os.replace 替换目标 (替换是原子的)；
+    encoding 为 gzip / br 时边写边压缩
+    """
+
+    def __init__(self, path, encoding=None):
+        self.path = path
+        self.size = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, self.tmp = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+        self.file = os.fdopen(fd, "wb")
+        self._compress = self._finish = None
+        if encoding == "gzip":
+            # wbits=31: gzip 头 (mtime 为 0，内容相同则压缩结果相同)
+            c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            self._compress, self._finish = c.compress, c.flush
+        elif encoding == "br":
+            c = brotli.Compressor(quality=BROTLI_QUALITY)
+            self._compress, self._finish = c.process, c.finish
+        elif encoding is not None:
+            raise ValueError(f"unsupported encoding: {encoding}")
+
+    def write(self, data):
+        if self._compress is not None:
+            data = self._compress(data)
+        self.file.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        if self._finish is not None:
+            tail = self._finish()
+            self.file.write(tail)
+            self.size += len(tail)
+        self.file.close()
+        # mkstemp 创建的文件为 0600，沿用原文件权限 (新文件 0644)，静态服务器 / 其他用户可读
+        try:
+            mode = os.stat(self.path).st_mode & 0o777
+        except OSError:
+            mode = 0o644
+        os.chmod(self.tmp, mode)
+        os.replace(self.tmp, self.path)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.tmp)
+        except OSError:
+            pass
+
+
+def write_atomic(path, data):
+    """原子写入 bytes"""
+    f = AtomicFile(path)
+    try:
+        f.write(data)
+        f.commit()
+    except BaseException:
+        f.abort()
+        raise
+
+
+def compress(data, encoding):
+    if encoding == "gzip":
+        # mtime=0: 内容相同则压缩结果相同
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    raise ValueError(f"unsupported encoding: {encoding}")
+
+
+def write_artifact(path, chunks):
+    """
+    原子写入 path 及其预压缩版本，返回 {编码: 字节数}。chunks 为 bytes 或分块序列 (iter_dumps)，
+    原文件和各压缩版本边读边写，不在内存中拼接整份内容。
+    先替换原文件再替换压缩版本: 压缩版本比原文件旧时视为过期 (server.py 回退到原文件)，
+    因此任何时刻读者拿到的都是完整且一致的内容。
+    """
+    if isinstance(chunks, bytes):
+        chunks = (chunks,)
+    if not HAS_BROTLI:
+        # 没有 brotli 时删除旧的 .br，避免返回过期内容
+        try:
+            os.unlink(path + ".br")
+        except OSError:
+            pass
+    files = {"identity": AtomicFile(path)}
+    try:
+        for encoding, suffix in reversed(ENCODINGS):
+            if encoding != "br" or HAS_BROTLI:
+                files[encoding] = AtomicFile(path + suffix, encoding)
+        for chunk in chunks:
+            for f in files.values():
+                f.write(chunk)
+        for f in files.values():
+            f.commit()
+    except BaseException:
+        for f in files.values():
+            f.abort()
+        raise
+    return {encoding: f.size for encoding, f in files.items()}
+
+
+def accepted_encodings(header):
+    """解析 Accept-Encoding，返回客户端接受的编码集合 (忽略 q=0)"""
+    accepted = set()
+    for item in (header or "").split(","):
+        parts = [p.strip() for p in item.split(";")]
+        name = parts[0].lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            accepted.add(name)
+    return accepted
+
+
+def precompressed(path, accept_header):
+    """
+    选择 path 的预压缩版本，返回 (文件路径, 编码)；
+    没有可用版本 (客户端不接受 / 文件不存在 / 比原文件旧) 时返回 (path, None)
+    """
+    accepted = accepted_encodings(accept_header)
+    try:
+        original = os.stat(path).st_mtime_ns
+    except OSError:
+        return path, None
+    for encoding, suffix in ENCODINGS:
+        if encoding not in accepted and "*" not in accepted:
+            continue
+        try:
+            if os.stat(path + suffix).st_mtime_ns >= original:
+                return path + suffix, encoding
+        except OSError:
+            continue
+    return path, None
+
+
+class PreparedBody:
+    """
+    JSON 对象主体只序列化 / gzip 压缩一次；render(extra) 在末尾追加字段。
+    gzip 流在主体后 Z_SYNC_FLUSH，每个请求复制压缩器状态后只压缩追加的几十个字节。
+    """
+
+    def __init__(self, payload):
+        raw = dumps(payload)
+        self.head = raw[:-1]            # 去掉结尾的 "}"
+        self.empty = raw == b"{}"
+        self._gzip = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        self._gzip_head = self._gzip.compress(self.head) + self._gzip.flush(zlib.Z_SYNC_FLUSH)
+
+    def _tail(self, extra):
+        if not extra:
+            return b"}"
+        body = json.dumps(extra, separators=(",", ":")).encode("utf-8")[1:]
+        return body if self.empty else b"," + body
+
+    def render(self, extra=None, encoding=None):
+        """返回 (body, encoding)；encoding 为 gzip 或 None (客户端不接受压缩时)"""
+        tail = self._tail(extra)
+        if encoding == "gzip":
+            c = self._gzip.copy()
+            return self._gzip_head + c.compress(tail) + c.flush(), "gzip"
+        return self.head + tail, None
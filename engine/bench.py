@@ -0,0 +1,490 @@
+"""
+基准测试 (不联网)
+生成合成持仓 (10 ~ 50,000 个，混入手动定价标的和 OCC 期权)，用确定性的合成价格帧喂给各个阶段:
+  main.generate_snapshot_data / generate_history_data / save_outputs
+  dashboard/api/index.py 的 generate_snapshot / generate_history
+  多账户 lot (同一标的分散在几个账户，按标的聚合) 的快照，以及 CachedProvider 的未命中 / 命中路径
+报告每个阶段的吞吐量、延迟分位数和峰值内存 (tracemalloc)，并可与保存的基线对比，部署前发现性能回退。
+
+用法:
+  python -m engine.bench --sizes 10,1000,50000
+  python -m engine.bench --save-baseline          # 保存到 .cache/bench_baseline.json
+  python -m engine.bench --compare --threshold 0.25
+  python -m engine.bench --check --sizes ""      # 只做一致性检查
+  python -m engine.bench --sizes "" --startup 10   # 只测 Serverless 冷启动
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date
+
+import numpy as np
+
+from engine import options, quotes
+from engine.holdings import Holdings
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(ROOT_DIR, ".cache", "bench_baseline.json")
+# 固定最后一个交易日，保证每次运行的价格帧完全一致
+BENCH_END = date(2025, 12, 30)
+DEFAULT_SIZES = "10,1000,10000,50000"
+
+
+ACCOUNTS = ("self", "family", "ira")
+
+
+def synthetic_portfolio(n, seed=0, manual_ratio=0.05, option_ratio=0.05):
+    """
+    生成 n 个持仓: 大部分为普通股票，混入手动定价 (私募等) 和 OCC 期权。
+    期权代码 "S00xxx 260116C..." 按标的 S00xxx 的价格用 Black-Scholes 定价 (标的不一定在持仓中，会一并请求)
+    """
+    rng = random.Random(seed)
+    positions = []
+    for i in range(n):
+        r = rng.random()
+        if r < option_ratio:
+            strike = rng.randint(10, 500)
+            positions.append({
+                "symbol": f"S{i % 997:05d} 260116C{strike * 1000:08d}",
+                "quantity": rng.randint(1, 20),
+                "cost_basis": round(rng.uniform(0.5, 40.0), 2),
+            })
+        elif r < option_ratio + manual_ratio:
+            positions.append({
+                "symbol": f"PRIV{i:05d}",
+                "quantity": rng.randint(1, 500),
+                "cost_basis": round(rng.uniform(1.0, 100.0), 2),
+                "manual_price": round(rng.uniform(1.0, 150.0), 2),
+            })
+        else:
+            positions.append({
+                "symbol": f"S{i:05d}",
+                "quantity": rng.randint(1, 2000),
+                # 约 10% 成本未知
+                "cost_basis": round(rng.uniform(5.0, 500.0), 2) if rng.random() > 0.1 else 0.0,
+            })
+    return positions
+
+
+def synthetic_lots(positions, seed=0, split_ratio=0.2):
+    """
+    多账户版本: 每个持仓分配一个账户，约 split_ratio 的股票拆成 2 ~ 3 个 lot 分散在不同账户
+    (数量之和不变，成本各不相同)，快照按标的聚合后应与拆分前的持仓数相同
+    """
+    rng = random.Random(seed + 2)
+    lots = []
+    for p in positions:
+        if "manual_price" in p or " " in p["symbol"] or p["quantity"] < 3 or rng.random() >= split_ratio:
+            lots.append(dict(p, account=rng.choice(ACCOUNTS)))
+            continue
+        parts = rng.randint(2, 3)
+        cuts = sorted(rng.sample(range(1, p["quantity"]), parts - 1))
+        for account, lo, hi in zip(ACCOUNTS, [0] + cuts, cuts + [p["quantity"]]):
+            cost = round(p["cost_basis"] * rng.uniform(0.8, 1.2), 2) if p["cost_basis"] else 0.0
+            lots.append(dict(p, quantity=hi - lo, cost_basis=cost, account=account))
+    return lots
+
+
+def underlying_of(symbol):
+    """期权代码的标的 (其他代码原样返回)"""
+    contract = options.parse_occ(symbol)
+    return contract.underlying if contract else symbol
+
+
+class SyntheticMarket(quotes.QuoteProvider):
+    """
+    预先生成的价格帧 (FakeProvider + 固定结束日)，fetch 只做字典查找，
+    计时只包含被测代码，不包含造数成本。
+    missing: 批量结果中缺失的标的 (走兜底重试路径)
+    """
+    name = "synthetic"
+
+    def __init__(self, symbols, end=BENCH_END, missing=()):
+        self.base = quotes.FakeProvider(end=end)
+        self.symbols = list(dict.fromkeys(list(symbols) + ["SPY"]))
+        self.missing = set(missing)
+        self.calls = 0
+        self._frames = {}
+
+    def frame(self, period):
+        if period not in self._frames:
+            self._frames[period] = self.base.fetch(self.symbols, period)
+        return self._frames[period]
+
+    def fetch(self, symbols, period="5d", start=None):
+        self.calls += 1
+        if start:
+            return self.base.fetch(symbols, period, start)
+        frame = self.frame(period)
+        if len(symbols) > 1:
+            return {s: frame[s] for s in dict.fromkeys(symbols) if s in frame and s not in self.missing}
+        # 单标的请求 (兜底重试) 能取到数据
+        return {s: frame[s] for s in symbols if s in frame}
+
+
+def load_api():
+    """按文件路径加载 dashboard/api/index.py (不是包)"""
+    path = os.path.join(ROOT_DIR, "dashboard", "api", "index.py")
+    spec = importlib.util.spec_from_file_location("dashboard_api_index", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@contextlib.contextmanager
+def patched(module, **attrs):
+    """临时替换模块属性 (持仓配置 / 行情源)"""
+    saved = {k: getattr(module, k) for k in attrs if hasattr(module, k)}
+    for k, v in attrs.items():
+        setattr(module, k, v)
+    try:
+        yield module
+    finally:
+        for k in attrs:
+            if k in saved:
+                setattr(module, k, saved[k])
+            else:
+                delattr(module, k)
+
+
+def measure(fn, repeat, warmup=1):
+    """返回 (每次耗时秒数列表, tracemalloc 峰值字节)；峰值单独跑一次，不影响计时"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(warmup):
+            fn()
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - t0)
+        tracemalloc.start()
+        try:
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return times, peak
+
+
+def summarize(n, times, peak):
+    t = np.array(times) * 1000.0
+    p50 = float(np.percentile(t, 50))
+    return {
+        "positions": n,
+        "runs": len(times),
+        "p50_ms": round(p50, 3),
+        "p95_ms": round(float(np.percentile(t, 95)), 3),
+        "max_ms": round(float(t.max()), 3),
+        "positions_per_s": round(n / (p50 / 1000.0), 1) if p50 else None,
+        "peak_kb": round(peak / 1024.0, 1),
+    }
+
+
+def run_size(n, api, repeat=5, seed=0, missing_ratio=0.0, out_dir=None):
+    """对 n 个持仓跑所有阶段，返回 {stage: summary}"""
+    import main
+    import manual_portfolio as mp
+
+    positions = synthetic_portfolio(n, seed=seed)
+    lots = synthetic_lots(positions, seed=seed)
+    cash = 10000.0
+    stocks = [p["symbol"] for p in positions if "manual_price" not in p and " " not in p["symbol"]]
+    rng = random.Random(seed + 1)
+    missing = [s for s in stocks if rng.random() < missing_ratio]
+    # 行情源需要请求的标的: 股票 + 期权的标的
+    quoted = list(dict.fromkeys(stocks + [underlying_of(p["symbol"]) for p in positions if " " in p["symbol"]]))
+
+    # 1. 预先生成价格帧 (main 用 5d / 1mo，api 用 5d / 3mo)
+    market = SyntheticMarket(quoted, missing=missing)
+    for period in ("5d", "1mo", "3mo"):
+        market.frame(period)
+
+    config = Holdings(positions, cash, {}, None)
+    lot_config = Holdings(lots, cash, {}, None)
+    # 命中路径: 预先填满的缓存 (TTL 足够长，计时期间不过期)
+    warm = quotes.CachedProvider(market, ttl=3600)
+    warm.fetch(quoted, "5d")
+    results = {}
+    with patched(mp, POSITIONS=positions, TOTAL_CASH=cash), \
+            patched(api, get_holdings=lambda: config, provider=market), \
+            contextlib.redirect_stdout(io.StringIO()):
+        # 2. 先跑一次快照，得到 history / 写文件阶段的输入
+        result = main.generate_snapshot_data(provider=market)
+        snap = result["data"]
+        total = snap["portfolio"]["total_value"]
+
+    stages = [
+        ("main.snapshot", lambda: main.generate_snapshot_data(provider=market)),
+        ("main.history", lambda: main.generate_history_data(snap["positions"], cash, total, provider=market)),
+        ("main.save_outputs", lambda: main.save_outputs(result, out_dir)),
+        ("api.snapshot", api.generate_snapshot),
+        ("api.history", lambda: api.generate_history(positions, cash, total)),
+        ("main.snapshot_lots", lambda: main.generate_snapshot_data(provider=market, holdings=lot_config)),
+        ("api.snapshot_lots", lambda: api.generate_snapshot(lot_config)),
+        ("cache.miss", lambda: quotes.CachedProvider(market, ttl=3600).fetch(quoted, "5d")),
+        ("cache.hit", lambda: warm.fetch(quoted, "5d")),
+    ]
+
+    # 3. 逐阶段计时 + 峰值内存
+    with patched(mp, POSITIONS=positions, TOTAL_CASH=cash), \
+            patched(api, get_holdings=lambda: config, provider=market):
+        for name, fn in stages:
+            times, peak = measure(fn, repeat)
+            results[name] = summarize(n, times, peak)
+    return results
+
+
+def consistency_checks():
+    """
+    不同入口的结果应当一致 (出错时返回描述列表):
+      - 非基准币种持仓: 快照内嵌的 history 与 /api/history 由快照 positions 重建的序列相同
+      - 风险模型: 只有价格 / 汇率 / 期权市值变化时增量更新，结果与完整重建相同
+    """
+    import main
+    from engine import fx
+
+    failures = []
+    market = quotes.FakeProvider(end=BENCH_END)
+    holdings = Holdings([{"symbol": "0700.HK", "quantity": 100, "cost_basis": 300.0},
+                         {"symbol": "NVDA", "quantity": 10, "cost_basis": 100.0}], 1000.0, {}, None)
+    saved = fx.get_rates()
+    fx.set_rates(fx.FXRates(fx.StaticFXSource({"HKD": 0.128})))
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = main.generate_snapshot_data(provider=market, holdings=holdings)
+            data = result["data"]
+            rebuilt = main.generate_history_data(data["positions"], holdings.cash,
+                                                 data["portfolio"]["total_value"], provider=market)
+    finally:
+        fx.set_rates(saved)
+    embedded = {p["date"]: p["value"] for p in result["history"]}
+    diff = [d for d, v in ((p["date"], p["value"]) for p in rebuilt)
+            if d in embedded and abs(embedded[d] - v) > 1e-6 * max(1.0, abs(v))]
+    if diff or not embedded:
+        failures.append(f"fx history: embedded and rebuilt history differ on {len(diff)} day(s)")
+    failures.extend(risk_incremental_check())
+    return failures
+
+
+class _StartRecorder(quotes.FakeProvider):
+    """记录每次 fetch 的 start (None 为整个 period 的完整请求)"""
+
+    def __init__(self, end):
+        super().__init__(end=end)
+        self.starts = []
+
+    def fetch(self, symbols, period="5d", start=None):
+        self.starts.append(start)
+        return super().fetch(symbols, period, start)
+
+
+def risk_incremental_check():
+    """
+    风险模型只按持仓结构重建: 只有价格 / 汇率 / 期权市值变化的刷新必须走增量路径 (start=)，
+    且结果与完整重建相同
+    """
+    from datetime import timedelta
+
+    from engine import risk
+
+    def positions(price, fx_rate, option_value):
+        return [{"symbol": "NVDA", "quantity": 10, "current_price": price},
+                {"symbol": "VOD.L", "quantity": 100, "current_price": 70.0, "fx_rate": fx_rate},
+                {"symbol": "NVDA  260116C00150000", "quantity": 1, "market_value": option_value}]
+
+    failures = []
+    model, _ = risk.compute(positions(100.0, 1.27, 500.0), 1000.0, quotes.FakeProvider(end=BENCH_END))
+    for label, changed in (("price", positions(101.0, 1.27, 500.0)), ("fx", positions(100.0, 1.2701, 500.0)),
+                           ("option value", positions(100.0, 1.27, 510.0))):
+        end = BENCH_END + timedelta(days=1)
+        market = _StartRecorder(end)
+        model, report = risk.compute(changed, 1000.0, market, model)
+        if None in market.starts:
+            failures.append(f"risk: {label}-only refresh rebuilt the model from the full period")
+        _, full = risk.compute(changed, 1000.0, quotes.FakeProvider(end=end))
+        if json.dumps(report["portfolio"]) != json.dumps(full["portfolio"]):
+            failures.append(f"risk: {label}-only incremental report differs from a full rebuild")
+    return failures
+
+
+# 冷启动子进程: 导入 api/index.py，起一个本地 HTTP 服务，请求两次 (冷 / 热)
+STARTUP_CHILD = r"""
+import importlib.util, json, sys, threading, time, urllib.request
+from http.server import HTTPServer
+spawned = float(sys.argv[1])
+started = time.time()
+t0 = time.perf_counter()
+spec = importlib.util.spec_from_file_location("dashboard_api_index", sys.argv[2])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+import_s = time.perf_counter() - t0
+heavy = sorted(m for m in ("numpy", "pandas", "yfinance") if m in sys.modules)
+server = HTTPServer(("127.0.0.1", 0), module.handler)
+server.RequestHandlerClass.log_message = lambda *a: None
+threading.Thread(target=server.serve_forever, daemon=True).start()
+url = "http://127.0.0.1:%d/api/index" % server.server_address[1]
+def get():
+    t = time.perf_counter()
+    with urllib.request.urlopen(url) as r:
+        ttfb, at = time.perf_counter() - t, time.time()
+        r.read()
+    return ttfb, at
+cold_ttfb, first_byte_at = get()
+warm_ttfb, _ = get()
+print(json.dumps({"interpreter": started - spawned, "import": import_s, "cold_ttfb": cold_ttfb,
+                  "first_byte": first_byte_at - spawned, "warm_ttfb": warm_ttfb, "heavy_imports": heavy}))
+"""
+
+
+def startup_benchmark(runs=5, provider="fake"):
+    """
+    冷启动基准: 每次新开解释器，测量导入耗时、首个请求的首字节时间 (从进程启动算起) 和热请求耗时。
+    分两种模式: artifact (先返回预计算快照) / compute (SNAPSHOT_ARTIFACT=off，同步计算)
+    """
+    import subprocess
+
+    path = os.path.join(ROOT_DIR, "dashboard", "api", "index.py")
+    results = {}
+    for mode in ("artifact", "compute"):
+        env = dict(os.environ, QUOTE_PROVIDER=provider, PRICE_STORE="off")
+        if mode == "compute":
+            env["SNAPSHOT_ARTIFACT"] = "off"
+        samples = []
+        for _ in range(runs):
+            out = subprocess.run([sys.executable, "-c", STARTUP_CHILD, repr(time.time()), path],
+                                 env=env, capture_output=True, text=True, timeout=120)
+            lines = out.stdout.strip().splitlines()
+            if out.returncode != 0 or not lines:
+                print(f"Startup run failed ({mode}): {out.stderr.strip()[-500:]}", file=sys.stderr)
+                continue
+            samples.append(json.loads(lines[-1]))
+        if not samples:
+            continue
+        print(f"startup/{mode}: heavy modules loaded at import: {samples[0]['heavy_imports'] or 'none'}",
+              file=sys.stderr)
+        for metric in ("import", "cold_ttfb", "first_byte", "warm_ttfb"):
+            results[f"startup.{mode}.{metric}"] = summarize(0, [x[metric] for x in samples], 0)
+    return results
+
+
+def print_results(results):
+    print(f"{'stage':<30}{'n':>8}{'p50 ms':>11}{'p95 ms':>11}{'max ms':>11}{'pos/s':>13}{'peak KB':>11}")
+    for key, r in results.items():
+        stage = key.rsplit("/", 1)[0]
+        rate = f"{r['positions_per_s']:,.0f}" if r["positions_per_s"] else "-"
+        print(f"{stage:<30}{r['positions'] or '-':>8}{r['p50_ms']:>11.2f}{r['p95_ms']:>11.2f}"
+              f"{r['max_ms']:>11.2f}{rate:>13}{r['peak_kb']:>11.1f}")
+
+
+def compare(results, baseline, threshold=0.25, min_ms=1.0):
+    """
+    与基线对比 p50 和峰值内存，超过 (1 + threshold) 倍记为回退。
+    p50 差值小于 min_ms 的不算 (小规模下计时噪声大)。返回回退列表。
+    """
+    regressions = []
+    base_results = baseline.get("results", {})
+    print(f"\n{'stage':<32}{'p50 base':>11}{'p50 now':>11}{'ratio':>8}{'mem ratio':>11}")
+    for key, cur in results.items():
+        base = base_results.get(key)
+        if not base:
+            continue
+        ratio = cur["p50_ms"] / base["p50_ms"] if base["p50_ms"] else 1.0
+        mem_ratio = cur["peak_kb"] / base["peak_kb"] if base["peak_kb"] else 1.0
+        slow = ratio > 1 + threshold and cur["p50_ms"] - base["p50_ms"] > min_ms
+        fat = mem_ratio > 1 + threshold
+        flag = "  REGRESSION" if slow or fat else ""
+        print(f"{key:<32}{base['p50_ms']:>11.2f}{cur['p50_ms']:>11.2f}{ratio:>8.2f}{mem_ratio:>11.2f}{flag}")
+        if flag:
+            regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Portfolio engine benchmark (synthetic data, offline)")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="持仓数量列表，逗号分隔")
+    parser.add_argument("--repeat", type=int, default=5, help="每个阶段计时次数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--missing", type=float, default=0.0, help="批量结果中缺失 (走兜底重试) 的股票比例")
+    parser.add_argument("--startup", type=int, default=0, metavar="RUNS",
+                        help="同时运行冷启动基准 (api/index.py)，每种模式 RUNS 次")
+    parser.add_argument("--startup-provider", default="fake", help="冷启动基准使用的行情源")
+    parser.add_argument("--json", help="把结果写入该文件")
+    parser.add_argument("--save-baseline", nargs="?", const=BASELINE_PATH, help="保存为基线")
+    parser.add_argument("--compare", nargs="?", const=BASELINE_PATH, help="与基线对比，有回退时退出码为 1")
+    parser.add_argument("--threshold", type=float, default=0.25, help="允许的变慢 / 内存增长比例")
+    parser.add_argument("--check", action="store_true", help="先做一致性检查 (不同入口的结果相同)，失败时退出码为 1")
+    args = parser.parse_args()
+
+    # api 模块导入时会取默认行情源: 先注入离线后端，避免打开本地行情库或联网
+    quotes.set_provider(quotes.FakeProvider(end=BENCH_END))
+    api = load_api()
+
+    if args.check:
+        failures = consistency_checks()
+        for failure in failures:
+            print(f"CHECK FAILED: {failure}")
+        if failures:
+            return 1
+        print("Consistency checks passed", file=sys.stderr)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as out_dir:
+        for n in [int(s) for s in args.sizes.split(",") if s.strip()]:
+            print(f"Benchmarking {n} positions...", file=sys.stderr)
+            for stage, summary in run_size(n, api, args.repeat, args.seed, args.missing, out_dir).items():
+                results[f"{stage}/{n}"] = summary
+
+    if args.startup:
+        print("Benchmarking cold start...", file=sys.stderr)
+        results.update(startup_benchmark(args.startup, args.startup_provider))
+
+    print_results(results)
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "missing": args.missing,
+            "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "results": results,
+    }
+
+    for path in (args.json, args.save_baseline):
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+            print(f"Saved {path}")
+
+    if args.compare:
+        try:
+            with open(args.compare, encoding="utf-8") as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Cannot read baseline {args.compare}: {e}")
+            return 2
+        for key in ("seed", "missing"):
+            if baseline.get("meta", {}).get(key) != report["meta"][key]:
+                print(f"Warning: baseline {key}={baseline['meta'].get(key)} differs from current {report['meta'][key]}")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+            return 1
+        print("\nNo regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
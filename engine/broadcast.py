@@ -0,0 +1,59 @@
+"""
+服务器推送扇出 (Server-Sent Events)
+一次快照计算生成一条消息，序列化一次后分发给所有已连接的客户端。
+每个客户端有一个有界队列 (背压)；队列写满说明该客户端跟不上，直接断开 (drop-slowest)，
+它重连时会带上 Last-Event-ID，从增量接口补齐。
+"""
+import json
+import queue
+import threading
+
+
+def format_event(event, payload, event_id=None):
+    """编码为一条 SSE 消息 (bytes)"""
+    lines = []
+    if event_id:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append("data: " + json.dumps(payload, separators=(",", ":")))
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+class Client:
+    def __init__(self, max_queue):
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = False
+
+
+class Broadcaster:
+    def __init__(self, max_queue=16):
+        self.max_queue = max_queue
+        self._clients = set()
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._clients)
+
+    def register(self):
+        client = Client(self.max_queue)
+        with self._lock:
+            self._clients.add(client)
+        return client
+
+    def unregister(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+    def publish(self, message):
+        """把一条已编码的消息放入所有客户端队列，不阻塞；队列已满的客户端被断开"""
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.queue.put_nowait(message)
+            except queue.Full:
+                client.dropped = True
+                self.unregister(client)
+                self.dropped += 1
+        return len(clients)
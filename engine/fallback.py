@@ -0,0 +1,101 @@
+"""
+缺失标的兜底重试
+批量下载漏掉的标的在一个阶段内并发重试：有界线程池 + 单标的超时 + 整体刷新截止时间。
+仍然失败的标的明确返回给调用方，由快照标注出来，而不是静默按 0 估值。
+"""
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from engine import metrics
+from engine.quotes import last_and_prev
+
+DEFAULT_WORKERS = int(os.environ.get("FALLBACK_WORKERS", "4"))
+DEFAULT_TIMEOUT = float(os.environ.get("FALLBACK_TIMEOUT", "8"))
+# 一次刷新的总预算 (秒)，从开始计算快照算起
+REFRESH_DEADLINE = float(os.environ.get("REFRESH_DEADLINE", "30"))
+
+
+def refresh_deadline():
+    """本次刷新的绝对截止时间 (time.monotonic)"""
+    return time.monotonic() + REFRESH_DEADLINE
+
+
+def _attempt(provider, symbol, timeout, started):
+    """单标的兜底: 先查实时报价 (fast_info)，再单独下载最近5天日线"""
+    started[symbol] = time.monotonic()
+    error = None
+    try:
+        q = provider.quote(symbol)
+        if q and q[0]:
+            return q
+    except Exception as e:
+        error = e
+    if time.monotonic() - started[symbol] < timeout:
+        try:
+            bars = provider.fetch([symbol], "5d").get(symbol)
+            if bars:
+                return last_and_prev(bars)
+        except Exception as e:
+            error = e
+    if error is not None:
+        raise error
+    return None
+
+
+def fetch_fallbacks(provider, symbols, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT, deadline=None):
+    """
+    并发重试 symbols。
+    返回 (quotes, failed): quotes 为 {symbol: (现价, 昨收)}，failed 为 {symbol: 失败原因}
+    """
+    symbols = list(dict.fromkeys(symbols))
+    quotes, failed = {}, {}
+    if not symbols:
+        return quotes, failed
+    deadline = deadline if deadline is not None else refresh_deadline()
+
+    started = {}
+    pool = ThreadPoolExecutor(max_workers=max(1, min(workers, len(symbols))), thread_name_prefix="fallback")
+    futures = {pool.submit(_attempt, provider, sym, timeout, started): sym for sym in symbols}
+    pending = set(futures)
+    try:
+        while pending:
+            now = time.monotonic()
+            remaining = deadline - now
+            if remaining <= 0:
+                break
+
+            # 已开始但超过单标的超时的任务直接放弃
+            for f in list(pending):
+                sym = futures[f]
+                if sym in started and now - started[sym] >= timeout and not f.done():
+                    pending.discard(f)
+                    failed[sym] = "timeout"
+            if not pending:
+                break
+
+            done, _ = wait(pending, timeout=min(remaining, timeout), return_when=FIRST_COMPLETED)
+            for f in done:
+                pending.discard(f)
+                sym = futures[f]
+                try:
+                    q = f.result()
+                except Exception as e:
+                    failed[sym] = f"error: {e}"
+                    continue
+                if q:
+                    quotes[sym] = (float(q[0]), float(q[1] or 0.0))
+                else:
+                    failed[sym] = "no data"
+    finally:
+        for f in pending:
+            failed.setdefault(futures[f], "deadline")
+        # 不等待被放弃的任务，避免拖慢整次刷新
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    metrics.inc("fallback_symbols_total", len(symbols), help="Symbols retried after the batch download")
+    for sym in failed:
+        print(f"Fallback failed for {sym}: {failed[sym]}")
+        metrics.inc("failed_symbols_total", help="Symbols still without a price after retries",
+                    reason=failed[sym].split(":")[0])
+    return quotes, failed
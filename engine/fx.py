@@ -0,0 +1,173 @@
+"""
+多币种换算
+每个持仓带一个计价币种 (配置中的 "currency"，否则按代码后缀推断: 7203.T -> JPY、0700.HK -> HKD、BTC-EUR -> EUR)，
+价格 / 成本按该币种，估值时统一换算为 BASE_CURRENCY:
+  - FXRates: 币种 -> 基准币种汇率的缓存 (带 TTL)；vector(currencies) 返回与持仓等长的换算向量，
+    过期 / 缺失的币种一次批量请求，估值时乘到数量上 (一次向量化运算)
+  - 汇率来源可替换: QuoteFXSource (行情源的 "EURUSD=X" 货币对，默认) / StaticFXSource (固定汇率，离线测试用)
+GBp / GBX (便士报价，伦敦) 等辅币单位按主币种汇率 × 0.01 换算。
+"""
+import os
+import threading
+import time
+
+import numpy as np
+
+BASE_CURRENCY = os.environ.get("BASE_CURRENCY", "USD").upper()
+FX_TTL = float(os.environ.get("FX_TTL", "300"))
+
+# 交易所代码后缀 -> 计价币种
+SUFFIX_CURRENCY = {
+    "HK": "HKD", "T": "JPY", "L": "GBp", "TO": "CAD", "V": "CAD", "AX": "AUD", "NZ": "NZD",
+    "DE": "EUR", "F": "EUR", "PA": "EUR", "AS": "EUR", "MI": "EUR", "MC": "EUR", "BR": "EUR", "LS": "EUR",
+    "SW": "CHF", "ST": "SEK", "OL": "NOK", "CO": "DKK", "SS": "CNY", "SZ": "CNY",
+    "KS": "KRW", "KQ": "KRW", "TW": "TWD", "SI": "SGD", "NS": "INR", "BO": "INR",
+}
+# 辅币单位: 报价币种 -> (主币种, 换算系数)
+MINOR_UNITS = {"GBp": ("GBP", 0.01), "GBX": ("GBP", 0.01), "ZAc": ("ZAR", 0.01), "ILA": ("ILS", 0.01)}
+# 加密货币对 (BTC-USD / ETH-EUR) 的报价币种
+QUOTE_CURRENCIES = {"USD", "EUR", "GBP", "JPY", "CAD", "AUD", "HKD", "CHF", "CNY", "KRW", "SGD", "USDT"}
+
+
+def infer_currency(symbol, base=None):
+    """代码 -> 计价币种 (无法推断时为基准币种)"""
+    base = base or BASE_CURRENCY
+    if "." in symbol:
+        suffix = symbol.rsplit(".", 1)[1].upper()
+        if suffix in SUFFIX_CURRENCY:
+            return SUFFIX_CURRENCY[suffix]
+    if "-" in symbol:
+        quote = symbol.rsplit("-", 1)[1].upper()
+        if quote in QUOTE_CURRENCIES:
+            return "USD" if quote == "USDT" else quote
+    return base
+
+
+def position_currency(p, base=None):
+    """持仓的计价币种: 配置中的 "currency" 优先 (保留 GBp 的大小写)，否则按代码推断"""
+    currency = p.get("currency")
+    if currency:
+        return currency if currency in MINOR_UNITS else currency.upper()
+    return infer_currency(p["symbol"], base)
+
+
+def split_currency(currency):
+    """(主币种, 系数)：GBp -> ("GBP", 0.01)"""
+    return MINOR_UNITS.get(currency, (currency.upper(), 1.0))
+
+
+class QuoteFXSource:
+    """从行情源取货币对日线 ("EURUSD=X" = 1 EUR 兑多少 USD)，一次批量请求全部币种"""
+
+    def __init__(self, provider=None):
+        self.provider = provider
+
+    def fetch(self, currencies, base):
+        from engine import quotes
+
+        provider = self.provider or quotes.get_provider()
+        pairs = {f"{c}{base}=X": c for c in currencies}
+        bars = provider.fetch(list(pairs), "5d")
+        rates = {}
+        for pair, currency in pairs.items():
+            last, _ = quotes.last_and_prev(bars.get(pair))
+            if last > 0:
+                rates[currency] = last
+        return rates
+
+
+class StaticFXSource:
+    """
+    固定汇率 {币种: 1 单位兑基准币种}，离线测试 / 没有行情时使用。
+    默认读取 FX_RATES 环境变量 ("EUR=1.08,HKD=0.128")
+    """
+
+    def __init__(self, rates=None):
+        if rates is None:
+            rates = {}
+            for item in os.environ.get("FX_RATES", "").split(","):
+                if "=" in item:
+                    currency, value = item.split("=", 1)
+                    rates[currency.strip().upper()] = float(value)
+        self.rates = dict(rates)
+
+    def fetch(self, currencies, base):
+        return {c: self.rates[c] for c in currencies if c in self.rates}
+
+
+def make_source(name=None):
+    """按名称创建汇率来源: quotes (默认) / static；QUOTE_PROVIDER=fake 时默认 static (假行情的货币对没有意义)"""
+    default = "static" if os.environ.get("QUOTE_PROVIDER") == "fake" else "quotes"
+    name = name or os.environ.get("FX_SOURCE", default)
+    if name == "static":
+        return StaticFXSource()
+    return QuoteFXSource()
+
+
+class FXRates:
+    """
+    币种 -> 基准币种汇率的缓存。source: 实现 fetch(currencies, base) -> {币种: 汇率} 的对象
+    取不到汇率的币种在向量中为 NaN (调用方标注为取价失败)，上次的汇率仍在时继续使用旧值。
+    """
+
+    def __init__(self, source=None, base=BASE_CURRENCY, ttl=FX_TTL, clock=time.monotonic):
+        self.source = source or make_source()
+        self.base = base
+        self.ttl = ttl
+        self.clock = clock
+        self.rates = {}             # 主币种 -> (汇率, 取得时间)
+        self._lock = threading.Lock()
+
+    def refresh(self, currencies):
+        """批量请求过期或缺失的主币种 (一次调用)；返回仍缺失的币种"""
+        now = self.clock()
+        with self._lock:
+            stale = sorted({c for c in currencies if c != self.base
+                            and (c not in self.rates or now - self.rates[c][1] >= self.ttl)})
+        if stale:
+            try:
+                fetched = self.source.fetch(stale, self.base)
+            except Exception as e:
+                print(f"FX fetch failed ({', '.join(stale)}): {e}")
+                fetched = {}
+            with self._lock:
+                for c, rate in fetched.items():
+                    self.rates[c] = (float(rate), now)
+        with self._lock:
+            return [c for c in set(currencies) if c != self.base and c not in self.rates]
+
+    def vector(self, currencies):
+        """与 currencies 等长的换算系数 (1 单位报价币种 = 多少基准币种)，缺失为 NaN"""
+        majors = [split_currency(c) for c in currencies]
+        self.refresh({m for m, _ in majors})
+        with self._lock:
+            table = {c: r for c, (r, _) in self.rates.items()}
+        table[self.base] = 1.0
+        return np.array([table.get(m, np.nan) * factor for m, factor in majors], dtype=float)
+
+    def snapshot(self, currencies):
+        """data.json 的 fx: {"base", "rates": {币种: 汇率}} (只含用到的非基准币种)"""
+        majors = sorted({split_currency(c)[0] for c in currencies} - {self.base})
+        with self._lock:
+            rates = {c: self.rates[c][0] for c in majors if c in self.rates}
+        return {"base": self.base, "rates": rates}
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_rates():
+    """进程共享的 FXRates (首次使用时创建)"""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = FXRates()
+        return _default
+
+
+def set_rates(rates):
+    """替换默认汇率缓存 (测试时注入 StaticFXSource)"""
+    global _default
+    with _default_lock:
+        _default = rates
@@ -0,0 +1,217 @@
+"""
+多分辨率历史曲线
+日线净值序列预先聚合为 daily / weekly / monthly 三级 (周 / 月取最后一个交易日的值)，另有当日的 intraday 序列。
+查询 (range, max_points) 时选择点数不超过 max_points × OVERSAMPLE 的最细一级，
+再用 LTTB (Largest-Triangle-Three-Buckets) 降采样到 max_points 个点:
+10 年和 30 天的返回点数 / 字节数 / 前端绘制开销相同，LTTB 保留峰谷形状。
+"""
+import threading
+import time
+from collections import deque
+from datetime import date
+
+import numpy as np
+
+from engine.quotes import PERIOD_DAYS
+
+DEFAULT_MAX_POINTS = 200
+MAX_POINTS_LIMIT = 2000
+# 选级别时允许的超采样倍数: 点数略多于 max_points 时仍用更细的级别，由 LTTB 挑点
+OVERSAMPLE = 4
+LEVELS = ("daily", "weekly", "monthly")
+# range=max 时回溯的年限
+MAX_RANGE_DAYS = PERIOD_DAYS["10y"]
+# 没有盘中数据时，1 天以内的查询退回最近一周的日线
+MIN_DAILY_DAYS = 7
+
+
+def parse_range(text, default="3mo"):
+    """
+    解析 range 参数，返回天数。
+    支持 1d / 5d / 1mo / 3mo / 1y / 10y 等 (与行情 period 一致)、任意 Nd / Nw / Nm / Ny、ytd、max
+    """
+    text = (text or default).strip().lower()
+    if text in PERIOD_DAYS:
+        return PERIOD_DAYS[text]
+    if text == "max":
+        return MAX_RANGE_DAYS
+    if text == "ytd":
+        today = date.today()
+        return (today - date(today.year, 1, 1)).days + 1
+    units = {"d": 1, "w": 7, "m": 30, "y": 365}
+    if text[-1:] in units and text[:-1].isdigit():
+        return max(1, int(text[:-1]) * units[text[-1]])
+    raise ValueError(f"invalid range: {text}")
+
+
+def parse_max_points(text):
+    if not text:
+        return DEFAULT_MAX_POINTS
+    return min(MAX_POINTS_LIMIT, max(3, int(text)))
+
+
+def fetch_period(days):
+    """覆盖 days 天的最短行情 period"""
+    for period, span in sorted(PERIOD_DAYS.items(), key=lambda kv: kv[1]):
+        if span >= days:
+            return period
+    return "10y"
+
+
+def lttb(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets 降采样，返回选中点的下标 (升序，含首尾)。
+    x / y 为等长数组，x 单调递增。
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # 首尾之外的点平均分成 n_out - 2 个桶
+    edges = np.floor(np.linspace(1, n - 1, n_out - 1)).astype(np.intp)
+    selected = np.empty(n_out, dtype=np.intp)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # 下一个桶的平均点 (最后一个桶用终点)
+        if i + 2 < len(edges):
+            nlo, nhi = edges[i + 1], edges[i + 2]
+            cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        else:
+            cx, cy = x[-1], y[-1]
+        # 与上一个选中点、下一桶平均点构成的三角形面积最大的点
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def _day_numbers(dates):
+    """YYYY-MM-DD 字符串 -> 自 1970-01-01 起的天数"""
+    return np.array(dates, dtype="datetime64[D]").astype(np.int64)
+
+
+def _last_of_groups(keys):
+    """有序分组键中每组最后一个元素的下标"""
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.intp)
+    return np.append(np.flatnonzero(np.diff(keys) != 0), len(keys) - 1)
+
+
+class HistoryLevels:
+    """由日线净值序列 [{"date", "value"}] 预聚合的三级序列"""
+
+    def __init__(self, points):
+        self.dates = [p["date"] for p in points]
+        self.values = np.array([p["value"] for p in points], dtype=float)
+        self.days = _day_numbers(self.dates) if self.dates else np.zeros(0, dtype=np.int64)
+        # 1970-01-01 为周四，+3 后按 7 整除即以周一为一周的开始
+        weekly = _last_of_groups((self.days + 3) // 7)
+        monthly = _last_of_groups(self.days.astype("datetime64[D]").astype("datetime64[M]").astype(np.int64))
+        self.index = {"daily": np.arange(len(self.dates)), "weekly": weekly, "monthly": monthly}
+
+    def __len__(self):
+        return len(self.dates)
+
+    def update_last(self, value):
+        """用当前净值覆盖最后一点 (今天)"""
+        if len(self.values):
+            self.values[-1] = value
+
+    def query(self, days, max_points=DEFAULT_MAX_POINTS, end=None):
+        """最近 days 天的序列，返回 (level, 日期列表, 值数组)"""
+        if not len(self.dates):
+            return "daily", [], self.values
+        end_day = self.days[-1] if end is None else _day_numbers([end])[0]
+        start_day = end_day - days + 1
+        level, rows = "monthly", None
+        for name in LEVELS:
+            idx = self.index[name]
+            idx = idx[(self.days[idx] >= start_day) & (self.days[idx] <= end_day)]
+            level, rows = name, idx
+            if len(idx) <= max_points * OVERSAMPLE:
+                break
+        # 当前值 (最后一个点) 总是保留，周 / 月级别的最后一组本身就以它结尾
+        keep = lttb(self.days[rows], self.values[rows], max_points)
+        rows = rows[keep]
+        return level, [self.dates[i] for i in rows], self.values[rows]
+
+
+class LevelCache:
+    """
+    HistoryLevels 缓存: 日线序列只取决于持仓配置和日期，key (配置摘要, 日期) 不变时每个 period 只生成一次，
+    较长 period 的结果同样用于更短的查询
+    """
+
+    def __init__(self):
+        self.key = None
+        self.by_span = {}           # period 覆盖的天数 -> HistoryLevels
+        self._lock = threading.Lock()
+
+    def get(self, key, days, build):
+        """覆盖 days 天的 HistoryLevels；未缓存时调用 build(period) 生成日线序列 [{"date", "value"}]"""
+        days = max(days, MIN_DAILY_DAYS)
+        with self._lock:
+            if self.key != key:
+                self.key, self.by_span = key, {}
+            cached = [(span, lv) for span, lv in self.by_span.items() if span >= days]
+        if cached:
+            return min(cached, key=lambda item: item[0])[1]
+        period = fetch_period(days)
+        levels = HistoryLevels(build(period))
+        with self._lock:
+            if self.key == key:
+                self.by_span[PERIOD_DAYS[period]] = levels
+        return levels
+
+
+class IntradaySeries:
+    """当日盘中净值 (每次快照发布记录一个点)，只在内存中保留最近 maxlen 个点"""
+
+    def __init__(self, maxlen=2000):
+        self.points = deque(maxlen=maxlen)     # (unix 时间, 值)
+        self._lock = threading.Lock()
+
+    def record(self, value, ts=None):
+        ts = time.time() if ts is None else ts
+        with self._lock:
+            if self.points and self.points[-1][0] >= ts:
+                return
+            self.points.append((ts, float(value)))
+
+    def query(self, seconds, max_points=DEFAULT_MAX_POINTS, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            points = [p for p in self.points if p[0] >= now - seconds]
+        if not points:
+            return [], np.zeros(0)
+        ts = np.array([p[0] for p in points])
+        values = np.array([p[1] for p in points])
+        keep = lttb(ts, values, max_points)
+        labels = [time.strftime("%Y-%m-%d %H:%M", time.localtime(t)) for t in ts[keep]]
+        return labels, values[keep]
+
+
+def query(levels, range_text=None, max_points=None, intraday=None):
+    """
+    /api/history 的响应: {"range", "level", "max_points", "source_points", "history": [{"date", "value"}]}
+    range 不超过 1 天且有盘中数据时返回 intraday 级别
+    """
+    days = parse_range(range_text)
+    max_points = parse_max_points(max_points)
+    level, labels, values = None, [], []
+    if days <= 1 and intraday is not None:
+        labels, values = intraday.query(days * 86400, max_points)
+        level = "intraday" if len(labels) >= 2 else None
+    if level is None:
+        level, labels, values = levels.query(max(days, MIN_DAILY_DAYS), max_points)
+    return {
+        "range": range_text or "3mo",
+        "level": level,
+        "max_points": max_points,
+        "source_points": len(levels),
+        "history": [{"date": d, "value": float(v)} for d, v in zip(labels, values)],
+    }
+
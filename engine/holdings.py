@@ -0,0 +1,135 @@
+"""
+持仓配置热加载
+manual_portfolio.py 按文件路径执行 (不经过 import 缓存)，修改时间 / 大小变化后再比对内容哈希，
+内容确实变化才重新加载，进程不需要重启。
+每次重新加载同时给出新旧持仓的差异 (新增 / 修改 / 删除的标的)，调用方只需重新取价和估值变化的标的，
+其余标的沿用上一次的报价 (或行情缓存)。
+配置有语法错误等问题时打印错误并继续使用上一个有效版本。
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import namedtuple
+
+DEFAULT_PATH = os.environ.get(
+    "PORTFOLIO_CONFIG",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "manual_portfolio.py"))
+
+# positions: POSITIONS 列表; cash: TOTAL_CASH; conids: 可选的 CONIDS; digest: 文件内容哈希
+Holdings = namedtuple("Holdings", "positions cash conids digest")
+# 按标的的差异 (均为 set)；cash_changed 表示只有现金变化也需要重新汇总
+Change = namedtuple("Change", "added changed removed cash_changed")
+
+
+def from_module(module):
+    """由已导入的配置模块构建 (命令行一次性运行时使用)"""
+    return Holdings(list(getattr(module, "POSITIONS")), getattr(module, "TOTAL_CASH", 0.0),
+                    dict(getattr(module, "CONIDS", {})), None)
+
+
+def lots_by_symbol(positions):
+    """symbol -> 该标的全部 lot 的规范化表示 (用于比较)"""
+    lots = {}
+    for p in positions:
+        lots.setdefault(p["symbol"], []).append(json.dumps(p, sort_keys=True, default=str))
+    return {sym: sorted(items) for sym, items in lots.items()}
+
+
+def diff(old, new):
+    """比较两份 Holdings，返回 Change；old 为 None 时全部视为新增"""
+    new_lots = lots_by_symbol(new.positions)
+    if old is None:
+        return Change(set(new_lots), set(), set(), True)
+    old_lots = lots_by_symbol(old.positions)
+    added = {s for s in new_lots if s not in old_lots}
+    changed = {s for s in new_lots if s in old_lots and old_lots[s] != new_lots[s]}
+    removed = {s for s in old_lots if s not in new_lots}
+    return Change(added, changed, removed, old.cash != new.cash)
+
+
+class PositionSource:
+    """
+    path: 配置文件路径 (默认仓库根目录的 manual_portfolio.py，可用 PORTFOLIO_CONFIG 覆盖)
+    current() 返回当前有效配置；poll() 检查文件并在内容变化时重新加载。
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.holdings = None
+        self._stat = None           # (mtime_ns, size)
+        self._lock = threading.Lock()
+        self.reloads = 0
+
+    def _read_stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def changed(self):
+        """
+        配置内容是否变化 (不重新加载)：先比较 stat，变化时再比对内容哈希；
+        只是 touch / 保存了相同内容的记下新的 stat，不算变化
+        """
+        with self._lock:
+            if self.holdings is None:
+                return True
+            stat = self._read_stat()
+            if stat == self._stat:
+                return False
+            try:
+                with open(self.path, "rb") as f:
+                    digest = hashlib.sha1(f.read()).hexdigest()
+            except OSError:
+                return False
+            if digest == self.holdings.digest:
+                self._stat = stat
+                return False
+            return True
+
+    def _load(self, raw):
+        namespace = {"__file__": self.path, "__name__": "manual_portfolio"}
+        exec(compile(raw, self.path, "exec"), namespace)
+        if "POSITIONS" not in namespace:
+            raise ValueError(f"No POSITIONS found in {os.path.basename(self.path)}")
+        return Holdings(list(namespace["POSITIONS"]), namespace.get("TOTAL_CASH", 0.0),
+                        dict(namespace.get("CONIDS", {})), hashlib.sha1(raw).hexdigest())
+
+    def poll(self):
+        """
+        返回 (holdings, change)；内容未变化时 change 为 None。
+        第一次加载失败时抛异常，之后的加载失败只打印错误并保留上一个有效版本。
+        """
+        with self._lock:
+            stat = self._read_stat()
+            if self.holdings is not None and stat == self._stat:
+                return self.holdings, None
+            try:
+                with open(self.path, "rb") as f:
+                    raw = f.read()
+                digest = hashlib.sha1(raw).hexdigest()
+                # 只是 touch / 保存了相同内容: 更新 stat，不重新加载
+                if self.holdings is not None and digest == self.holdings.digest:
+                    self._stat = stat
+                    return self.holdings, None
+                holdings = self._load(raw)
+            except Exception as e:
+                if self.holdings is None:
+                    raise
+                print(f"Portfolio config reload failed, keeping previous version: {e}")
+                self._stat = stat
+                return self.holdings, None
+
+            change = diff(self.holdings, holdings)
+            if self.holdings is not None:
+                self.reloads += 1
+                print(f"Portfolio config reloaded: +{len(change.added)} ~{len(change.changed)} "
+                      f"-{len(change.removed)} symbols")
+            self.holdings, self._stat = holdings, stat
+            return holdings, change
+
+    def current(self):
+        """当前有效配置 (必要时重新加载)"""
+        return self.poll()[0]
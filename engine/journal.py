@@ -0,0 +1,252 @@
+"""
+快照日志 (append-only)
+每次计算出的快照追加到 .cache/journal/ 下的两个文件，不再只保留最新的 data.json:
+  - snapshots.log: 记录体，每条为 zlib 压缩的紧凑 JSON (updated_at / portfolio / positions / accounts)
+  - snapshots.idx: 定长索引 (时间戳, 偏移, 长度, crc32, 总市值, 当日盈亏)，按时间递增
+追加只写两个文件的末尾 (O(1))；时间范围查询对 mmap 的索引二分查找，
+净值曲线直接从索引读取，不解压记录体，指定时刻的持仓明细只读一条记录。
+与按当前持仓回溯的 history 不同，这里是实际记录下来的净值，调仓前后都正确。
+"""
+import bisect
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from engine import artifacts
+
+try:
+    import fcntl
+except ImportError:         # Windows: 只有进程内的锁
+    fcntl = None
+
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "journal")
+# 同一进程两次记录的最小间隔 (秒)：实时行情每秒都可能发布快照，日志只按这个间隔采样
+DEFAULT_INTERVAL = float(os.environ.get("JOURNAL_INTERVAL", "60"))
+
+# 索引记录: ts (unix 秒), offset, length, crc32, total_value, day_pnl
+RECORD = struct.Struct("<dQIIdd")
+LOG_NAME = "snapshots.log"
+INDEX_NAME = "snapshots.idx"
+
+
+def parse_time(text):
+    """unix 秒 / YYYY-MM-DD / YYYY-MM-DDTHH:MM[:SS] (本地时间) -> unix 秒；空值返回 None"""
+    if text is None or text == "":
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(text.replace(" ", "T")).timestamp()
+    except ValueError:
+        raise ValueError(f"invalid time: {text}") from None
+
+
+def format_time(ts):
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class _Timestamps:
+    """索引中时间戳列的只读序列视图 (供 bisect 二分查找，不复制)"""
+
+    def __init__(self, buf, count):
+        self.buf, self.count = buf, count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return RECORD.unpack_from(self.buf, i * RECORD.size)[0]
+
+
+class SnapshotJournal:
+    """
+    directory: 日志目录 (默认 .cache/journal，可用 SNAPSHOT_JOURNAL 覆盖)
+    多个进程 (main.py 定时任务 + server.py) 可以同时追加: 追加时对索引文件加 flock，偏移按当前文件大小计算。
+    """
+
+    def __init__(self, directory=DEFAULT_DIR, interval=DEFAULT_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        os.makedirs(directory, exist_ok=True)
+        self.log_path = os.path.join(directory, LOG_NAME)
+        self.index_path = os.path.join(directory, INDEX_NAME)
+        self._log = open(self.log_path, "ab")
+        self._index = open(self.index_path, "ab")
+        self._lock = threading.Lock()
+        self._map = None
+        self._mapped = 0            # 已映射的索引记录数
+        self._last_append = 0.0
+        with self._lock, self._file_lock():
+            self._recover()
+
+    def close(self):
+        with self._lock:
+            self._unmap()
+            self._log.close()
+            self._index.close()
+
+    def _file_lock(self):
+        return _FileLock(self._index if fcntl else None)
+
+    def _recover(self):
+        """
+        截掉崩溃留下的半条记录: 索引按整条截断，丢弃指向日志末尾之外的索引项，
+        再把日志截到最后一条已索引记录的末尾 (写了记录体但没写索引的部分)
+        """
+        log_size = os.fstat(self._log.fileno()).st_size
+        count = os.fstat(self._index.fileno()).st_size // RECORD.size
+        end = 0
+        with open(self.index_path, "rb") as f:
+            while count:
+                f.seek((count - 1) * RECORD.size)
+                _, offset, length, _, _, _ = RECORD.unpack(f.read(RECORD.size))
+                if offset + length <= log_size:
+                    end = offset + length
+                    break
+                count -= 1
+        if os.fstat(self._index.fileno()).st_size != count * RECORD.size:
+            self._index.truncate(count * RECORD.size)
+        if log_size != end:
+            self._log.truncate(end)
+
+    def __len__(self):
+        return os.fstat(self._index.fileno()).st_size // RECORD.size
+
+    def append(self, snapshot, ts=None, force=False):
+        """
+        追加一条快照 ({"updated_at", "portfolio", "positions", ...})，返回记录序号；
+        距上次记录不足 interval 秒时跳过并返回 None (force=True 时总是记录)
+        """
+        now = time.time()
+        ts = now if ts is None else ts
+        if not force and now - self._last_append < self.interval:
+            return None
+        portfolio = snapshot.get("portfolio", {})
+        body = zlib.compress(artifacts.dumps(snapshot, "compact"), 6)
+        with self._lock, self._file_lock():
+            # 1. 记录体追加到日志末尾 (偏移取当前文件大小，其他进程也可能追加过)
+            offset = os.fstat(self._log.fileno()).st_size
+            self._log.write(body)
+            self._log.flush()
+            # 2. 再写索引: 崩溃在两步之间时，没有索引的记录体在下次打开时截掉
+            count = os.fstat(self._index.fileno()).st_size // RECORD.size
+            if count:
+                # 时间戳保持严格递增 (时钟回拨时顺延)，二分查找依赖有序
+                last = self._read_record(count - 1)[0]
+                ts = max(ts, last + 1e-6)
+            self._index.write(RECORD.pack(ts, offset, len(body), zlib.crc32(body),
+                                          float(portfolio.get("total_value", 0.0)),
+                                          float(portfolio.get("day_pnl", 0.0))))
+            self._index.flush()
+            self._last_append = now
+            return count
+
+    def _read_record(self, i):
+        with open(self.index_path, "rb") as f:
+            f.seek(i * RECORD.size)
+            return RECORD.unpack(f.read(RECORD.size))
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+        self._map, self._mapped = None, 0
+
+    def _view(self):
+        """(mmap, 记录数)；索引增长后重新映射"""
+        count = len(self)
+        if count == 0:
+            return None, 0
+        if self._map is None or count != self._mapped:
+            self._unmap()
+            with open(self.index_path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), count * RECORD.size, access=mmap.ACCESS_READ)
+            self._mapped = count
+        return self._map, count
+
+    def span(self, start=None, end=None):
+        """时间在 [start, end] 内的记录序号范围 [lo, hi)，二分查找"""
+        with self._lock:
+            buf, count = self._view()
+            if not count:
+                return 0, 0
+            keys = _Timestamps(buf, count)
+            lo = 0 if start is None else bisect.bisect_left(keys, start)
+            hi = count if end is None else bisect.bisect_right(keys, end)
+            return lo, max(lo, hi)
+
+    def entries(self, start=None, end=None):
+        """[start, end] 内的索引项 (numpy 结构化数组: ts / value / day_pnl)，不读取记录体"""
+        import numpy as np
+
+        dtype = np.dtype([("ts", "<f8"), ("offset", "<u8"), ("length", "<u4"), ("crc", "<u4"),
+                          ("value", "<f8"), ("day_pnl", "<f8")])
+        lo, hi = self.span(start, end)
+        with self._lock:
+            buf, count = self._view()
+            if hi <= lo:
+                return np.zeros(0, dtype=dtype)
+            return np.frombuffer(buf, dtype=dtype, count=hi - lo, offset=lo * RECORD.size).copy()
+
+    def read(self, i):
+        """第 i 条记录的快照 (校验 crc32)"""
+        ts, offset, length, crc, _, _ = self._read_record(i)
+        with open(self.log_path, "rb") as f:
+            f.seek(offset)
+            body = f.read(length)
+        if len(body) != length or zlib.crc32(body) != crc:
+            raise ValueError(f"journal record {i} is corrupt")
+        return ts, json.loads(zlib.decompress(body))
+
+    def at(self, ts):
+        """ts 时刻 (含) 之前最近一条记录，返回 (记录时间, 快照)；早于第一条时返回 None"""
+        _, hi = self.span(None, ts)
+        if hi == 0:
+            return None
+        return self.read(hi - 1)
+
+    def nav(self, start=None, end=None, max_points=None):
+        """
+        记录下来的净值曲线 [{"time", "value", "day_pnl"}]；max_points 给定时用 LTTB 降采样
+        """
+        from engine.history import lttb
+
+        rows = self.entries(start, end)
+        if max_points and len(rows) > max_points:
+            rows = rows[lttb(rows["ts"], rows["value"], max_points)]
+        return [{"time": format_time(ts), "value": float(v), "day_pnl": float(p)}
+                for ts, v, p in zip(rows["ts"], rows["value"], rows["day_pnl"])]
+
+
+class _FileLock:
+    """对索引文件加排他 flock (跨进程追加)；没有 fcntl 时为空操作"""
+
+    def __init__(self, f):
+        self.f = f
+
+    def __enter__(self):
+        if self.f is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self.f is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+
+
+def open_journal(directory=None):
+    """打开默认快照日志 (SNAPSHOT_JOURNAL 环境变量指定目录，设为 off 关闭)；不可写时返回 None"""
+    directory = directory or os.environ.get("SNAPSHOT_JOURNAL", DEFAULT_DIR)
+    if directory.lower() in ("off", "none", "0"):
+        return None
+    try:
+        return SnapshotJournal(directory)
+    except OSError as e:
+        print(f"Snapshot journal unavailable ({directory}): {e}")
+        return None
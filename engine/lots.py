@@ -0,0 +1,285 @@
+"""
+多账户 / 多笔持仓 (lot) 汇总
+POSITIONS 中每一条是一个 lot，可带 "account" 标签 (本人 / 家人等账户)；同一标的可以出现在多个账户。
+  - 按标的聚合: 每个标的只取价 / 定价一次，lot 通过下标取所属标的的价格
+  - 汇总: 按标的 (data.json 的 positions，合并视图) 和按账户 (data.json 的 accounts)
+  - 增量: 单个价格 (update_price) 或单个 lot (update_lot) 变化时只更新受影响的标的 / 账户 / 总计，
+    不全量重算；rebuild() 全量重算，生成快照时使用，也用于定期消除增量累加的浮点误差
+"""
+import numpy as np
+
+from engine import fx, options, valuation
+from engine.portfolio import FIELDS, Portfolio
+
+DEFAULT_ACCOUNT = "default"
+
+
+class LotBook:
+    """
+    lots:     Portfolio (每行一个 lot)
+    accounts: 每个 lot 的账户名，默认取配置中的 "account" 字段
+    """
+
+    def __init__(self, lots, accounts=None):
+        self.lots = lots
+        if accounts is None:
+            accounts = [c.get('account', DEFAULT_ACCOUNT) for c in lots.config] if lots.config is not None \
+                else [DEFAULT_ACCOUNT] * len(lots)
+
+        # 标的 / 账户编码 (按首次出现顺序)
+        self.symbols = list(dict.fromkeys(lots.symbols))
+        self.symbol_index = {s: k for k, s in enumerate(self.symbols)}
+        self.symbol_code = np.array([self.symbol_index[s] for s in lots.symbols], dtype=np.intp)
+        self.accounts = list(dict.fromkeys(accounts))
+        self.account_index = {a: j for j, a in enumerate(self.accounts)}
+        self.account_code = np.array([self.account_index[a] for a in accounts], dtype=np.intp)
+
+        # 每个标的的 lot 行号: 按标的稳定排序后切片
+        n_symbols = len(self.symbols)
+        self._order = np.argsort(self.symbol_code, kind='stable')
+        self._bounds = np.searchsorted(self.symbol_code[self._order], np.arange(n_symbols + 1))
+
+        # 每个标的一个价格: 手动定价取该标的第一个带 manual_price 的 lot，否则用第一个 lot 的已知价格
+        first = self._order[self._bounds[:-1]] if n_symbols else np.zeros(0, dtype=np.intp)
+        self.manual_price = np.full(n_symbols, np.nan)
+        for row in np.flatnonzero(lots.manual)[::-1]:
+            self.manual_price[self.symbol_code[row]] = lots.manual_price[row]
+        self.manual = ~np.isnan(self.manual_price)
+        # 每单位数量的股数 (期权合约 100)；同一代码的 lot 相同
+        self.multiplier = lots.multiplier[first]
+        self.option = np.array([options.is_option(s) for s in self.symbols], dtype=bool)
+        # 计价币种 (取第一个 lot) 和换算为基准币种的汇率 (set_prices 时传入；
+        # 由快照的 positions 重建时沿用其中的 fx_rate，否则为 1)
+        self.currency = [lots.currency[i] for i in first.tolist()]
+        self.fx = np.ones(n_symbols)
+        if lots.config is not None:
+            self.fx = np.array([lots.config[i].get('fx_rate', 1.0) for i in first.tolist()], dtype=float)
+        self.price = np.where(self.manual, self.manual_price, lots.price[first])
+        self.prev = np.where(self.manual, self.manual_price, 0.0)
+        self.missing = np.zeros(n_symbols, dtype=bool)
+        self.rebuild()
+
+    @classmethod
+    def from_positions(cls, positions):
+        return cls(Portfolio.from_positions(positions))
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def lots_of(self, symbol):
+        """该标的的 lot 行号"""
+        k = self.symbol_index.get(symbol)
+        if k is None:
+            return np.zeros(0, dtype=np.intp)
+        return self._order[self._bounds[k]:self._bounds[k + 1]]
+
+    def quote_symbols(self):
+        """需要向行情源请求的标的 (排除手动定价和期权代码，期权由 option_chain 按标的价格定价)"""
+        return [s for s, m, o in zip(self.symbols, self.manual, self.option) if not m and not o and ' ' not in s]
+
+    def unpriced(self, prices):
+        """没有手动定价、也不在 prices 中的标的 (不含期权)"""
+        return [s for s, m, o in zip(self.symbols, self.manual, self.option) if not m and not o and s not in prices]
+
+    def option_chain(self):
+        """期权持仓的 OptionChain (配置中的 "iv" 为该合约的隐含波动率)；没有期权时返回 None"""
+        if not self.option.any():
+            return None
+        ks = np.flatnonzero(self.option)
+        config = self.lots.config
+        iv = [np.nan] * len(ks)
+        if config is not None:
+            iv = [config[self.lots_of(self.symbols[k])[0]].get('iv', np.nan) for k in ks]
+        return options.get_chain([self.symbols[k] for k in ks], iv)
+
+    @property
+    def symbol_units(self):
+        """每个标的的换算系数 (数量 × 乘数 × 汇率)：当地价格 × symbol_units = 基准币种市值，用于回溯历史"""
+        return self.symbol_quantity * self.multiplier * self.fx
+
+    # ---- 定价 ----
+
+    def set_prices(self, last, prev_close, failed=(), fx_rates=None):
+        """
+        last / prev_close: {symbol: 价格}，每个标的一次；手动定价优先。
+        failed: 取价失败的标的，在输出中标注 price_missing。全量重算汇总。
+        fx_rates: 与 symbols 等长的汇率向量 (计价币种 -> 基准币种，engine.fx.FXRates.vector)，默认不换算
+        """
+        if fx_rates is not None:
+            self.fx = np.asarray(fx_rates, dtype=float)
+        quoted = np.array([last.get(s, 0.0) for s in self.symbols], dtype=float)
+        quoted_prev = np.array([prev_close.get(s, 0.0) for s in self.symbols], dtype=float)
+        self.price = np.where(self.manual, self.manual_price, quoted)
+        self.prev = np.where(self.manual, self.manual_price, quoted_prev)
+        self.missing = np.array([s in failed for s in self.symbols], dtype=bool)
+        self.rebuild()
+
+    def _lot_values(self, rows):
+        """rows 这些 lot 的 (市值, 日盈亏, 成本)，按所属标的当前价格计算"""
+        code = self.symbol_code[rows]
+        price, prev = self.price[code], self.prev[code]
+        # 换算为基准币种: 汇率并入数量，一次乘法
+        quantity = self.lots.quantity[rows] * self.lots.multiplier[rows] * self.fx[code]
+        has_price = price != 0
+        has_prev = has_price & (prev != 0)
+        market_value = np.where(has_price, quantity * price, 0.0)
+        day_pnl = np.where(has_prev, (price - prev) * quantity, 0.0)
+        return market_value, day_pnl, self.lots.cost_basis[rows] * quantity
+
+    # ---- 汇总 ----
+
+    def rebuild(self):
+        """全量重算按标的 / 按账户汇总和总计"""
+        n_symbols, n_accounts = len(self.symbols), len(self.accounts)
+        market_value, day_pnl, cost = self._lot_values(slice(None))
+        by_symbol = lambda w: np.bincount(self.symbol_code, weights=w, minlength=n_symbols)
+        by_account = lambda w: np.bincount(self.account_code, weights=w, minlength=n_accounts)
+
+        self.symbol_quantity = by_symbol(self.lots.quantity)
+        self.symbol_market_value = by_symbol(market_value)
+        self.symbol_day_pnl = by_symbol(day_pnl)
+        self.symbol_cost = by_symbol(cost)
+        self.account_market_value = by_account(market_value)
+        self.account_day_pnl = by_account(day_pnl)
+        self.account_cost = by_account(cost)
+        self.account_lots = np.bincount(self.account_code, minlength=n_accounts)
+
+        # 按标的顺序依次累加 (每个标的一个 lot 时与逐持仓累加的结果逐位相同)
+        legs = np.stack([self.symbol_market_value, self.symbol_day_pnl, self.symbol_cost])
+        totals = valuation.matvec(legs, np.ones(n_symbols))
+        self.market_value, self.day_pnl, self.total_cost = (float(v) for v in totals)
+
+    def _apply(self, k, rows, d_market_value, d_day_pnl, d_cost):
+        """把 rows (同属标的 k) 的变化量加到标的 / 账户 / 总计"""
+        self.symbol_market_value[k] += d_market_value.sum()
+        self.symbol_day_pnl[k] += d_day_pnl.sum()
+        self.symbol_cost[k] += d_cost.sum()
+        accounts = self.account_code[rows]
+        np.add.at(self.account_market_value, accounts, d_market_value)
+        np.add.at(self.account_day_pnl, accounts, d_day_pnl)
+        np.add.at(self.account_cost, accounts, d_cost)
+        self.market_value += float(d_market_value.sum())
+        self.day_pnl += float(d_day_pnl.sum())
+        self.total_cost += float(d_cost.sum())
+
+    def update_price(self, symbol, last, prev=None):
+        """单个标的价格变化 (实时行情)，只更新持有它的 lot 所在的标的 / 账户汇总"""
+        k = self.symbol_index.get(symbol)
+        if k is None or not last:
+            return False
+        rows = self.lots_of(symbol)
+        old_mv, old_day, _ = self._lot_values(rows)
+        self.price[k] = last
+        if prev:
+            self.prev[k] = prev
+        self.missing[k] = False
+        new_mv, new_day, _ = self._lot_values(rows)
+        self._apply(k, rows, new_mv - old_mv, new_day - old_day, np.zeros(len(rows)))
+        return True
+
+    def update_lot(self, row, quantity=None, cost_basis=None):
+        """单个 lot 的数量 / 成本变化 (配置修改)，只更新该 lot 的标的 / 账户汇总"""
+        rows = np.array([row], dtype=np.intp)
+        old_mv, old_day, old_cost = self._lot_values(rows)
+        old_quantity = self.lots.quantity[row]
+        if quantity is not None:
+            self.lots.quantity[row] = quantity
+        if cost_basis is not None:
+            self.lots.cost_basis[row] = cost_basis
+        new_mv, new_day, new_cost = self._lot_values(rows)
+        k = self.symbol_code[row]
+        self.symbol_quantity[k] += self.lots.quantity[row] - old_quantity
+        self._apply(k, rows, new_mv - old_mv, new_day - old_day, new_cost - old_cost)
+
+    # ---- 输出 ----
+
+    def fields(self):
+        """按标的的估值字段 (与 valuation.value_positions 相同的列)"""
+        has_price = self.price != 0
+        has_prev = has_price & (self.prev != 0)
+        total_pnl = np.where(has_price, self.symbol_market_value - self.symbol_cost, 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pnl_percent = np.where(has_price & (self.symbol_cost != 0), total_pnl / self.symbol_cost * 100, 0.0)
+            day_pnl_percent = np.where(has_prev, (self.price - self.prev) / self.prev * 100, 0.0)
+        return {
+            "market_value": self.symbol_market_value,
+            "total_pnl": total_pnl,
+            "pnl_percent": pnl_percent,
+            "day_pnl": self.symbol_day_pnl,
+            "day_pnl_percent": day_pnl_percent,
+        }
+
+    def _describe(self, k):
+        """标的 k 的配置部分: 单个 lot 原样保留配置，多个 lot 合并 (数量求和，成本取加权平均)"""
+        rows = self.lots_of(self.symbols[k])
+        config = self.lots.config
+        if len(rows) == 1:
+            row = rows[0]
+            if config is not None:
+                return dict(config[row])
+            return {"symbol": self.symbols[k], "quantity": float(self.lots.quantity[row]),
+                    "cost_basis": float(self.lots.cost_basis[row])}
+
+        quantity = self.symbol_quantity[k]
+        p = {
+            "symbol": self.symbols[k],
+            "quantity": float(quantity),
+            "cost_basis": float(self.lots.cost_basis[rows] @ self.lots.quantity[rows] / quantity) if quantity else 0.0,
+        }
+        if self.manual[k]:
+            p['manual_price'] = float(self.manual_price[k])
+        p['lots'] = [{
+            "account": self.accounts[self.account_code[row]],
+            "quantity": config[row]['quantity'] if config is not None else float(self.lots.quantity[row]),
+            "cost_basis": float(self.lots.cost_basis[row]),
+        } for row in rows.tolist()]
+        return p
+
+    def to_positions(self):
+        """序列化为 data.json 的 positions (每个标的一行，按市值降序)"""
+        fields = self.fields()
+        price = self.price.tolist()
+        missing = self.missing.tolist()
+        columns = {k: fields[k].tolist() for k in FIELDS}
+        total = self.market_value
+        allocation = (fields['market_value'] / total * 100).tolist() if total else None
+
+        positions = []
+        for k in np.argsort(-fields['market_value'], kind='stable').tolist():
+            p = self._describe(k)
+            if self.currency[k] != fx.BASE_CURRENCY:
+                # 价格 / 成本为计价币种，市值 / 盈亏已换算为基准币种
+                p['currency'] = self.currency[k]
+                p['fx_rate'] = float(self.fx[k])
+                if not self.fx[k]:
+                    p['price_missing'] = True
+            if price[k]:
+                p['current_price'] = price[k]
+            elif missing[k]:
+                # 明确标注取价失败，而不是静默按 0 估值
+                p['price_missing'] = True
+            for key in FIELDS:
+                if key == 'pnl_percent' and not price[k]:
+                    continue
+                p[key] = columns[key][k]
+            p['allocation_percent'] = allocation[k] if allocation is not None else 0
+            positions.append(p)
+        return positions
+
+    def account_rollup(self):
+        """data.json 的 accounts: 每个账户的市值 / 日盈亏 / 成本 / 盈亏 / 占比"""
+        total = self.market_value
+        accounts = []
+        for j, name in enumerate(self.accounts):
+            market_value = float(self.account_market_value[j])
+            cost = float(self.account_cost[j])
+            accounts.append({
+                "account": name,
+                "lots": int(self.account_lots[j]),
+                "market_value": market_value,
+                "day_pnl": float(self.account_day_pnl[j]),
+                "total_cost": cost,
+                "total_pnl": market_value - cost,
+                "allocation_percent": (market_value / total * 100) if total else 0,
+            })
+        return accounts
@@ -0,0 +1,229 @@
+"""
+运行指标 (Prometheus 文本格式)
+  - span(stage):   计时各个阶段 (下载 / 解析 / 估值 / 历史 / 写文件 / 整次刷新)
+  - inc / set_gauge: 上游请求数、缓存命中、取价失败的标的等计数
+  - 直方图同时保留累计桶 (Prometheus 语义，可用 rate()) 和最近一段时间的样本窗口，
+    窗口内的分位数以 summary 形式输出，反映"最近"的延迟而不被启动以来的历史稀释
+  - Profiler: 按需对一次刷新做 cProfile，结果写入 .cache/profiles/
+只依赖标准库，导入开销可忽略。
+"""
+import bisect
+import io
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+PREFIX = "portfolio_"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUANTILES = (0.5, 0.9, 0.99)
+# 滚动窗口: 最近 WINDOW 秒、最多 WINDOW_SAMPLES 个样本
+WINDOW = float(os.environ.get("METRICS_WINDOW", "600"))
+WINDOW_SAMPLES = 1024
+DEFAULT_PROFILE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "profiles")
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    body = ",".join('{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"')) for k, v in items)
+    return "{" + body + "}"
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS, window=WINDOW, clock=time.monotonic):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # 最后一个为 +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.window = window
+        self.clock = clock
+        self.samples = deque(maxlen=WINDOW_SAMPLES)  # (time, value)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.samples.append((self.clock(), value))
+
+    def recent(self):
+        """窗口内的样本值"""
+        cutoff = self.clock() - self.window
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+        return sorted(v for _, v in self.samples)
+
+    def quantiles(self):
+        values = self.recent()
+        if not values:
+            return {}
+        return {q: values[min(len(values) - 1, int(q * len(values)))] for q in QUANTILES}
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}        # name -> (type, help)
+        self._values = {}       # (name, labels) -> float (counter / gauge)
+        self._histograms = {}   # (name, labels) -> Histogram
+        self.last_spans = {}    # stage -> 最近一次耗时 (秒)
+
+    def _declare(self, name, kind, help_text):
+        if name not in self._types:
+            self._types[name] = (kind, help_text or name)
+
+    def inc(self, name, value=1.0, help=None, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._declare(name, "counter", help)
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def set_gauge(self, name, value, help=None, **labels):
+        with self._lock:
+            self._declare(name, "gauge", help)
+            self._values[(name, _labels(labels))] = float(value)
+
+    def observe(self, name, value, help=None, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._declare(name, "histogram", help)
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram()
+            hist.observe(value)
+
+    def value(self, name, **labels):
+        with self._lock:
+            return self._values.get((name, _labels(labels)), 0.0)
+
+    def reset(self):
+        with self._lock:
+            self._types.clear()
+            self._values.clear()
+            self._histograms.clear()
+            self.last_spans.clear()
+
+    def render(self):
+        """Prometheus 文本格式 (text/plain; version=0.0.4)"""
+        out = []
+        with self._lock:
+            for name in sorted(self._types):
+                kind, help_text = self._types[name]
+                full = PREFIX + name
+                out.append(f"# HELP {full} {help_text}")
+                out.append(f"# TYPE {full} {kind}")
+                if kind != "histogram":
+                    for (n, labels), v in sorted(self._values.items()):
+                        if n == name:
+                            out.append(f"{full}{_format_labels(labels)} {v:g}")
+                    continue
+
+                series = sorted((labels, h) for (n, labels), h in self._histograms.items() if n == name)
+                for labels, h in series:
+                    cumulative = 0
+                    for le, c in zip(list(h.buckets) + ["+Inf"], h.counts):
+                        cumulative += c
+                        le = le if isinstance(le, str) else f"{le:g}"
+                        out.append(f"{full}_bucket{_format_labels(labels, [('le', le)])} {cumulative}")
+                    out.append(f"{full}_sum{_format_labels(labels)} {h.sum:.6f}")
+                    out.append(f"{full}_count{_format_labels(labels)} {h.count}")
+
+                # 滚动窗口分位数
+                window = f"{full}_window"
+                out.append(f"# HELP {window} {help_text} (last {WINDOW:g}s)")
+                out.append(f"# TYPE {window} summary")
+                for labels, h in series:
+                    qs = h.quantiles()
+                    for q, v in qs.items():
+                        out.append(f"{window}{_format_labels(labels, [('quantile', f'{q:g}')])} {v:.6f}")
+                    out.append(f"{window}_count{_format_labels(labels)} {len(h.samples)}")
+        return "\n".join(out) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def inc(name, value=1.0, help=None, **labels):
+    REGISTRY.inc(name, value, help, **labels)
+
+
+def set_gauge(name, value, help=None, **labels):
+    REGISTRY.set_gauge(name, value, help, **labels)
+
+
+def observe(name, value, help=None, **labels):
+    REGISTRY.observe(name, value, help, **labels)
+
+
+def render():
+    return REGISTRY.render()
+
+
+@contextmanager
+def span(stage):
+    """计时一个阶段，写入 stage_duration_seconds{stage=...}；异常时额外计数"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc("stage_errors_total", help="Stages that raised", stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - t0
+        REGISTRY.last_spans[stage] = elapsed
+        observe("stage_duration_seconds", elapsed, help="Time spent per stage", stage=stage)
+
+
+class Profiler:
+    """
+    cProfile 采集: PROFILE_REFRESH=1 时每次刷新都采集，否则通过 request() 只采集下一次。
+    结果保存为 .prof 文件 (可用 snakeviz / pstats 查看)，并保留最近一次的 top 函数文本。
+    """
+
+    def __init__(self, directory=None, always=False, top=25):
+        self.directory = directory or os.environ.get("PROFILE_DIR", DEFAULT_PROFILE_DIR)
+        self.always = always
+        self.top = top
+        self.last = None            # {"path", "stats", "seconds"}
+        self._requested = threading.Event()
+
+    def request(self):
+        self._requested.set()
+
+    @contextmanager
+    def capture(self, name):
+        if not (self.always or self._requested.is_set()):
+            yield None
+            return
+        self._requested.clear()
+
+        import cProfile
+        import pstats
+
+        profile = cProfile.Profile()
+        t0 = time.perf_counter()
+        profile.enable()
+        try:
+            yield profile
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - t0
+            path = None
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(self.directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}.prof")
+                profile.dump_stats(path)
+            except OSError as e:
+                print(f"Cannot save profile: {e}")
+            buf = io.StringIO()
+            pstats.Stats(profile, stream=buf).sort_stats("cumulative").print_stats(self.top)
+            self.last = {"path": path, "stats": buf.getvalue(), "seconds": round(elapsed, 3)}
+
+
+PROFILER = Profiler(always=os.environ.get("PROFILE_REFRESH", "") in ("1", "true"))
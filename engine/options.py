@@ -0,0 +1,259 @@
+"""
+期权持仓: OCC 代码解析 + 向量化 Black-Scholes 定价与 Greeks
+  - OCC 代码: 标的 (最多 6 位，可用空格补齐) + 到期日 YYMMDD + C/P + 行权价 × 1000 (8 位)，
+    如 "TSLA  260116C00300000" 或 "TSLA260116C00300000"
+  - OptionChain: 全部合约的并行数组 (标的 / 到期时间 / 行权价 / 看涨看跌)，一次性定价，不逐个合约循环
+  - 波动率 / 利率 / 股息率来自可替换的参数源 (默认 FlatParams: 常数，可按标的覆盖)；
+    持仓配置中的 "iv" 字段优先于参数源
+Greeks 单位: delta / gamma 按每股，theta 为每个自然日的价格变化，vega 为波动率变化 1 个百分点的价格变化。
+"""
+import os
+import re
+import time
+from collections import namedtuple
+from datetime import date
+
+import numpy as np
+
+from engine.schedule import CLOSE, from_eastern
+
+try:
+    from scipy.special import ndtr as _ndtr
+except ImportError:
+    _ndtr = None
+
+# 默认参数 (可被 FlatParams / 自定义参数源覆盖)
+OPTION_VOL = float(os.environ.get("OPTION_VOL", "0.30"))
+RISK_FREE_RATE = float(os.environ.get("RISK_FREE_RATE", "0.04"))
+OPTION_MULTIPLIER = float(os.environ.get("OPTION_MULTIPLIER", "100"))
+YEAR_DAYS = 365.0
+# 到期当天收盘后 T 取这个下限 (约 1 分钟)，避免除零
+MIN_YEARS = 1.0 / (YEAR_DAYS * 24 * 60)
+
+OCC_PATTERN = re.compile(r"^([A-Z][A-Z0-9.]{0,5})\s*(\d{2})(\d{2})(\d{2})([CP])(\d{8})$")
+
+Contract = namedtuple("Contract", "underlying expiry right strike")
+
+
+def parse_occ(symbol):
+    """解析 OCC 期权代码，返回 Contract；不是期权代码时返回 None"""
+    m = OCC_PATTERN.match(symbol.strip().upper())
+    if not m:
+        return None
+    root, yy, mm, dd, right, strike = m.groups()
+    try:
+        expiry = date(2000 + int(yy), int(mm), int(dd))
+    except ValueError:
+        return None
+    return Contract(root, expiry, right, int(strike) / 1000.0)
+
+
+def is_option(symbol):
+    return parse_occ(symbol) is not None
+
+
+def norm_cdf(x):
+    """标准正态分布函数 (有 scipy 时用 ndtr；否则 Abramowitz-Stegun 26.2.17，误差 < 7.5e-8)"""
+    if _ndtr is not None:
+        return _ndtr(x)
+    x = np.asarray(x, dtype=float)
+    z = np.abs(x)
+    t = 1.0 / (1.0 + 0.2316419 * z)
+    poly = t * (0.319381530 + t * (-0.356563782 + t * (1.781477937 + t * (-1.821255978 + t * 1.330274429))))
+    tail = norm_pdf(z) * poly
+    return np.where(x >= 0, 1.0 - tail, tail)
+
+
+def norm_pdf(x):
+    return np.exp(-0.5 * x * x) / np.sqrt(2.0 * np.pi)
+
+
+def black_scholes(spot, strike, years, vol, rate, dividend, is_call):
+    """
+    向量化 Black-Scholes (带连续股息率)，所有参数为等长数组 (或可广播的标量)。
+    返回 dict: price / delta / gamma / theta (每自然日) / vega (每 1 个百分点)
+    波动率或剩余期限为 0 时按内在价值 (折现后) 处理。
+    """
+    spot, strike, years, vol, rate, dividend, is_call = np.broadcast_arrays(
+        *(np.asarray(a, dtype=float) for a in (spot, strike, years, vol, rate, dividend)),
+        np.asarray(is_call, dtype=bool))
+    sqrt_t = np.sqrt(years)
+    sig_t = vol * sqrt_t
+    live = sig_t > 1e-12
+    disc_r = np.exp(-rate * years)
+    disc_q = np.exp(-dividend * years)
+    forward = spot * disc_q
+    pv_strike = strike * disc_r
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        safe_sig = np.where(live, sig_t, 1.0)
+        d1 = (np.log(spot / strike) + (rate - dividend + 0.5 * vol * vol) * years) / safe_sig
+        d2 = d1 - safe_sig
+    sign = np.where(is_call, 1.0, -1.0)
+    nd1, nd2 = norm_cdf(sign * d1), norm_cdf(sign * d2)
+    pdf = norm_pdf(d1)
+
+    price = sign * (forward * nd1 - pv_strike * nd2)
+    delta = sign * disc_q * nd1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        gamma = np.where(live, disc_q * pdf / (spot * safe_sig), 0.0)
+        theta_year = (-forward * pdf * vol / (2.0 * np.where(live, sqrt_t, 1.0))
+                      - sign * rate * pv_strike * nd2 + sign * dividend * forward * nd1)
+    vega = forward * pdf * sqrt_t
+
+    # 没有时间价值: 内在价值 (远期口径)，delta 为 0 / ±1
+    intrinsic = np.maximum(sign * (forward - pv_strike), 0.0)
+    itm = sign * (forward - pv_strike) > 0
+    price = np.where(live, price, intrinsic)
+    delta = np.where(live, delta, np.where(itm, sign * disc_q, 0.0))
+    theta = np.where(live, theta_year, 0.0) / YEAR_DAYS
+    vega = np.where(live, vega, 0.0) / 100.0
+    bad = ~(np.isfinite(spot) & (spot > 0) & (strike > 0))
+    return {key: np.where(bad, np.nan, value) for key, value in
+            (("price", price), ("delta", delta), ("gamma", gamma), ("theta", theta), ("vega", vega))}
+
+
+class FlatParams:
+    """
+    默认参数源: 常数波动率 / 无风险利率 / 股息率，by_underlying 可按标的覆盖波动率 ({"TSLA": 0.6})。
+    自定义参数源 (如本地波动率曲面) 实现相同的三个方法即可，传给 value(params=...)。
+    """
+
+    def __init__(self, volatility=OPTION_VOL, rate=RISK_FREE_RATE, dividend=0.0, by_underlying=None):
+        self.default_vol = volatility
+        self.default_rate = rate
+        self.default_dividend = dividend
+        self.by_underlying = dict(by_underlying or {})
+
+    def volatility(self, chain, spot, years):
+        """每个合约的波动率 (chain: OptionChain，spot / years: 每个合约的标的价格和剩余年数)"""
+        return np.array([self.by_underlying.get(u, self.default_vol) for u in chain.underlying], dtype=float)
+
+    def rate(self, chain, years):
+        return np.full(len(chain), self.default_rate)
+
+    def dividend(self, chain):
+        return np.full(len(chain), self.default_dividend)
+
+
+# 进程默认参数源，可整体替换 (options.PARAMS = MySurface())
+PARAMS = FlatParams()
+
+
+def expiry_timestamp(day):
+    """到期日收盘时间 (纽约 16:00) 的 unix 秒"""
+    return from_eastern(day, CLOSE)
+
+
+_chains = {}
+
+
+def get_chain(symbols, iv=None):
+    """按 (代码, iv) 缓存的 OptionChain: 持仓不变时每次刷新只定价，不重新解析代码"""
+    iv = np.full(len(symbols), np.nan) if iv is None else np.asarray(iv, dtype=float)
+    key = (tuple(symbols), iv.tobytes())
+    chain = _chains.get(key)
+    if chain is None:
+        if len(_chains) > 8:
+            _chains.clear()
+        chain = _chains[key] = OptionChain(symbols, iv)
+    return chain
+
+
+class OptionChain:
+    """
+    symbols: OCC 代码列表 (全部须为期权)；iv: 每个合约配置的隐含波动率 (NaN 表示使用参数源)
+    """
+
+    def __init__(self, symbols, iv=None):
+        contracts = [parse_occ(s) for s in symbols]
+        if any(c is None for c in contracts):
+            bad = [s for s, c in zip(symbols, contracts) if c is None]
+            raise ValueError(f"not OCC option symbols: {bad}")
+        self.symbols = list(symbols)
+        self.underlying = [c.underlying for c in contracts]
+        self.underlyings = list(dict.fromkeys(self.underlying))
+        code = {u: i for i, u in enumerate(self.underlyings)}
+        self.underlying_code = np.array([code[u] for u in self.underlying], dtype=np.intp)
+        self.expiry = [c.expiry for c in contracts]
+        expiry_ts = {d: expiry_timestamp(d) for d in set(self.expiry)}
+        self.expiry_ts = np.array([expiry_ts[d] for d in self.expiry], dtype=float)
+        self.strike = np.array([c.strike for c in contracts], dtype=float)
+        self.is_call = np.array([c.right == "C" for c in contracts], dtype=bool)
+        self.iv = np.full(len(contracts), np.nan) if iv is None else np.asarray(iv, dtype=float)
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def years(self, now=None):
+        now = time.time() if now is None else now
+        return np.maximum((self.expiry_ts - now) / (YEAR_DAYS * 86400.0), MIN_YEARS)
+
+    def spots(self, prices):
+        """{标的: 价格} -> 每个合约的标的价格 (缺失为 NaN)"""
+        per_underlying = np.array([prices.get(u) or np.nan for u in self.underlyings], dtype=float)
+        return per_underlying[self.underlying_code]
+
+    def value(self, prices, prev_prices=None, params=None, now=None):
+        """
+        按标的现价 (和昨收) 给全部合约定价，返回 (greeks, prev_price)：
+        greeks 为 black_scholes 的结果加 "vol" / "spot"；prev_price 为昨收标的价、剩余期限多一天时的理论价 (用于日盈亏)
+        """
+        params = params or PARAMS
+        spot = self.spots(prices)
+        years = self.years(now)
+        vol = params.volatility(self, spot, years)
+        vol = np.where(np.isnan(self.iv), vol, self.iv)
+        rate, dividend = params.rate(self, years), params.dividend(self)
+        greeks = black_scholes(spot, self.strike, years, vol, rate, dividend, self.is_call)
+        greeks["vol"], greeks["spot"] = vol, spot
+        prev_price = None
+        if prev_prices is not None:
+            prev_years = years + 1.0 / YEAR_DAYS
+            prev_price = black_scholes(self.spots(prev_prices), self.strike, prev_years, vol, rate, dividend,
+                                       self.is_call)["price"]
+        return greeks, prev_price
+
+    def exposure(self, greeks, quantity, multiplier):
+        """
+        按标的汇总的 Greeks 敞口 (quantity: 合约数，multiplier: 每张合约的股数):
+        delta (等价股数) / delta_dollars / gamma (标的每变动 1 美元的 delta 变化) /
+        gamma_dollars (标的变动 1% 时 delta_dollars 的变化) / theta ($/天) / vega ($/波动率点)。
+        返回 (按标的列表, 组合合计)；股数口径的 delta / gamma 不能跨标的相加，合计只含美元口径
+        """
+        units = np.asarray(quantity, dtype=float) * np.asarray(multiplier, dtype=float)
+        spot = greeks["spot"]
+        legs = {
+            "delta": greeks["delta"] * units,
+            "delta_dollars": greeks["delta"] * units * spot,
+            "gamma": greeks["gamma"] * units,
+            "gamma_dollars": greeks["gamma"] * units * spot * spot / 100.0,
+            "theta": greeks["theta"] * units,
+            "vega": greeks["vega"] * units,
+        }
+        n = len(self.underlyings)
+        rolled = {key: np.bincount(self.underlying_code, weights=np.nan_to_num(v), minlength=n)
+                  for key, v in legs.items()}
+        by_underlying = [dict({"underlying": u}, **{key: float(rolled[key][i]) for key in legs})
+                         for i, u in enumerate(self.underlyings)]
+        totals = {key: float(v.sum()) for key, v in rolled.items() if key not in ("delta", "gamma")}
+        return by_underlying, totals
+
+    def describe(self, i, greeks):
+        """第 i 个合约的合约信息和 Greeks (写入 data.json 该持仓的 option 字段)"""
+        def num(v):
+            v = float(v)
+            return v if np.isfinite(v) else None
+
+        return {
+            "underlying": self.underlying[i],
+            "expiry": self.expiry[i].isoformat(),
+            "right": "call" if self.is_call[i] else "put",
+            "strike": float(self.strike[i]),
+            "underlying_price": num(greeks["spot"][i]),
+            "volatility": num(greeks["vol"][i]),
+            "delta": num(greeks["delta"][i]),
+            "gamma": num(greeks["gamma"][i]),
+            "theta": num(greeks["theta"][i]),
+            "vega": num(greeks["vega"][i]),
+        }
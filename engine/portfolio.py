@@ -0,0 +1,59 @@
+"""
+持仓模型 (Portfolio)
+持仓 (lot) 以并行数组保存 (symbol / 数量 / 成本 / 手动定价 / 已知现价)，原始配置 dict 只读引用、不复制。
+按标的聚合 (symbol -> 行号)、定价、估值和输出 data.json 的 positions 由 engine.lots.LotBook 负责。
+"""
+import numpy as np
+
+from engine.fx import infer_currency, position_currency
+from engine.options import OPTION_MULTIPLIER, is_option
+
+# data.json 中每个持仓的估值字段 (顺序即输出顺序)
+FIELDS = ("market_value", "total_pnl", "pnl_percent", "day_pnl", "day_pnl_percent")
+
+
+class Portfolio:
+    """
+    symbols:      代码列表 (允许重复，如同一标的多笔持仓)
+    quantity / cost_basis / manual_price: 等长数组，manual_price 为 NaN 表示没有手动定价
+    multiplier:   每单位数量对应的股数 (股票为 1，OCC 期权合约默认 100)；价格 / 成本均按每股
+    currency:     计价币种 (价格 / 成本均按该币种，估值时由 engine.fx 换算为基准币种)
+    config:       原始配置 dict 列表 (只读)，序列化时原样保留其中的字段
+    """
+
+    def __init__(self, symbols, quantity, cost_basis, manual_price=None, config=None, multiplier=None,
+                 currency=None):
+        self.symbols = list(symbols)
+        n = len(self.symbols)
+        self.quantity = np.asarray(quantity, dtype=float)
+        self.cost_basis = np.asarray(cost_basis, dtype=float)
+        self.manual_price = np.full(n, np.nan) if manual_price is None else np.asarray(manual_price, dtype=float)
+        if multiplier is None:
+            multiplier = [OPTION_MULTIPLIER if is_option(s) else 1.0 for s in self.symbols]
+        self.multiplier = np.asarray(multiplier, dtype=float)
+        self.currency = list(currency) if currency is not None else [infer_currency(s) for s in self.symbols]
+        self.config = config
+
+        # 已知现价 (0 表示无报价)，手动定价的持仓等于手动价
+        self.manual = ~np.isnan(self.manual_price)
+        self.price = np.where(self.manual, self.manual_price, 0.0)
+
+    @classmethod
+    def from_positions(cls, positions):
+        """由 manual_portfolio.POSITIONS 格式构建；已带 current_price 的条目沿用该价格"""
+        portfolio = cls(
+            [p['symbol'] for p in positions],
+            [p['quantity'] for p in positions],
+            [p.get('cost_basis', 0) for p in positions],
+            [p.get('manual_price', np.nan) for p in positions],
+            config=positions,
+            multiplier=[p.get('multiplier') or (OPTION_MULTIPLIER if is_option(p['symbol']) else 1.0)
+                        for p in positions],
+            currency=[position_currency(p) for p in positions],
+        )
+        current = np.array([p.get('current_price', 0.0) for p in positions], dtype=float)
+        portfolio.price = np.where(portfolio.manual, portfolio.price, current)
+        return portfolio
+
+    def __len__(self):
+        return len(self.symbols)
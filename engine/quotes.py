@@ -0,0 +1,436 @@
+"""
+行情数据源 (Quote Providers)
+统一的取价接口，包含:
+  - YFinanceProvider: 线上行情 (Yahoo Finance)
+  - ChartProvider:    直接请求 Yahoo chart JSON 接口，不依赖 pandas / yfinance (冷启动快)
+  - FakeProvider:     确定性的本地假行情，离线测试用
+  - CachedProvider:   进程内 TTL 缓存，按 (symbol, period) 缓存 (含上游缺失的标的)，带 LRU 淘汰
+所有后端返回 {symbol: [Bar, ...]} (按日期升序)，取不到的标的不出现在结果中。
+"""
+import json
+import math
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+
+from engine import metrics
+from engine.singleflight import SingleFlight
+
+Bar = namedtuple("Bar", ["date", "open", "high", "low", "close", "volume"])
+
+# period 字符串对应的自然日跨度 (与 yfinance 的 period 参数一致)
+PERIOD_DAYS = {
+    "1d": 1, "5d": 5, "1mo": 30, "3mo": 90, "6mo": 180,
+    "1y": 365, "2y": 730, "5y": 1826, "10y": 3652,
+}
+
+
+def last_and_prev(bars):
+    """从日线中取 (现价, 昨收)；只有一根K线时用开盘价作为昨收"""
+    if not bars:
+        return 0.0, 0.0
+    if len(bars) >= 2:
+        return float(bars[-1].close), float(bars[-2].close)
+    return float(bars[-1].close), float(bars[-1].open)
+
+
+class QuoteProvider:
+    """行情后端基类"""
+    name = "base"
+
+    @property
+    def available(self):
+        return True
+
+    def fetch(self, symbols, period="5d", start=None):
+        """
+        批量获取日线: 返回 {symbol: [Bar, ...]}
+        start (YYYY-MM-DD) 不为空时获取该日 (含) 之后的全部K线，忽略 period。
+        """
+        raise NotImplementedError
+
+    def quote(self, symbol):
+        """单标的兜底报价，返回 (现价, 昨收)，失败返回 None"""
+        bars = self.fetch([symbol], "5d").get(symbol)
+        if not bars:
+            return None
+        return last_and_prev(bars)
+
+
+class YFinanceProvider(QuoteProvider):
+    """Yahoo Finance 后端 (yfinance / pandas 在首次调用时才导入)"""
+    name = "yfinance"
+
+    @property
+    def available(self):
+        import importlib.util
+        return importlib.util.find_spec("yfinance") is not None
+
+    def fetch(self, symbols, period="5d", start=None):
+        import yfinance as yf
+
+        symbols = list(dict.fromkeys(symbols))
+        if not symbols:
+            return {}
+
+        metrics.inc("upstream_requests_total", help="Requests sent to the quote backend", provider=self.name, kind="download")
+        metrics.inc("upstream_symbols_total", len(symbols), help="Symbols requested from the quote backend", provider=self.name)
+        with metrics.span("yfinance.download"):
+            if start:
+                hist = yf.download(symbols, start=start, progress=False, group_by='ticker')
+            else:
+                hist = yf.download(symbols, period=period, progress=False, group_by='ticker')
+
+        with metrics.span("yfinance.parse"):
+            return self._parse(hist, symbols)
+
+    @staticmethod
+    def _parse(hist, symbols):
+        """DataFrame -> {symbol: [Bar, ...]}"""
+        import pandas as pd
+
+        result = {}
+        for sym in symbols:
+            try:
+                # 单标的 / 多标的返回结构不同，需要判断
+                if isinstance(hist.columns, pd.MultiIndex):
+                    if sym not in hist.columns.levels[0]:
+                        continue
+                    df = hist[sym]
+                elif len(symbols) == 1:
+                    df = hist
+                else:
+                    continue
+
+                df = df.dropna()
+                if df.empty:
+                    continue
+
+                result[sym] = [
+                    Bar(dt.strftime("%Y-%m-%d"), float(o), float(h), float(l), float(c), float(v))
+                    for dt, o, h, l, c, v in zip(
+                        df.index, df['Open'], df['High'], df['Low'], df['Close'], df['Volume'])
+                ]
+            except Exception as e:
+                print(f"Error parse hist for {sym}: {e}")
+        return result
+
+    def quote(self, symbol):
+        import yfinance as yf
+        metrics.inc("upstream_requests_total", help="Requests sent to the quote backend", provider=self.name, kind="quote")
+        try:
+            info = yf.Ticker(symbol).fast_info
+            last = getattr(info, 'last_price', None)
+            prev = getattr(info, 'previous_close', None)
+        except Exception:
+            return None
+        if not last:
+            return None
+        return float(last), float(prev or 0.0)
+
+
+class ChartProvider(QuoteProvider):
+    """
+    Yahoo chart 接口 (v8/finance/chart)，每个标的一个 HTTP 请求，并发执行。
+    只用标准库 (urllib + json)，适合 Serverless 冷启动: 省去导入 pandas / yfinance 的时间。
+    """
+    name = "chart"
+    URL = "https://query1.finance.yahoo.com/v8/finance/chart/{symbol}"
+
+    def __init__(self, workers=8, timeout=10.0):
+        self.workers = workers
+        self.timeout = timeout
+
+    def _request(self, symbol, period, start):
+        import urllib.parse
+        import urllib.request
+
+        if start:
+            since = datetime.combine(date.fromisoformat(start), datetime.min.time(), timezone.utc)
+            params = {"period1": int(since.timestamp()), "period2": int(time.time()), "interval": "1d"}
+        else:
+            params = {"range": period, "interval": "1d"}
+        url = self.URL.format(symbol=urllib.parse.quote(symbol)) + "?" + urllib.parse.urlencode(params)
+        # 默认的 Python UA 会被 Yahoo 拒绝
+        req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            return json.loads(resp.read())
+
+    @staticmethod
+    def parse(payload):
+        """chart JSON -> [Bar, ...]，日期按交易所时区换算，缺失收盘价的K线跳过"""
+        result = (payload.get("chart") or {}).get("result") or []
+        if not result:
+            return []
+        chart = result[0]
+        offset = (chart.get("meta") or {}).get("gmtoffset") or 0
+        quote = ((chart.get("indicators") or {}).get("quote") or [{}])[0]
+        timestamps = chart.get("timestamp") or []
+        # 各列与 timestamp 等长，停牌等情况下对应位置为 null
+        columns = {k: (quote.get(k) or []) + [None] * len(timestamps) for k in ("open", "high", "low", "close", "volume")}
+        bars = []
+        for i, ts in enumerate(timestamps):
+            close = columns["close"][i]
+            if close is None:
+                continue
+            day = datetime.fromtimestamp(ts + offset, timezone.utc).strftime("%Y-%m-%d")
+            bar = Bar(day, float(columns["open"][i] or close), float(columns["high"][i] or close),
+                      float(columns["low"][i] or close), float(close), float(columns["volume"][i] or 0.0))
+            # 盘中请求时最后一根可能与前一根同日 (实时价)，以后者为准
+            if bars and bars[-1].date == day:
+                bars[-1] = bar
+            else:
+                bars.append(bar)
+        return bars
+
+    def _fetch_one(self, symbol, period, start):
+        try:
+            return symbol, self.parse(self._request(symbol, period, start))
+        except Exception as e:
+            print(f"Chart request failed for {symbol}: {e}")
+            return symbol, []
+
+    def fetch(self, symbols, period="5d", start=None):
+        symbols = list(dict.fromkeys(symbols))
+        if not symbols:
+            return {}
+        metrics.inc("upstream_requests_total", len(symbols), help="Requests sent to the quote backend", provider=self.name, kind="download")
+        metrics.inc("upstream_symbols_total", len(symbols), help="Symbols requested from the quote backend", provider=self.name)
+        with metrics.span("chart.download"):
+            with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(symbols)))) as pool:
+                fetched = list(pool.map(lambda s: self._fetch_one(s, period, start), symbols))
+        return {sym: bars for sym, bars in fetched if bars}
+
+
+class FakeProvider(QuoteProvider):
+    """
+    确定性的本地假行情 (不联网)
+    价格只由 (symbol, 日期) 决定，与请求的 period 无关，因此不同窗口的结果可以互相对齐。
+    """
+    name = "fake"
+
+    def __init__(self, end=None, missing=(), latency=0.0):
+        self.end = end                  # 最后一个交易日 (默认今天)
+        self.missing = set(missing)     # 模拟取不到数据的标的
+        self.latency = latency          # 模拟网络延迟 (秒/次)
+        self.calls = 0                  # 上游调用次数，用于验证缓存效果
+
+    @staticmethod
+    def price_at(symbol, day):
+        """(symbol, 日期) -> 收盘价，闭式计算，无需逐日累积"""
+        seed = zlib.crc32(symbol.encode("utf-8"))
+        base = 20.0 + seed % 480
+        phase = (seed >> 9) % 628 / 100.0
+        t = day.toordinal()
+        noise = (zlib.crc32(f"{symbol}:{t}".encode("utf-8")) % 2001 - 1000) / 100000.0
+        return round(base * (1 + 0.25 * math.sin(t / 37.0 + phase)
+                             + 0.05 * math.sin(t / 5.3 + 2 * phase) + noise), 4)
+
+    def trading_days(self, period, start=None):
+        end = self.end or date.today()
+        if start:
+            span = (end - date.fromisoformat(start)).days + 1
+        else:
+            span = PERIOD_DAYS.get(period, 30)
+        days = []
+        for i in range(span - 1, -1, -1):
+            d = end - timedelta(days=i)
+            if d.weekday() < 5:
+                days.append(d)
+        return days
+
+    def fetch(self, symbols, period="5d", start=None):
+        self.calls += 1
+        metrics.inc("upstream_requests_total", help="Requests sent to the quote backend", provider=self.name, kind="download")
+        metrics.inc("upstream_symbols_total", len(symbols), help="Symbols requested from the quote backend", provider=self.name)
+        if self.latency:
+            time.sleep(self.latency)
+
+        days = self.trading_days(period, start)
+        result = {}
+        for sym in dict.fromkeys(symbols):
+            # 与 Yahoo 一致: 带空格的 (期权等) 代码查不到
+            if sym in self.missing or ' ' in sym:
+                continue
+            bars = []
+            for d in days:
+                close = self.price_at(sym, d)
+                prev = self.price_at(sym, d - timedelta(days=1))
+                hi, lo = max(prev, close), min(prev, close)
+                bars.append(Bar(d.strftime("%Y-%m-%d"), prev, hi, lo, close, 1000000.0))
+            result[sym] = bars
+        return result
+
+
+class CachedProvider(QuoteProvider):
+    """
+    进程内 TTL 缓存
+    键为 (symbol, period)：同一 TTL 窗口内无论多少客户端请求，同一标的只向上游请求一次。
+    上游结果中缺失的标的同样缓存 (空列表)，TTL 内不再重复请求 (兜底重试的 quote() 不经过缓存)。
+    并发未命中按 (标的集合, 窗口) 合并 (SingleFlight)：相同请求只下载一次，不同请求互不阻塞。
+    容量: max_entries 与各窗口最近一次请求的标的数之和取大，一次刷新的全部标的不会被自身淘汰。
+    """
+
+    def __init__(self, backend, ttl=60.0, max_entries=2048, clock=time.monotonic):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries = OrderedDict()   # (symbol, period) -> (expires_at, bars)
+        self._demand = {}               # 窗口 -> 最近一次请求的标的数 (决定容量)
+        self._flights = {}              # (frozenset(标的), 窗口) -> SingleFlight
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def name(self):
+        return f"cached:{self.backend.name}"
+
+    @property
+    def available(self):
+        return self.backend.available
+
+    @property
+    def capacity(self):
+        return max(self.max_entries, sum(self._demand.values()))
+
+    def _lookup(self, symbols, window, result):
+        """从缓存读取，返回未命中的标的列表"""
+        now = self.clock()
+        missing = []
+        with self._lock:
+            for sym in symbols:
+                if sym in result:
+                    continue
+                key = (sym, window)
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(key)
+                    result[sym] = entry[1]
+                else:
+                    missing.append(sym)
+        return missing
+
+    def _store(self, symbols, fetched, window):
+        """写入本次请求的全部标的；上游没有返回的记为空列表"""
+        expires = self.clock() + self.ttl
+        with self._lock:
+            for sym in symbols:
+                key = (sym, window)
+                self._entries[key] = (expires, fetched.get(sym) or [])
+                self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        """先清理过期条目，再按 LRU 淘汰到容量上限 (调用方持有 _lock)"""
+        now = self.clock()
+        for key in [k for k, (exp, _) in self._entries.items() if exp <= now]:
+            del self._entries[key]
+        # 已没有条目的窗口 (如过期的 since:日期) 不再计入容量
+        live = {window for _, window in self._entries}
+        for window in [w for w in self._demand if w not in live]:
+            del self._demand[window]
+        capacity = self.capacity
+        while len(self._entries) > capacity:
+            self._entries.popitem(last=False)
+
+    def _download(self, symbols, period, start, window):
+        """SingleFlight 的执行者: 再查一次缓存 (其他请求可能刚取回)，只下载仍缺失的标的"""
+        result = {}
+        missing = self._lookup(symbols, window, result)
+        self._count_hits(len(symbols) - len(missing))
+        if missing:
+            self.misses += len(missing)
+            metrics.inc("quote_cache_total", len(missing), help="Quote cache lookups", result="miss")
+            fetched = self.backend.fetch(missing, period, start)
+            self._store(missing, fetched, window)
+            result.update((sym, fetched.get(sym) or []) for sym in missing)
+        return result
+
+    def fetch(self, symbols, period="5d", start=None):
+        symbols = list(dict.fromkeys(symbols))
+        # start 不为空时以起始日作为窗口键
+        window = f"since:{start}" if start else period
+        with self._lock:
+            self._demand[window] = len(symbols)
+        result = {}
+        missing = self._lookup(symbols, window, result)
+        self._count_hits(len(symbols) - len(missing))
+        if missing:
+            result.update(self._coalesced(missing, period, start, window))
+        # 与其他后端一致: 取不到的标的不出现在结果中
+        return {sym: bars for sym, bars in result.items() if bars}
+
+    def _coalesced(self, missing, period, start, window):
+        """相同 (标的集合, 窗口) 的并发未命中只下载一次，其余调用者共享结果"""
+        key = (frozenset(missing), window)
+        with self._lock:
+            flight = self._flights.setdefault(key, SingleFlight())
+        try:
+            fetched, _ = flight.do(self._download, missing, period, start, window)
+        finally:
+            with self._lock:
+                if not flight.in_flight and self._flights.get(key) is flight:
+                    del self._flights[key]
+        return fetched
+
+    @property
+    def size(self):
+        return len(self._entries)
+
+    def _count_hits(self, n):
+        if n:
+            self.hits += n
+            metrics.inc("quote_cache_total", n, help="Quote cache lookups", result="hit")
+
+    def quote(self, symbol):
+        return self.backend.quote(symbol)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def make_backend(name=None):
+    """按名称创建后端: yfinance (默认) / chart / fake"""
+    name = name or os.environ.get("QUOTE_PROVIDER", "yfinance")
+    if name == "fake":
+        return FakeProvider()
+    if name == "chart":
+        return ChartProvider()
+    return YFinanceProvider()
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_provider():
+    """
+    进程级共享的行情源: TTL 缓存 -> 本地行情库 (增量更新) -> 上游后端。
+    TTL 由 QUOTE_TTL 环境变量控制 (默认 60 秒)；本地库不可用时直接访问上游。
+    """
+    global _default
+    with _default_lock:
+        if _default is None:
+            from engine.store import StoredProvider, open_store
+
+            backend = make_backend()
+            store = open_store()
+            if store is not None:
+                backend = StoredProvider(backend, store)
+            ttl = float(os.environ.get("QUOTE_TTL", "60"))
+            _default = CachedProvider(backend, ttl=ttl)
+        return _default
+
+
+def set_provider(provider):
+    """替换默认行情源 (测试 / 基准时注入 FakeProvider)"""
+    global _default
+    with _default_lock:
+        _default = provider
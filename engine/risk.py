@@ -0,0 +1,314 @@
+"""
+风险指标: 组合与各持仓相对基准 (SPY) 的 beta、滚动波动率、最大回撤、持仓间相关系数矩阵
+价格来自行情源 (默认经本地行情库增量同步)，对齐为 dates × (持仓, 基准) 的价格水平矩阵后转成日收益率；
+组合净值由价格 × 当前数量 + 现金得到。
+  - RollingStats: 最近 window 个收益率的 Σx 与 Σx·xᵀ，每根新K线加入一行、移出最旧一行，
+    与窗口长度无关 (全部标的一次外积，向量化)；协方差 / beta / 相关系数都由这两个和导出
+  - Drawdown: 各列的历史高点和最大回撤，同样逐行 O(1) 更新
+  - RiskModel: 只喂入上次之后新增的K线；最后一根 (当天，未收盘仍会变化) 只参与计算、不写入状态
+  - compute: 模型已有状态时只向行情源请求上次写入日期之后的K线 (start=)；组合净值按当前汇率 / 现金在报告时计算
+"""
+import os
+
+import numpy as np
+
+from engine import valuation
+from engine.options import is_option
+
+BENCHMARK = os.environ.get("RISK_BENCHMARK", "SPY")
+# 波动率 / beta / 相关系数使用最近 RISK_WINDOW 个交易日的收益率；最大回撤覆盖 RISK_PERIOD 以来的全部K线
+RISK_WINDOW = int(os.environ.get("RISK_WINDOW", "60"))
+RISK_PERIOD = os.environ.get("RISK_PERIOD", "1y")
+TRADING_DAYS = 252
+# 批量喂入超过这个行数时直接用矩阵乘法重建窗口和 (首次加载)
+BULK_ROWS = 8
+
+
+class RollingStats:
+    """k 列收益率的滑动窗口 (环形缓冲) 及其一阶 / 二阶和"""
+
+    def __init__(self, k, window):
+        self.window = window
+        self.buffer = np.zeros((window, k))
+        self.n = 0                  # 窗口内的行数
+        self.pos = 0                # 下一行写入的位置
+        self.s1 = np.zeros(k)
+        self.s2 = np.zeros((k, k))
+        self.pushes = 0
+
+    def rows(self):
+        """窗口内的行 (按时间顺序)"""
+        if self.n < self.window:
+            return self.buffer[:self.n]
+        return np.roll(self.buffer, -self.pos, axis=0)
+
+    def push(self, x):
+        if self.n == self.window:
+            # 加入 x、移出最旧一行: 一次秩 2 更新 [x, old]ᵀ·[x, -old]
+            old = self.buffer[self.pos].copy()
+            self.s1 += x - old
+            self.s2 += np.stack([x, old]).T @ np.stack([x, -old])
+        else:
+            self.n += 1
+            self.s1 += x
+            self.s2 += np.outer(x, x)
+        self.buffer[self.pos] = x
+        self.pos = (self.pos + 1) % self.window
+        self.pushes += 1
+        # 每滑过一整个窗口重算一次和，消除加减累积的浮点误差
+        if self.pushes % self.window == 0:
+            self._resync()
+
+    def extend(self, rows):
+        if len(rows) < BULK_ROWS:
+            for x in rows:
+                self.push(x)
+            return
+        rows = np.concatenate([self.rows(), rows])[-self.window:]
+        self.n = len(rows)
+        self.buffer[:self.n] = rows
+        self.pos = self.n % self.window
+        self.pushes += len(rows)
+        self._resync()
+
+    def _resync(self):
+        rows = self.rows()
+        self.s1 = rows.sum(axis=0)
+        self.s2 = rows.T @ rows
+
+    def covariance(self, extra=None):
+        """(均值, 协方差矩阵, 样本数)；extra 为临时加入窗口的一行 (不改变状态)，样本不足 2 个时返回 None"""
+        n, s1 = self.n, self.s1
+        # 低秩修正合并为一次矩阵乘法: s2 + Σ uᵢ·vᵢᵀ - n·mean·meanᵀ
+        u, v = [], []
+        if extra is not None:
+            s1 = s1 + extra
+            u.append(extra)
+            v.append(extra)
+            if n == self.window:
+                old = self.buffer[self.pos]
+                s1 = s1 - old
+                u.append(old)
+                v.append(-old)
+            else:
+                n += 1
+        if n < 2:
+            return None
+        mean = s1 / n
+        u.append(mean)
+        v.append(-n * mean)
+        cov = (self.s2 + np.stack(u).T @ np.stack(v)) / (n - 1)
+        return mean, cov, n
+
+
+class Drawdown:
+    """各列的历史高点与最大回撤 (负数)"""
+
+    def __init__(self, k):
+        self.peak = np.full(k, np.nan)
+        self.worst = np.zeros(k)
+
+    @staticmethod
+    def _drawdown(levels, peak):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(peak > 0, levels / peak - 1.0, 0.0)
+
+    def extend(self, rows):
+        if not len(rows):
+            return
+        peaks = np.fmax.accumulate(np.vstack([self.peak, rows]), axis=0)[1:]
+        self.worst = np.minimum(self.worst, self._drawdown(rows, peaks).min(axis=0))
+        self.peak = peaks[-1]
+
+    def current(self, levels):
+        """(当前回撤, 最大回撤)，levels 临时计入 (不改变状态)"""
+        peak = np.fmax(self.peak, levels)
+        drawdown = self._drawdown(levels, peak)
+        return drawdown, np.minimum(self.worst, drawdown)
+
+
+def returns(levels, previous):
+    """逐列日收益率；前一日水平为 0 / NaN 时记为 0"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = levels / previous - 1.0
+    return np.where(np.isfinite(r), r, 0.0)
+
+
+class RiskModel:
+    """
+    key:     持仓结构 (标的 / 数量 / 手动定价 / 窗口 / 基准)，变化时调用方重建模型
+    columns: 各持仓 + 基准；滚动统计和回撤只针对这些价格列 (与数量、汇率、现金无关)
+    组合净值随汇率 / 期权市值 / 现金变化，不进入状态: 已收盘的价格行缓存在 levels 中，
+    报告时按当前的换算数量和常数项一次矩阵-向量乘法得到净值序列
+    """
+
+    def __init__(self, key, columns, window=RISK_WINDOW):
+        self.key = key
+        self.columns = columns
+        self.stats = RollingStats(len(columns), window)
+        self.drawdown = Drawdown(len(columns))
+        self.levels = np.zeros((0, len(columns)))
+        self.first_date = None
+        self.last_date = None
+        self.last_levels = None
+
+    def feed(self, dates, levels):
+        """按时间顺序写入已收盘的K线 (价格水平，每行对应 columns)"""
+        if not len(dates):
+            return
+        self.levels = np.vstack([self.levels, levels])
+        if self.last_levels is None:
+            self.first_date, self.last_levels = dates[0], levels[0]
+            self.drawdown.extend(levels[:1])
+            dates, levels = dates[1:], levels[1:]
+            if not len(dates):
+                self.last_date = self.first_date
+                return
+        previous = np.vstack([self.last_levels, levels[:-1]])
+        self.stats.extend(returns(levels, previous))
+        self.drawdown.extend(levels)
+        self.last_date, self.last_levels = dates[-1], levels[-1]
+
+    def portfolio(self, levels, units, constant):
+        """
+        组合净值 (已收盘的K线 + 当前这根，持仓价格 × units + constant) 的
+        (收益率, 基准收益率, 当前回撤, 最大回撤)；收益率只取最近 window 个，与滚动统计一致
+        """
+        rows = np.vstack([self.levels, levels])
+        nav = valuation.history_values(rows[:, :-1], units, constant)
+        bench = rows[:, -1]
+        r = returns(nav[1:], nav[:-1])[-self.stats.window:]
+        rb = returns(bench[1:], bench[:-1])[-self.stats.window:]
+        peak = np.fmax.accumulate(nav)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            drawdown = np.where(peak > 0, nav / peak - 1.0, 0.0)
+        return r, rb, drawdown[-1], drawdown.min()
+
+    def report(self, date, levels, units, constant=0.0):
+        """
+        最新一根K线 (date, levels) 临时计入后的指标。
+        units: 各持仓换算为基准币种的数量 (数量 × 汇率)，constant: 计入净值的常数 (现金 + 期权市值)
+        返回 {"portfolio", "benchmark", "positions", "correlation"}，无法计算的值为 None
+        """
+        extra = None if self.last_levels is None else returns(levels, self.last_levels)
+        moments = self.stats.covariance(extra)
+        drawdown, worst = self.drawdown.current(levels)
+        k = len(self.columns)
+        if moments is None:
+            cov, n = np.full((k, k), np.nan), self.stats.n
+        else:
+            _, cov, n = moments
+        var = np.diag(cov).copy()
+        std = np.sqrt(np.maximum(var, 0.0))
+        bench = k - 1
+        with np.errstate(divide="ignore", invalid="ignore"):
+            beta = cov[:, bench] / var[bench]
+            corr = cov / np.outer(std, std)
+        vol = std * np.sqrt(TRADING_DAYS)
+
+        def metrics_of(j):
+            return {
+                "beta": _num(beta[j]),
+                "volatility": _num(vol[j]),
+                "correlation_to_benchmark": _num(corr[j, bench]),
+                "max_drawdown": _num(worst[j]),
+                "drawdown": _num(drawdown[j]),
+            }
+
+        market_value = units * levels[:-1]
+        total = market_value.sum()
+        weights = market_value / total if total else np.zeros(k - 1)
+        positions = []
+        for j, sym in enumerate(self.columns[:-1]):
+            item = {"symbol": sym, "weight": _num(weights[j])}
+            item.update(metrics_of(j))
+            positions.append(item)
+
+        # 组合: 按当前的换算数量和常数项重建净值序列
+        r, rb, p_drawdown, p_worst = self.portfolio(levels, units, constant)
+        p_beta = p_vol = p_corr = np.nan
+        if len(r) >= 2:
+            c = np.cov(r, rb)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                p_beta = c[0, 1] / c[1, 1]
+                p_corr = c[0, 1] / np.sqrt(c[0, 0] * c[1, 1])
+            p_vol = np.sqrt(max(c[0, 0], 0.0) * TRADING_DAYS)
+        s = k - 1
+        return {
+            "as_of": date,
+            "since": self.first_date,
+            "window": self.stats.window,
+            "observations": n,
+            "portfolio": {
+                "beta": _num(p_beta),
+                "volatility": _num(p_vol),
+                "correlation_to_benchmark": _num(p_corr),
+                "max_drawdown": _num(p_worst),
+                "drawdown": _num(p_drawdown),
+            },
+            "benchmark": dict(metrics_of(bench), symbol=self.columns[-1]),
+            "positions": positions,
+            "correlation": {
+                "symbols": list(self.columns[:s]),
+                "matrix": [[_num(v) for v in row] for row in corr[:s, :s]],
+            },
+        }
+
+
+def _num(value):
+    """NaN / inf -> None (JSON null)"""
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+
+def compute(positions, cash, provider, model=None, period=RISK_PERIOD, window=RISK_WINDOW, benchmark=BENCHMARK):
+    """
+    positions: 快照中的持仓 (symbol / quantity / current_price / 可选 manual_price / fx_rate)，cash: 现金。
+    返回 (model, report)；把返回的 model 传给下一次调用，只处理新增的K线。
+    期权没有价格历史，不单独计算指标，其当前市值按常数并入组合净值 (与现金相同)。
+    模型只按持仓结构重建: 价格 / 汇率 / 期权市值变化只影响报告时的净值，仍走增量路径。
+    """
+    held_options = [p for p in positions if is_option(p["symbol"])]
+    constant = float(cash)
+    if held_options:
+        constant += sum(p.get("market_value") or 0.0 for p in held_options)
+        positions = [p for p in positions if not is_option(p["symbol"])]
+    symbols = [p["symbol"] for p in positions]
+    quantity = np.array([float(p.get("quantity", 0.0)) for p in positions])
+    # 非基准币种的持仓按快照的汇率换算 (fx_rate)，净值为基准币种
+    units = quantity * np.array([p.get("fx_rate", 1.0) for p in positions], dtype=float)
+    current = np.array([float(p.get("current_price") or np.nan) for p in positions])
+    manual = np.array([float(p["manual_price"]) if p.get("manual_price") is not None else np.nan
+                       for p in positions])
+
+    # 1. 行情: 手动定价的标的不请求，整列使用手动价
+    key = (tuple(symbols), quantity.tobytes(), manual.tobytes(), window, benchmark)
+    fetch_symbols = list(dict.fromkeys([s for s, m in zip(symbols, manual) if np.isnan(m)] + [benchmark]))
+    columns = symbols + [benchmark]
+    overrides = np.append(manual, np.nan)
+    dates = None
+    if model is not None and model.key == key and model.last_date is not None:
+        # 增量: 结构不变时只取上次写入日期 (含) 之后的K线，缺失值从上次的水平前向填充
+        bars = provider.fetch(fetch_symbols, period, start=model.last_date)
+        matrix = valuation.PriceMatrix.from_bars(bars, columns)
+        if len(matrix.dates) > 1 and matrix.dates[0] == model.last_date:
+            levels = valuation.forward_fill(np.vstack([model.last_levels, matrix.values[1:]]))[1:]
+            manual_cols = ~np.isnan(overrides)
+            levels[:, manual_cols] = overrides[manual_cols]
+            dates = matrix.dates[1:]
+    if dates is None:
+        # 首次 / 结构变化 / 上次的日期已不在行情中: 取整个 period 重建模型
+        bars = provider.fetch(fetch_symbols, period)
+        matrix = valuation.PriceMatrix.from_bars(bars, columns)
+        levels = matrix.filled(np.append(np.where(current > 0, current, np.nan), np.nan), overrides)
+        # 基准 (或全部行情) 开始之前的日期没有可比的收益率
+        keep = ~np.isnan(levels).any(axis=1)
+        dates = [d for d, k in zip(matrix.dates, keep) if k]
+        levels = levels[keep]
+        if not dates:
+            return model, {"error": f"no price history for {benchmark}"}
+        model = RiskModel(key, columns, window)
+
+    # 2. 写入已收盘的K线 (价格水平: 各持仓 | 基准)；最后一根 (当天，未收盘仍会变化) 只参与本次报告
+    model.feed(dates[:-1], levels[:-1])
+    return model, model.report(dates[-1], levels[-1], units, constant)
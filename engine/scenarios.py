@@ -0,0 +1,381 @@
+"""
+情景分析: 蒙特卡洛模拟 + 自定义冲击 (压力测试)
+以当前快照的持仓 / 现金为基准:
+  - 因子为持仓标的及期权的标的，最近 SCENARIO_PERIOD 的日对数收益率估计协方差 (Cholesky 分解)
+  - 蒙特卡洛: 按 horizon 个交易日缩放协方差，生成多元正态对数收益；正股按市值线性计盈亏，
+    期权按模拟的标的价格和剩余期限用 Black-Scholes 全量重新定价 (不是 delta 近似)
+  - 路径分块 (每块 CHUNK_PATHS 条) 并行交给进程池，每块独立的随机数流 (SeedSequence.spawn)，
+    结果与块的执行顺序无关；单进程或进程池不可用时在当前进程内依次计算
+  - 压力测试: "NVDA:-20,QQQ:-10" (百分比)，propagate 时未指定的标的按协方差取条件期望联动
+手动定价 / 没有价格历史的持仓视为常数 (不参与模拟)。
+"""
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from engine import metrics, options, valuation
+
+# 协方差估计使用的行情区间
+SCENARIO_PERIOD = os.environ.get("SCENARIO_PERIOD", "1y")
+DEFAULT_PATHS = int(os.environ.get("SCENARIO_PATHS", "100000"))
+MAX_PATHS = int(os.environ.get("SCENARIO_MAX_PATHS", "1000000"))
+# 进程池大小 (默认 CPU 数)；0 / 1 表示在当前进程内计算
+WORKERS = int(os.environ.get("SCENARIO_WORKERS", str(os.cpu_count() or 1)))
+# 每块路径数: 50000 × 20 个因子的收益矩阵约 8MB
+CHUNK_PATHS = 50000
+MAX_HORIZON = 252
+TRADING_DAYS = 252
+HISTOGRAM_BINS = 50
+PERCENTILES = (1, 5, 10, 25, 50, 75, 90, 95, 99)
+DEFAULT_CONFIDENCE = (0.95, 0.99)
+# 同一快照版本缓存的参数组合数
+CACHE_SIZE = 16
+
+_pool = None
+_pool_size = 0
+
+
+def parse_shocks(text):
+    """
+    "NVDA:-20,QQQ:-10" / "NVDA=-20%" -> {"NVDA": -0.2, "QQQ": -0.1}
+    冲击为百分比 (价格变动)，不能低于 -100
+    """
+    shocks = {}
+    for item in (text or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        sep = ":" if ":" in item else "="
+        if sep not in item:
+            raise ValueError(f"invalid shock: {item}")
+        symbol, value = item.split(sep, 1)
+        try:
+            pct = float(value.strip().rstrip("%"))
+        except ValueError:
+            raise ValueError(f"invalid shock: {item}") from None
+        if pct <= -100:
+            raise ValueError(f"shock below -100%: {item}")
+        shocks[symbol.strip().upper()] = pct / 100.0
+    return shocks
+
+
+def parse_confidence(text):
+    """"0.95,0.99" 或 "95,99" -> (0.95, 0.99)"""
+    if not text:
+        return DEFAULT_CONFIDENCE
+    levels = []
+    for item in text.split(","):
+        c = float(item)
+        c = c / 100.0 if c > 1 else c
+        if not 0.5 <= c < 1:
+            raise ValueError(f"invalid confidence: {item}")
+        levels.append(c)
+    return tuple(sorted(set(levels)))
+
+
+def parse_params(query):
+    """
+    /api/scenarios 的查询参数 (parse_qs 结果) -> (paths, horizon, confidence, seed, shocks, propagate)
+    paths (默认 SCENARIO_PATHS，上限 SCENARIO_MAX_PATHS) / horizon (交易日) / confidence / seed /
+    shock ("NVDA:-20,QQQ:-10") / propagate (1 时未指定的标的按相关性联动)
+    """
+    def get(name, default=None):
+        return query.get(name, [default])[0]
+
+    try:
+        paths = int(get("paths") or DEFAULT_PATHS)
+        horizon = int(get("horizon") or 1)
+        seed = int(get("seed")) if get("seed") else None
+    except ValueError as e:
+        raise ValueError(f"invalid parameter: {e}") from None
+    if not 1 <= paths <= MAX_PATHS:
+        raise ValueError(f"paths must be between 1 and {MAX_PATHS}")
+    if not 1 <= horizon <= MAX_HORIZON:
+        raise ValueError(f"horizon must be between 1 and {MAX_HORIZON} trading days")
+    propagate = (get("propagate") or "0").lower() in ("1", "true", "yes", "on")
+    return paths, horizon, parse_confidence(get("confidence")), seed, parse_shocks(get("shock")), propagate
+
+
+def _cholesky(cov):
+    """协方差的 Cholesky 因子；样本不足导致非正定时把负特征值截断为 0"""
+    try:
+        return np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        w, v = np.linalg.eigh(cov)
+        return v * np.sqrt(np.maximum(w, 0.0))
+
+
+class ScenarioModel:
+    """
+    positions: 快照中的持仓 (symbol / market_value / 期权的 multiplier + option)，cash: 现金。
+    构建时请求一次行情估计协方差；之后的模拟 / 压力测试都只用内存中的数组。
+    """
+
+    def __init__(self, positions, cash, provider, period=SCENARIO_PERIOD):
+        self.cash = float(cash)
+        self.symbols = [p["symbol"] for p in positions]
+        self.value = np.array([float(p.get("market_value") or 0.0) for p in positions])
+        self.total_value = float(self.value.sum()) + self.cash
+        stock_rows = [i for i, p in enumerate(positions) if "option" not in p and p.get("manual_price") is None]
+        option_rows = [i for i, p in enumerate(positions) if "option" in p and p.get("current_price")]
+
+        # 1. 因子: 正股持仓 + 期权标的
+        factors = [self.symbols[i] for i in stock_rows]
+        factors += [positions[i]["option"]["underlying"] for i in option_rows]
+        factors = list(dict.fromkeys(s for s in factors if ' ' not in s))
+
+        # 2. 日对数收益率 -> 协方差；没有历史的因子方差为 0 (视为常数)
+        cov = np.zeros((len(factors), len(factors)))
+        self.observations = 0
+        if factors:
+            bars = provider.fetch(factors, period)
+            matrix = valuation.PriceMatrix.from_bars(bars, factors)
+            has_history = ~np.isnan(matrix.values).all(axis=0) if len(matrix.dates) else np.zeros(len(factors), bool)
+            cols = np.flatnonzero(has_history)
+            if len(cols):
+                prices = matrix.values[:, cols]
+                prices = prices[~np.isnan(prices).any(axis=1)]
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    log_returns = np.diff(np.log(prices), axis=0)
+                log_returns = log_returns[np.isfinite(log_returns).all(axis=1)]
+                self.observations = len(log_returns)
+                if self.observations >= 2:
+                    cov[np.ix_(cols, cols)] = np.cov(log_returns, rowvar=False).reshape(len(cols), len(cols))
+        self.factors = factors
+        self.cov = cov
+        self.chol = _cholesky(cov) if factors else np.zeros((0, 0))
+        factor_index = {s: j for j, s in enumerate(factors)}
+
+        # 3. 正股: 按因子汇总市值 (同一标的多行合并)；其余 (手动定价 / 无历史) 为常数
+        self.stock_value = np.zeros(len(factors))
+        self.stock_rows = [i for i in stock_rows if self.symbols[i] in factor_index]
+        self.stock_factor = np.array([factor_index[self.symbols[i]] for i in self.stock_rows], dtype=np.intp)
+        np.add.at(self.stock_value, self.stock_factor, self.value[self.stock_rows])
+
+        # 4. 期权: 合约参数的并行数组 (波动率取快照定价时使用的值)
+        self.option_rows = [i for i in option_rows if positions[i]["option"]["underlying"] in factor_index]
+        chosen = [positions[i] for i in self.option_rows]
+        self.chain = None
+        if chosen:
+            self.chain = options.get_chain([p["symbol"] for p in chosen],
+                                           [p["option"].get("volatility") or np.nan for p in chosen])
+            self.option_factor = np.array([factor_index[p["option"]["underlying"]] for p in chosen], dtype=np.intp)
+            self.option_units = np.array([float(p["quantity"]) * float(p.get("multiplier", 1)) * p.get("fx_rate", 1.0)
+                                          for p in chosen])
+            self.option_price = np.array([float(p["current_price"]) for p in chosen])
+            self.option_spot = np.array([float(p["option"]["underlying_price"] or np.nan) for p in chosen])
+            self.option_vol = np.array([float(p["option"].get("volatility") or options.OPTION_VOL) for p in chosen])
+
+    def _option_args(self, horizon_days):
+        """期权重新定价所需的数组 (传给工作进程，不传 OptionChain 对象)"""
+        if self.chain is None:
+            return None
+        params = options.PARAMS
+        years = self.chain.years()
+        # 交易日换算为自然日
+        elapsed = horizon_days / TRADING_DAYS
+        return {
+            "factor": self.option_factor,
+            "units": self.option_units,
+            "price": self.option_price,
+            "spot": self.option_spot,
+            "strike": self.chain.strike,
+            "years": np.maximum(years - elapsed, options.MIN_YEARS),
+            "vol": self.option_vol,
+            "rate": params.rate(self.chain, years),
+            "dividend": params.dividend(self.chain),
+            "is_call": self.chain.is_call,
+        }
+
+    def simulate(self, paths, horizon_days=1, seed=None, workers=None):
+        """paths 条路径的组合盈亏 (美元)，返回 (pnl 数组, 实际使用的进程数)"""
+        paths = int(min(max(paths, 1), MAX_PATHS))
+        workers = WORKERS if workers is None else workers
+        chol = self.chol * np.sqrt(horizon_days)
+        drift = -0.5 * np.diag(self.cov) * horizon_days     # 使 E[exp(r)] = 1 (不假设收益方向)
+        opt = self._option_args(horizon_days)
+        sizes = [CHUNK_PATHS] * (paths // CHUNK_PATHS) + ([paths % CHUNK_PATHS] if paths % CHUNK_PATHS else [])
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        tasks = [(chol, drift, self.stock_value, opt, n, s) for n, s in zip(sizes, seeds)]
+
+        pool = _get_pool(workers) if len(tasks) > 1 else None
+        if pool is not None:
+            try:
+                chunks = list(pool.map(_simulate_chunk, tasks))
+                return np.concatenate(chunks), _pool_size
+            except Exception as e:          # 进程池损坏 (工作进程被杀等): 重建，本次在当前进程内计算
+                print(f"Scenario pool failed, running in-process: {e}")
+                _reset_pool()
+        return np.concatenate([_simulate_chunk(t) for t in tasks]), 1
+
+    def stress(self, shocks, propagate=False):
+        """
+        自定义冲击下的即时盈亏。shocks: {symbol: 价格变动比例}；
+        propagate: 未指定的因子取给定冲击下对数收益的条件期望 (Σ_os · Σ_ss⁻¹ · r_s)
+        """
+        k = len(self.factors)
+        moves = np.zeros(k)
+        given = [j for j, s in enumerate(self.factors) if s in shocks]
+        moves[given] = np.log1p([shocks[self.factors[j]] for j in given])
+        if propagate and given:
+            rest = [j for j in range(k) if j not in given]
+            sub = self.cov[np.ix_(given, given)]
+            moves[rest] = self.cov[np.ix_(rest, given)] @ np.linalg.pinv(sub) @ moves[given]
+        change = np.expm1(moves)
+
+        pnl = np.zeros(len(self.symbols))
+        pnl[self.stock_rows] = self.value[self.stock_rows] * change[self.stock_factor]
+        # 不是因子的持仓 (手动定价等) 直接按指定的冲击计算
+        for i, sym in enumerate(self.symbols):
+            if sym in shocks and sym not in self.factors:
+                pnl[i] = self.value[i] * shocks[sym]
+        if self.chain is not None:
+            opt = self._option_args(0)
+            spot = opt["spot"] * (1.0 + change[opt["factor"]])
+            price = options.black_scholes(spot, opt["strike"], opt["years"], opt["vol"], opt["rate"],
+                                          opt["dividend"], opt["is_call"])["price"]
+            pnl[self.option_rows] = np.nan_to_num((price - opt["price"]) * opt["units"])
+
+        total = float(pnl.sum())
+        rows = [{"symbol": self.symbols[i], "market_value": float(self.value[i]), "pnl": float(pnl[i])}
+                for i in np.argsort(pnl, kind="stable") if pnl[i] or self.symbols[i] in shocks]
+        return {
+            "shocks": {s: v * 100 for s, v in shocks.items()},
+            "propagate": bool(propagate),
+            "factor_moves": {s: float(change[j] * 100) for j, s in enumerate(self.factors) if change[j]},
+            "pnl": total,
+            "pnl_pct": total / self.total_value * 100 if self.total_value else 0.0,
+            "positions": rows,
+        }
+
+
+def _simulate_chunk(task):
+    """一块路径的组合盈亏 (在工作进程中执行，参数只含 numpy 数组)"""
+    chol, drift, stock_value, opt, n, seed = task
+    rng = np.random.default_rng(seed)
+    k = len(stock_value)
+    if k == 0:
+        return np.zeros(n)
+    log_returns = rng.standard_normal((n, k)) @ chol.T + drift
+    pnl = np.expm1(log_returns) @ stock_value
+    if opt is not None:
+        spot = opt["spot"] * np.exp(log_returns[:, opt["factor"]])
+        price = options.black_scholes(spot, opt["strike"], opt["years"], opt["vol"], opt["rate"],
+                                      opt["dividend"], opt["is_call"])["price"]
+        pnl += np.nan_to_num(price - opt["price"]) @ opt["units"]
+    return pnl
+
+
+def _get_pool(workers):
+    """进程池 (首次使用时创建，之后复用)；workers <= 1 或平台不支持 (如 Serverless) 时返回 None"""
+    global _pool, _pool_size
+    if workers <= 1:
+        return None
+    if _pool is not None and _pool_size == workers:
+        return _pool
+    _reset_pool()
+    try:
+        import multiprocessing
+        # 服务器进程有多个线程，fork 可能继承被持有的锁: 优先 forkserver
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        _pool_size = workers
+    except (OSError, NotImplementedError, ImportError) as e:
+        print(f"Scenario process pool unavailable, running in-process: {e}")
+        _pool = None
+    return _pool
+
+
+def _reset_pool():
+    global _pool, _pool_size
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+    _pool, _pool_size = None, 0
+
+
+def summarize(pnl, total_value, confidence=DEFAULT_CONFIDENCE):
+    """盈亏分布的 VaR / CVaR (正数表示损失)、分位数和直方图"""
+    n = len(pnl)
+    var, cvar = {}, {}
+    # 只对尾部做部分排序 (np.partition)，不整体排序
+    tail_sizes = {c: max(1, int(np.floor(n * (1 - c)))) for c in confidence}
+    largest = max(tail_sizes.values())
+    tail = np.sort(np.partition(pnl, largest - 1)[:largest]) if largest < n else np.sort(pnl)
+    for c, m in tail_sizes.items():
+        key = f"{c:g}"
+        var[key] = float(-tail[m - 1])
+        cvar[key] = float(-tail[:m].mean())
+    counts, edges = np.histogram(pnl, bins=HISTOGRAM_BINS)
+    pct = np.percentile(pnl, PERCENTILES)
+    return {
+        "var": var,
+        "cvar": cvar,
+        "var_pct": {k: v / total_value * 100 if total_value else 0.0 for k, v in var.items()},
+        "distribution": {
+            "mean": float(pnl.mean()),
+            "std": float(pnl.std()),
+            "min": float(pnl.min()),
+            "max": float(pnl.max()),
+            "prob_loss": float((pnl < 0).mean()),
+            "percentiles": {str(p): float(v) for p, v in zip(PERCENTILES, pct)},
+            "histogram": {"edges": edges.tolist(), "counts": counts.tolist()},
+        },
+    }
+
+
+def run(model, paths=DEFAULT_PATHS, horizon_days=1, confidence=DEFAULT_CONFIDENCE, seed=None,
+        shocks=None, propagate=False, workers=None):
+    """/api/scenarios 的响应: 蒙特卡洛结果 (+ 给定冲击时的压力测试)"""
+    horizon_days = int(min(max(horizon_days, 1), MAX_HORIZON))
+    started = time.perf_counter()
+    pnl, used = model.simulate(paths, horizon_days, seed, workers)
+    elapsed = time.perf_counter() - started
+    report = {
+        "total_value": model.total_value,
+        "paths": len(pnl),
+        "horizon_days": horizon_days,
+        "factors": model.factors,
+        "observations": model.observations,
+        "workers": used,
+        "elapsed_ms": elapsed * 1000,
+    }
+    report.update(summarize(pnl, model.total_value, confidence))
+    if shocks:
+        report["stress"] = model.stress(shocks, propagate)
+    return report
+
+
+class ScenarioCache:
+    """
+    按快照版本缓存: 协方差模型每个版本构建一次，同一版本 + 参数的结果直接复用 (最多 CACHE_SIZE 组参数)。
+    计算期间持锁，并发的相同请求只算一次。
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.version = None
+        self.model = None
+        self.reports = {}
+        self._lock = threading.Lock()
+
+    def report(self, version, data, provider, params):
+        """data: 快照的 data 部分；params: parse_params 的结果"""
+        paths, horizon, confidence, seed, shocks, propagate = params
+        key = (paths, horizon, confidence, seed, tuple(sorted(shocks.items())), propagate)
+        with self._lock:
+            if self.version != version or self.model is None:
+                with metrics.span("scenarios.model"):
+                    self.model = ScenarioModel(data["positions"], data["portfolio"]["cash"], provider)
+                self.version, self.reports = version, {}
+            if key not in self.reports:
+                with metrics.span("scenarios.simulate"):
+                    report = run(self.model, paths, horizon, confidence, seed, shocks, propagate)
+                report["version"] = version
+                if len(self.reports) >= self.size:
+                    self.reports.pop(next(iter(self.reports)))
+                self.reports[key] = report
+            return self.reports[key]
@@ -0,0 +1,285 @@
+"""
+按美股交易时段调度刷新
+  - MarketCalendar: 纽约时间的交易时段 (盘前 4:00-9:30 / 盘中 9:30-16:00 / 盘后 16:00-20:00)，
+    按规则计算 NYSE 假日 (含顺延) 和提前收盘日 (13:00)，MARKET_HOLIDAYS 可追加临时休市日
+  - snapshot_ttl: 快照保鲜期随时段变化，盘中短、盘前盘后长，休市时收盘后取的快照一直有效
+  - RefreshScheduler: server.py 的后台刷新线程，盘中频繁刷新、盘前盘后放慢、休市时休眠到下一个时段；
+    上游出错时指数退避，每次等待加随机抖动，避免多个实例同时请求
+"""
+import os
+import random
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+
+from engine import metrics
+
+try:
+    from zoneinfo import ZoneInfo
+    EASTERN = ZoneInfo("America/New_York")
+except Exception:           # 没有时区数据库 (Windows 未装 tzdata): 按美国夏令时规则计算
+    EASTERN = None
+
+# 各时段的刷新间隔 (秒)
+REGULAR_INTERVAL = float(os.environ.get("REFRESH_REGULAR", "60"))
+EXTENDED_INTERVAL = float(os.environ.get("REFRESH_EXTENDED", "300"))
+# 等待时间的随机抖动比例 (±)
+JITTER = float(os.environ.get("REFRESH_JITTER", "0.1"))
+# 连续出错时的退避: 15s, 30s, 60s ... 最长 BACKOFF_MAX 秒
+BACKOFF_BASE = 15.0
+BACKOFF_MAX = float(os.environ.get("REFRESH_BACKOFF_MAX", "900"))
+# 休市时最长睡眠 (秒)，到点重新计算 (时钟调整 / 配置变化)
+MAX_SLEEP = 3600.0
+
+# 时段边界 (纽约时间，自零点起的分钟数)
+PRE_OPEN, OPEN, CLOSE, POST_CLOSE = 4 * 60, 9 * 60 + 30, 16 * 60, 20 * 60
+EARLY_CLOSE = 13 * 60
+
+# 规则之外的临时休市日 (国丧等)
+SPECIAL_CLOSURES = {"2025-01-09"}
+
+
+def _eastern_offset(utc):
+    """美东 UTC 偏移: 夏令时为 3 月第二个周日 2:00 至 11 月第一个周日 2:00 (当地时间)"""
+    year = utc.year
+    start = _nth_weekday(year, 3, 6, 2)
+    end = _nth_weekday(year, 11, 6, 1)
+    dst_start = datetime(year, 3, start.day, 7, tzinfo=timezone.utc)      # 2:00 EST = 7:00 UTC
+    dst_end = datetime(year, 11, end.day, 6, tzinfo=timezone.utc)         # 2:00 EDT = 6:00 UTC
+    return timedelta(hours=-4 if dst_start <= utc < dst_end else -5)
+
+
+def to_eastern(ts):
+    """unix 秒 -> 纽约时间 (aware datetime)"""
+    utc = datetime.fromtimestamp(ts, timezone.utc)
+    if EASTERN is not None:
+        return utc.astimezone(EASTERN)
+    return utc.astimezone(timezone(_eastern_offset(utc)))
+
+
+def from_eastern(day, minute):
+    """纽约时间 day 当天第 minute 分钟 -> unix 秒"""
+    local = datetime(day.year, day.month, day.day, minute // 60, minute % 60)
+    if EASTERN is not None:
+        return local.replace(tzinfo=EASTERN).timestamp()
+    # 先按 EST 估算，再用该时刻的实际偏移修正
+    guess = local.replace(tzinfo=timezone(timedelta(hours=-5))).timestamp()
+    offset = _eastern_offset(datetime.fromtimestamp(guess, timezone.utc))
+    return local.replace(tzinfo=timezone(offset)).timestamp()
+
+
+def _nth_weekday(year, month, weekday, n):
+    """year 年 month 月第 n 个星期 weekday (0=周一)；n=-1 为最后一个"""
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = (date(year, month + 1, 1) if month < 12 else date(year + 1, 1, 1)) - timedelta(days=1)
+    return last - timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def _easter(year):
+    """公历复活节 (Anonymous Gregorian algorithm)"""
+    a, b, c = year % 19, year // 100, year % 100
+    d, e = b // 4, b % 4
+    g = (8 * b + 13) // 25
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = c // 4, c % 4
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month = (h + l - 7 * m + 114) // 31
+    day = (h + l - 7 * m + 114) % 31 + 1
+    return date(year, month, day)
+
+
+def _observed(day):
+    """周六的假日提前到周五，周日的顺延到周一"""
+    if day.weekday() == 5:
+        return day - timedelta(days=1)
+    if day.weekday() == 6:
+        return day + timedelta(days=1)
+    return day
+
+
+def nyse_holidays(year):
+    """year 年的 NYSE 全天休市日"""
+    days = {
+        _nth_weekday(year, 1, 0, 3),                # 马丁路德金日
+        _nth_weekday(year, 2, 0, 3),                # 总统日
+        _easter(year) - timedelta(days=2),          # 耶稣受难日
+        _nth_weekday(year, 5, 0, -1),               # 阵亡将士纪念日
+        _observed(date(year, 7, 4)),                # 独立日
+        _nth_weekday(year, 9, 0, 1),                # 劳动节
+        _nth_weekday(year, 11, 3, 4),               # 感恩节
+        _observed(date(year, 12, 25)),              # 圣诞节
+    }
+    # 元旦: 落在周六时不提前到上一年 12 月 31 日
+    new_year = date(year, 1, 1)
+    if new_year.weekday() != 5:
+        days.add(_observed(new_year))
+    if year >= 2022:
+        days.add(_observed(date(year, 6, 19)))      # 六月节
+    return days
+
+
+class MarketCalendar:
+    """extra_holidays: 额外的休市日 (YYYY-MM-DD)，默认取 MARKET_HOLIDAYS 环境变量 (逗号分隔)"""
+
+    def __init__(self, extra_holidays=None):
+        if extra_holidays is None:
+            extra_holidays = [d for d in os.environ.get("MARKET_HOLIDAYS", "").split(",") if d.strip()]
+        self.extra = {date.fromisoformat(d.strip()) for d in list(extra_holidays) + sorted(SPECIAL_CLOSURES)}
+        self._years = {}
+        self._days = {}             # 日期 -> sessions (读请求判断保鲜期时频繁调用)
+
+    def holidays(self, year):
+        if year not in self._years:
+            self._years[year] = nyse_holidays(year) | {d for d in self.extra if d.year == year}
+        return self._years[year]
+
+    def is_trading_day(self, day):
+        return day.weekday() < 5 and day not in self.holidays(day.year)
+
+    def close_minute(self, day):
+        """正常收盘 16:00；独立日前一天、感恩节次日、平安夜 (均为交易日时) 13:00 提前收盘"""
+        thanksgiving = _nth_weekday(day.year, 11, 3, 4)
+        if day in (date(day.year, 7, 3), thanksgiving + timedelta(days=1), date(day.year, 12, 24)):
+            return EARLY_CLOSE
+        return CLOSE
+
+    def sessions(self, day):
+        """day 当天的时段 [(名称, 开始, 结束)] (unix 秒)；非交易日为空"""
+        if day in self._days:
+            return self._days[day]
+        sessions = []
+        if self.is_trading_day(day):
+            close = self.close_minute(day)
+            # 提前收盘日的盘后时段同样提前结束 (17:00)
+            post_close = POST_CLOSE if close == CLOSE else close + 4 * 60
+            bounds = [("pre", PRE_OPEN, OPEN), ("regular", OPEN, close), ("post", close, post_close)]
+            sessions = [(name, from_eastern(day, start), from_eastern(day, end)) for name, start, end in bounds]
+        if len(self._days) > 64:
+            self._days.clear()
+        self._days[day] = sessions
+        return sessions
+
+    def session(self, now=None):
+        """当前时段: pre / regular / post / closed"""
+        now = time.time() if now is None else now
+        for name, start, end in self.sessions(to_eastern(now).date()):
+            if start <= now < end:
+                return name
+        return "closed"
+
+    def next_open(self, now=None):
+        """下一个时段 (从盘前开始) 的开始时间 (unix 秒)；当前已在交易时段内时返回 now"""
+        now = time.time() if now is None else now
+        day = to_eastern(now).date()
+        for offset in range(15):
+            for _, start, end in self.sessions(day + timedelta(days=offset)):
+                if now < end:
+                    return max(start, now)
+        return now + MAX_SLEEP
+
+    def last_close(self, now=None):
+        """最近一次盘后时段结束的时间 (unix 秒)，之后到下一个盘前之间价格不再变化"""
+        now = time.time() if now is None else now
+        day = to_eastern(now).date()
+        for offset in range(15):
+            sessions = self.sessions(day - timedelta(days=offset))
+            if sessions and sessions[-1][2] <= now:
+                return sessions[-1][2]
+        return now
+
+
+CALENDAR = MarketCalendar()
+
+
+def interval(session):
+    """时段对应的刷新间隔 (秒)；休市返回 None"""
+    if session == "regular":
+        return REGULAR_INTERVAL
+    if session in ("pre", "post"):
+        return EXTENDED_INTERVAL
+    return None
+
+
+def snapshot_ttl(updated_at, now=None, calendar=None, regular=None, extended=None):
+    """
+    快照在 now 时刻的保鲜期 (秒): 盘中为 regular (默认 REFRESH_REGULAR)，盘前 / 盘后为 extended (默认 REFRESH_EXTENDED)；
+    休市时快照取于最近一次收盘之后则一直有效 (inf)，否则立即过期
+    """
+    calendar = calendar or CALENDAR
+    now = time.time() if now is None else now
+    session = calendar.session(now)
+    if session == "regular":
+        return REGULAR_INTERVAL if regular is None else regular
+    if session in ("pre", "post"):
+        return EXTENDED_INTERVAL if extended is None else extended
+    if updated_at is not None and updated_at >= calendar.last_close(now):
+        return float("inf")
+    return 0.0
+
+
+def with_jitter(seconds, jitter=JITTER):
+    return seconds * random.uniform(1 - jitter, 1 + jitter) if seconds > 0 else seconds
+
+
+class RefreshScheduler:
+    """
+    state: SnapshotState；按时段间隔刷新，快照仍在间隔内 (例如读请求刚触发过刷新) 时跳过本轮。
+    休市时: 收盘后补一次刷新 (记录收盘价)，然后睡到下一个盘前。
+    """
+
+    def __init__(self, state, calendar=None):
+        self.state = state
+        self.calendar = calendar or CALENDAR
+        self.failures = 0
+        self.next_run = None
+        self._wake = threading.Event()
+
+    def wake(self):
+        """立即重新评估 (例如配置变化后)"""
+        self._wake.set()
+
+    def backoff(self):
+        return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (self.failures - 1))
+
+    def step(self, now=None):
+        """执行一轮调度，返回距下一轮的秒数"""
+        now = time.time() if now is None else now
+        session = self.calendar.session(now)
+        period = interval(session)
+        age = self.state.age
+        if period is None:
+            # 休市: 快照早于上次收盘时补一次，之后睡到下一个盘前
+            due = self.state.updated_at is None or self.state.updated_at < self.calendar.last_close(now)
+            wait = min(MAX_SLEEP, max(1.0, self.calendar.next_open(now) - now))
+        else:
+            due = age is None or age >= period
+            wait = period if due else period - age
+        if due:
+            try:
+                self.state.refresh()
+                self.failures = 0
+                metrics.inc("scheduled_refresh_total", help="Refreshes started by the scheduler",
+                            session=session, status="ok")
+            except Exception as e:
+                self.failures += 1
+                wait = self.backoff()
+                metrics.inc("scheduled_refresh_total", help="Refreshes started by the scheduler",
+                            session=session, status="error")
+                print(f"Scheduled refresh failed ({self.failures}x), retrying in {wait:.0f}s: {e}")
+        wait = with_jitter(wait)
+        self.next_run = now + wait
+        return wait
+
+    def run(self):
+        while True:
+            wait = self.step()
+            self._wake.wait(wait)
+            self._wake.clear()
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name="refresh-scheduler", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,51 @@
+"""
+Single-flight 调用合并
+同一时刻只运行一次计算；计算进行中到达的调用者不再重复执行，而是等待并共享同一结果。
+"""
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """合并并发调用: do(fn) 返回 (结果, 是否为共享结果)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._call = None
+
+    @property
+    def in_flight(self):
+        return self._call is not None
+
+    def do(self, fn, *args, **kwargs):
+        with self._lock:
+            call = self._call
+            leader = call is None
+            if leader:
+                call = self._call = _Call()
+
+        if not leader:
+            # 已有计算在进行，等待其结果
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+        finally:
+            with self._lock:
+                self._call = None
+            call.done.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result, False
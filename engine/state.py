@@ -0,0 +1,123 @@
+"""
+快照状态 (stale-while-revalidate)
+保存最近一次成功计算的快照，读者总是立即拿到它；过期时在后台线程刷新，不阻塞读请求。
+"""
+import json
+import os
+import threading
+import time
+
+from engine.singleflight import SingleFlight
+from engine.versions import SnapshotVersions
+
+
+class SnapshotState:
+    """
+    compute: 无参函数，返回 {"data": ..., "history": ...}，失败时抛异常
+    ttl:     快照保鲜期 (秒)，超过后读请求会触发后台刷新；
+             也可以是函数 ttl(updated_at) -> 秒 (按交易时段变化，见 engine.schedule.snapshot_ttl)
+    """
+
+    def __init__(self, compute, ttl=60.0):
+        self.compute = compute
+        self.ttl = ttl
+        self.result = None
+        self.version = None
+        self.updated_at = None      # time.time() of last good snapshot
+        self.versions = SnapshotVersions()
+        self.last_error = None
+        self.listeners = []         # fn(version, result, source)，快照内容变化时调用
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+
+    def load_files(self, data_path, history_path):
+        """启动时用磁盘上的 data.json / history.json 作为初始快照 (按文件修改时间计算 age)"""
+        try:
+            with open(data_path, encoding='utf-8') as f:
+                data = json.load(f)
+            with open(history_path, encoding='utf-8') as f:
+                history = json.load(f)
+        except (OSError, ValueError):
+            return False
+        with self._lock:
+            if self.result is None:
+                self.result = {"data": data, "history": history}
+                self.version, _ = self.versions.publish(self.result)
+                self.updated_at = os.path.getmtime(data_path)
+        return True
+
+    @property
+    def age(self):
+        if self.updated_at is None:
+            return None
+        return max(0.0, time.time() - self.updated_at)
+
+    @property
+    def fresh(self):
+        age = self.age
+        if age is None:
+            return False
+        ttl = self.ttl(self.updated_at) if callable(self.ttl) else self.ttl
+        return age < ttl
+
+    @property
+    def refreshing(self):
+        return self._flight.in_flight
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def publish(self, result, source="refresh"):
+        """设置新快照 (刷新结果或实时行情推送)，内容有变化时通知监听者"""
+        with self._lock:
+            self.result = result
+            self.version, changed = self.versions.publish(result)
+            self.updated_at = time.time()
+            version = self.version
+        if changed:
+            for listener in list(self.listeners):
+                try:
+                    listener(version, result, source)
+                except Exception as e:
+                    print(f"Snapshot listener failed: {e}")
+        return version
+
+    def _run(self):
+        result = self.compute()
+        self.publish(result)
+        self.last_error = None
+        return result
+
+    def refresh(self):
+        """同步刷新 (并发调用合并)，返回 (result, shared)"""
+        try:
+            return self._flight.do(self._run)
+        except Exception as e:
+            self.last_error = str(e)
+            raise
+
+    def refresh_async(self):
+        """在后台线程刷新；已有刷新在进行时直接返回 False"""
+        if self._flight.in_flight:
+            return False
+
+        def worker():
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Background refresh failed: {e}")
+
+        threading.Thread(target=worker, name="snapshot-refresh", daemon=True).start()
+        return True
+
+    def get(self):
+        """
+        立即返回最近的快照 (可能为 None)，过期则触发后台刷新。
+        返回 (version, result, age, fresh)
+        """
+        with self._lock:
+            version, result = self.version, self.result
+        fresh = self.fresh
+        if not fresh:
+            self.refresh_async()
+        return version, result, self.age, fresh
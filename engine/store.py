@@ -0,0 +1,182 @@
+"""
+本地 OHLC 行情库 (SQLite)
+按 (symbol, date) 存储日线；每次刷新只向上游请求每个标的最后一根已存K线之后的数据并追加，
+任意长度的历史查询都直接从本地读取 (读连接启用 mmap)。
+"""
+import os
+import sqlite3
+import threading
+from datetime import date, timedelta
+
+from engine import metrics
+from engine.quotes import Bar, PERIOD_DAYS, QuoteProvider
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "prices.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bars (
+    symbol TEXT NOT NULL,
+    date   TEXT NOT NULL,
+    open   REAL, high REAL, low REAL, close REAL, volume REAL,
+    PRIMARY KEY (symbol, date)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS coverage (
+    symbol TEXT PRIMARY KEY,
+    since  TEXT NOT NULL
+);
+"""
+
+
+class PriceStore:
+    """SQLite 日线库，线程安全 (单连接 + 锁)"""
+
+    def __init__(self, path=DEFAULT_PATH, mmap_size=256 * 1024 * 1024):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+            self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def last_dates(self, symbols):
+        """{symbol: 最后一根已存K线的日期}，没有数据的标的不出现"""
+        symbols = list(symbols)
+        if not symbols:
+            return {}
+        marks = ",".join("?" * len(symbols))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT symbol, MAX(date) FROM bars WHERE symbol IN ({marks}) GROUP BY symbol",
+                symbols).fetchall()
+        return dict(rows)
+
+    def coverage(self, symbols):
+        """{symbol: 已完整下载的最早起始日}"""
+        symbols = list(symbols)
+        if not symbols:
+            return {}
+        marks = ",".join("?" * len(symbols))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT symbol, since FROM coverage WHERE symbol IN ({marks})", symbols).fetchall()
+        return dict(rows)
+
+    def append(self, bars_map, since=None):
+        """
+        写入K线 (同一天重复写入时覆盖，用于更新当天未收盘的K线)。
+        since 不为空时记录这些标的已覆盖到该起始日。
+        """
+        rows = [(sym,) + tuple(b) for sym, bars in bars_map.items() for b in bars]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO bars (symbol, date, open, high, low, close, volume) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            if since:
+                self._conn.executemany(
+                    "INSERT INTO coverage (symbol, since) VALUES (?, ?) "
+                    "ON CONFLICT(symbol) DO UPDATE SET since = MIN(since, excluded.since)",
+                    [(sym, since) for sym in bars_map])
+        return len(rows)
+
+    def load(self, symbols, start=None, end=None):
+        """读取 [start, end] 区间的日线: {symbol: [Bar, ...]}"""
+        symbols = list(dict.fromkeys(symbols))
+        if not symbols:
+            return {}
+        marks = ",".join("?" * len(symbols))
+        sql = f"SELECT symbol, date, open, high, low, close, volume FROM bars WHERE symbol IN ({marks})"
+        args = list(symbols)
+        if start:
+            sql += " AND date >= ?"
+            args.append(start)
+        if end:
+            sql += " AND date <= ?"
+            args.append(end)
+        sql += " ORDER BY symbol, date"
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        result = {}
+        for row in rows:
+            result.setdefault(row[0], []).append(Bar(*row[1:]))
+        return result
+
+
+def window_start(period, today=None):
+    """period 对应的起始日期 (YYYY-MM-DD)"""
+    today = today or date.today()
+    span = PERIOD_DAYS.get(period, 30)
+    return (today - timedelta(days=span - 1)).isoformat()
+
+
+class StoredProvider(QuoteProvider):
+    """
+    本地库 + 增量更新
+    已覆盖请求窗口的标的只从最后一个已存日期 (含，当天K线可能仍在变化) 开始增量下载；
+    新标的或窗口更长时才整段下载。结果始终从本地库读取。
+    """
+
+    def __init__(self, backend, store):
+        self.backend = backend
+        self.store = store
+
+    @property
+    def name(self):
+        return f"stored:{self.backend.name}"
+
+    @property
+    def available(self):
+        return self.backend.available
+
+    def sync(self, symbols, since):
+        """把 symbols 同步到 since 之后的最新数据，返回上游请求的K线条数"""
+        symbols = list(dict.fromkeys(symbols))
+        covered = self.store.coverage(symbols)
+        last = self.store.last_dates(symbols)
+
+        # 按起始日分组，同组一次批量请求
+        groups = {}
+        full = []
+        for sym in symbols:
+            if sym in covered and covered[sym] <= since and sym in last:
+                groups.setdefault(last[sym], []).append(sym)
+            else:
+                full.append(sym)
+
+        fetched_bars = 0
+        if full:
+            fetched = self.backend.fetch(full, start=since)
+            fetched_bars += self.store.append(fetched, since=since)
+        for start, group in groups.items():
+            fetched = self.backend.fetch(group, start=start)
+            fetched_bars += self.store.append(fetched)
+        return fetched_bars
+
+    def fetch(self, symbols, period="5d", start=None):
+        since = start or window_start(period)
+        with metrics.span("store.sync"):
+            self.sync(symbols, since)
+        with metrics.span("store.load"):
+            return self.store.load(symbols, start=since)
+
+    def quote(self, symbol):
+        return self.backend.quote(symbol)
+
+
+def open_store(path=None):
+    """打开默认行情库 (PRICE_STORE 环境变量指定路径，设为 off 关闭)；不可写时返回 None"""
+    path = path or os.environ.get("PRICE_STORE", DEFAULT_PATH)
+    if path.lower() in ("off", "none", "0"):
+        return None
+    try:
+        return PriceStore(path)
+    except (sqlite3.Error, OSError) as e:
+        print(f"Price store unavailable ({path}): {e}")
+        return None
@@ -0,0 +1,426 @@
+"""
+实时行情流 (IBKR Client Portal Gateway websocket)
+通过 wss://localhost:5000/v1/api/ws 订阅 smd+conid (见 gateway/doc/RealtimeSubscription.md)，
+每个 conid 只订阅一次；收到 tick 后只重算受影响的持仓和组合汇总，不再整体重新估值。
+
+离线调试: 用录制的 tick 启动本地替身服务器，再让 server.py 连接它
+    python -m engine.stream --replay engine/sample_ticks.jsonl --port 5001
+    PRICE_STREAM=ws://127.0.0.1:5001/v1/api/ws python server.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import ssl
+import threading
+import time
+import urllib.request
+
+from engine.lots import DEFAULT_ACCOUNT
+from engine.options import is_option
+
+# websockets 为可选依赖，只有启用实时行情时才需要
+try:
+    import websockets
+    HAS_WS = True
+except ImportError:
+    HAS_WS = False
+
+DEFAULT_WS_URL = "wss://localhost:5000/v1/api/ws"
+DEFAULT_REST_URL = "https://localhost:5000/v1/api"
+
+# 行情字段 (tick type): 31 = 最新价, 7741 = 昨收
+FIELD_LAST = "31"
+FIELD_PRIOR_CLOSE = "7741"
+FIELDS = [FIELD_LAST, FIELD_PRIOR_CLOSE]
+
+HEARTBEAT_SECONDS = 50
+
+
+def gateway_ssl_context():
+    """网关使用自签名证书 (gateway/root/vertx.jks)，本地连接不校验证书"""
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+
+def parse_price(value):
+    """解析 tick 价格；网关会在价格前加 C (昨收) / H (停牌) 等前缀"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).lstrip("CH").replace(",", "")
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def resolve_conids(symbols, rest_url=DEFAULT_REST_URL, timeout=5.0):
+    """通过 /iserver/secdef/search 查询股票 conid，返回 {symbol: conid}"""
+    ctx = gateway_ssl_context()
+    result = {}
+    for sym in symbols:
+        try:
+            req = urllib.request.Request(
+                f"{rest_url}/iserver/secdef/search",
+                data=json.dumps({"symbol": sym}).encode(),
+                headers={"Content-Type": "application/json"})
+            with urllib.request.urlopen(req, timeout=timeout, context=ctx) as res:
+                matches = json.load(res)
+            if matches:
+                result[sym] = int(matches[0]["conid"])
+        except Exception as e:
+            print(f"conid lookup failed for {sym}: {e}")
+    return result
+
+
+class LivePortfolio:
+    """
+    内存中的实时组合
+    以一份完整快照为基准，按标的建立行索引；apply_tick 只更新该标的所在的持仓，
+    组合总市值 / 日盈亏和各账户汇总通过增量 (新值 - 旧值) 维护。
+    """
+
+    def __init__(self, result):
+        self.rebase(result)
+
+    def rebase(self, result):
+        """以新的完整快照为基准 (定时刷新后调用，顺带消除浮点累积误差)"""
+        data = result["data"]
+        self.history = result.get("history", [])
+        self.updated_at = data.get("updated_at")
+        self.extra = {k: v for k, v in data.items() if k not in ("portfolio", "positions", "accounts", "updated_at")}
+        self.cash = data["portfolio"].get("cash", 0.0)
+        self.positions = [dict(p) for p in data.get("positions", [])]
+        self.rows = {}
+        self.prev = []
+        for i, p in enumerate(self.positions):
+            self.rows.setdefault(p["symbol"], []).append(i)
+            # 期权持仓带 multiplier (每张合约的股数)，非基准币种带 fx_rate；价格 / 成本均按每股、计价币种
+            units = (p.get("quantity") or 0) * p.get("multiplier", 1) * p.get("fx_rate", 1)
+            price = p.get("current_price", 0.0)
+            # 快照里没有昨收字段，由日盈亏反推
+            self.prev.append(price - p.get("day_pnl", 0.0) / units if units and price else 0.0)
+        self.market_value = sum(p.get("market_value", 0.0) for p in self.positions)
+        self.day_pnl = sum(p.get("day_pnl", 0.0) for p in self.positions)
+        self.total_cost = sum(p.get("cost_basis", 0) * p["quantity"] * p.get("multiplier", 1) * p.get("fx_rate", 1)
+                              for p in self.positions)
+
+        # 账户汇总: 每行按各 lot 的数量拆分到所属账户
+        self.accounts = [dict(a) for a in data.get("accounts", [])]
+        account_index = {a["account"]: j for j, a in enumerate(self.accounts)}
+        self.shares = []
+        for p in self.positions:
+            lots = p.get("lots") or [{"account": p.get("account", DEFAULT_ACCOUNT), "quantity": p.get("quantity") or 0}]
+            self.shares.append([(account_index[lot["account"]], lot["quantity"]) for lot in lots
+                                if lot["account"] in account_index])
+
+    def apply_tick(self, symbol, last, prior_close=None):
+        """更新一个标的的价格，返回受影响的持仓行列表"""
+        rows = self.rows.get(symbol)
+        if not rows or not last:
+            return []
+        changed = []
+        for i in rows:
+            p = self.positions[i]
+            if prior_close:
+                self.prev[i] = prior_close
+            prev = self.prev[i]
+            qty = p["quantity"] * p.get("multiplier", 1) * p.get("fx_rate", 1)
+            if p.get("current_price") == last and not prior_close:
+                continue
+
+            old_mv, old_day = p.get("market_value", 0.0), p.get("day_pnl", 0.0)
+            cost = p.get("cost_basis", 0) * qty
+            p["current_price"] = last
+            p["market_value"] = qty * last
+            p["total_pnl"] = p["market_value"] - cost
+            p["pnl_percent"] = (p["total_pnl"] / cost * 100) if cost else 0.0
+            if prev:
+                p["day_pnl"] = (last - prev) * qty
+                p["day_pnl_percent"] = (last - prev) / prev * 100
+            p.pop("price_missing", None)
+
+            self.market_value += p["market_value"] - old_mv
+            self.day_pnl += p.get("day_pnl", 0.0) - old_day
+            self._apply_accounts(i, old_mv, old_day)
+            changed.append(p)
+        if changed:
+            self.updated_at = time.strftime("%Y-%m-%d %H:%M:%S")
+        return changed
+
+    def _apply_accounts(self, i, old_mv, old_day):
+        """把第 i 行的价格变化按 lot 数量加到所属账户"""
+        p = self.positions[i]
+        qty = p.get("quantity") or 0
+        if not qty:
+            return
+        d_price = (p["market_value"] - old_mv) / qty
+        d_day = (p.get("day_pnl", 0.0) - old_day) / qty
+        for j, lot_qty in self.shares[i]:
+            account = self.accounts[j]
+            account["market_value"] += d_price * lot_qty
+            account["day_pnl"] += d_day * lot_qty
+
+    def portfolio(self):
+        grand_total = self.market_value + self.cash
+        yesterday_val = grand_total - self.day_pnl
+        total_pnl_val = self.market_value - self.total_cost
+        return {
+            "total_value": grand_total,
+            "cash": self.cash,
+            "day_pnl": self.day_pnl,
+            "day_pnl_pct": (self.day_pnl / yesterday_val * 100) if yesterday_val else 0,
+            "total_pnl_val": total_pnl_val,
+            "total_pnl_pct": (total_pnl_val / self.total_cost * 100) if self.total_cost else 0,
+        }
+
+    def to_result(self):
+        """导出为与 generate_snapshot_data 相同格式的快照 (占比在此统一计算)"""
+        positions = sorted((dict(p) for p in self.positions), key=lambda x: x.get("market_value", 0), reverse=True)
+        for p in positions:
+            p["allocation_percent"] = (p.get("market_value", 0) / self.market_value * 100) if self.market_value else 0
+        history = list(self.history)
+        if history:
+            history[-1] = dict(history[-1], value=self.market_value + self.cash)
+        data = {"updated_at": self.updated_at, "portfolio": self.portfolio(), "positions": positions}
+        if self.accounts:
+            data["accounts"] = [dict(a, total_pnl=a["market_value"] - a["total_cost"],
+                                     allocation_percent=(a["market_value"] / self.market_value * 100)
+                                     if self.market_value else 0) for a in self.accounts]
+        data.update(self.extra)
+        return {"data": data, "history": history}
+
+
+class GatewayStream:
+    """
+    网关 websocket 客户端
+    conids: {conid: symbol}；on_tick(symbol, last, prior_close) 在收到行情时回调。
+    断线后指数退避重连，重连后重新订阅。
+    """
+
+    def __init__(self, url, conids, on_tick, record=None):
+        self.url = url
+        self.conids = dict(conids)
+        self.on_tick = on_tick
+        self.record = record            # 录制收到的 smd 消息 (JSONL)，供替身服务器回放
+        self.subscribed = set()
+        self._stop = False
+
+    async def _subscribe(self, ws):
+        for conid in self.conids:
+            if conid in self.subscribed:
+                continue
+            await ws.send(f'smd+{conid}+{json.dumps({"fields": FIELDS})}')
+            self.subscribed.add(conid)
+
+    async def _heartbeat(self, ws):
+        while True:
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+            await ws.send("ech+hb")
+
+    def handle(self, raw):
+        """解析一条消息，smd 行情回调 on_tick，返回是否为行情消息"""
+        try:
+            msg = json.loads(raw)
+        except (TypeError, ValueError):
+            return False
+        if not isinstance(msg, dict) or not str(msg.get("topic", "")).startswith("smd+"):
+            return False
+        conid = int(msg.get("conid") or msg["topic"].split("+", 1)[1])
+        symbol = self.conids.get(conid)
+        last = parse_price(msg.get(FIELD_LAST))
+        if symbol is None or last is None:
+            return False
+        if self.record is not None:
+            self.record.write(json.dumps({"t": time.time(), "msg": msg}) + "\n")
+        self.on_tick(symbol, last, parse_price(msg.get(FIELD_PRIOR_CLOSE)))
+        return True
+
+    async def run(self):
+        if not HAS_WS:
+            raise RuntimeError("websockets not installed (pip install websockets)")
+        backoff = 1.0
+        while not self._stop:
+            try:
+                ctx = gateway_ssl_context() if self.url.startswith("wss://") else None
+                async with websockets.connect(self.url, ssl=ctx) as ws:
+                    self.subscribed.clear()
+                    await self._subscribe(ws)
+                    backoff = 1.0
+                    hb = asyncio.ensure_future(self._heartbeat(ws))
+                    try:
+                        async for raw in ws:
+                            self.handle(raw)
+                    finally:
+                        hb.cancel()
+            except Exception as e:
+                if self._stop:
+                    break
+                print(f"Gateway stream disconnected: {e}; retry in {backoff:.0f}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 60.0)
+
+    def stop(self):
+        self._stop = True
+
+    def run_in_thread(self):
+        """在后台守护线程中运行事件循环"""
+        thread = threading.Thread(target=lambda: asyncio.run(self.run()), name="gateway-stream", daemon=True)
+        thread.start()
+        return thread
+
+
+def parse_conids(text):
+    """解析 "TSLA=76792991,NVDA=4815747" 格式的 conid 映射"""
+    pairs = [item.split("=", 1) for item in text.split(",") if "=" in item]
+    return {sym.strip(): int(conid) for sym, conid in pairs}
+
+
+def attach(state, url, symbols, conids=None, rest_url=None, min_interval=1.0):
+    """
+    把实时行情接入 SnapshotState: tick 增量更新 LivePortfolio，最多每 min_interval 秒发布一次快照。
+    conids: {symbol: conid}；给出 rest_url 时缺失的 conid 通过网关 REST 接口查询。
+    """
+    conids = dict(conids or {})
+    missing = [s for s in symbols if s not in conids and ' ' not in s and not is_option(s)]
+    if missing and rest_url:
+        conids.update(resolve_conids(missing, rest_url))
+
+    lock = threading.Lock()
+    live = {"portfolio": None, "published": 0.0, "dirty": False}
+
+    def on_snapshot(version, result, source):
+        if source == "stream":
+            return
+        with lock:
+            if live["portfolio"] is None:
+                live["portfolio"] = LivePortfolio(result)
+            else:
+                live["portfolio"].rebase(result)
+            live["dirty"] = False
+
+    def flush(force=False):
+        with lock:
+            portfolio = live["portfolio"]
+            if portfolio is None or not live["dirty"]:
+                return
+            now = time.monotonic()
+            if not force and now - live["published"] < min_interval:
+                return
+            live["published"], live["dirty"] = now, False
+            result = portfolio.to_result()
+        state.publish(result, source="stream")
+
+    def on_tick(symbol, last, prior_close):
+        with lock:
+            portfolio = live["portfolio"]
+            if portfolio is None or not portfolio.apply_tick(symbol, last, prior_close):
+                return
+            live["dirty"] = True
+        flush()
+
+    def flusher():
+        # 节流期间积压的 tick 由这里补发
+        while not stream._stop:
+            time.sleep(min_interval)
+            flush(force=True)
+
+    state.subscribe(on_snapshot)
+    if state.result is not None:
+        on_snapshot(state.version, state.result, "refresh")
+
+    stream = GatewayStream(url, {conid: sym for sym, conid in conids.items()}, on_tick)
+    stream.run_in_thread()
+    threading.Thread(target=flusher, name="gateway-stream-flush", daemon=True).start()
+    print(f"Streaming {len(conids)} symbols from {url}")
+    return stream
+
+
+# ---------------------------------------------------------
+# 本地替身服务器: 回放录制的 tick
+# ---------------------------------------------------------
+
+def load_recording(path):
+    """读取录制文件，返回 {conid: [(相对时间, msg), ...]}"""
+    by_conid = {}
+    start = None
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            start = item["t"] if start is None else start
+            msg = item["msg"]
+            conid = int(msg.get("conid") or msg["topic"].split("+", 1)[1])
+            by_conid.setdefault(conid, []).append((item["t"] - start, msg))
+    return by_conid
+
+
+async def _replay_conn(ws, recording, speed, loop_forever):
+    await ws.send(json.dumps({"topic": "system", "success": "replay"}))
+    tasks = []
+
+    async def replay(conid):
+        ticks = recording.get(conid, [])
+        while ticks:
+            t0 = time.monotonic()
+            for offset, msg in ticks:
+                delay = offset / speed - (time.monotonic() - t0)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await ws.send(json.dumps(msg))
+            if not loop_forever:
+                break
+
+    try:
+        async for raw in ws:
+            if raw.startswith("smd+"):
+                conid = int(raw.split("+")[1])
+                tasks.append(asyncio.ensure_future(replay(conid)))
+            elif raw == "ech+hb":
+                await ws.send("ech+hb")
+    finally:
+        for t in tasks:
+            t.cancel()
+
+
+async def serve_replay(path, host="127.0.0.1", port=5001, speed=1.0, loop_forever=True):
+    """启动回放服务器 (ws://host:port/v1/api/ws)"""
+    if not HAS_WS:
+        raise RuntimeError("websockets not installed (pip install websockets)")
+    recording = load_recording(path)
+    async with websockets.serve(lambda ws, *args: _replay_conn(ws, recording, speed, loop_forever), host, port):
+        print(f"Replaying {sum(map(len, recording.values()))} ticks for {len(recording)} conids "
+              f"on ws://{host}:{port}/v1/api/ws")
+        await asyncio.Future()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="IBKR gateway websocket replay / recorder")
+    parser.add_argument("--replay", help="回放录制文件 (JSONL)")
+    parser.add_argument("--record", help="连接网关并录制 tick 到该文件")
+    parser.add_argument("--conids", default="", help="录制时订阅的 SYMBOL=conid 列表，逗号分隔")
+    parser.add_argument("--url", default=os.environ.get("GATEWAY_WS", DEFAULT_WS_URL))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--speed", type=float, default=1.0, help="回放速度倍数")
+    args = parser.parse_args()
+
+    if args.replay:
+        asyncio.run(serve_replay(args.replay, args.host, args.port, args.speed))
+    elif args.record:
+        conids = {conid: sym for sym, conid in parse_conids(args.conids).items()}
+        with open(args.record, "a", encoding="utf-8") as f:
+            stream = GatewayStream(args.url, conids, lambda *a: print(*a), record=f)
+            asyncio.run(stream.run())
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
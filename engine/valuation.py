@@ -0,0 +1,111 @@
+"""
+向量化估值引擎
+把行情对齐成 dates × symbols 的 NumPy 价格矩阵，组合市值 / 日盈亏 / 总盈亏都通过一次矩阵-向量乘法得到，
+不再逐日、逐持仓做 Python 循环。
+"""
+import numpy as np
+
+
+class PriceMatrix:
+    """
+    收盘价矩阵: values[i, j] 为 dates[i] 当天第 j 列标的的收盘价，缺失为 NaN。
+    列与持仓一一对应 (同一标的可以出现在多列)。
+    """
+
+    def __init__(self, dates, symbols, values):
+        self.dates = dates
+        self.symbols = symbols
+        self.values = values
+
+    @classmethod
+    def from_bars(cls, bars_map, symbols):
+        """由 {symbol: [Bar, ...]} 构建；日期取 bars_map 中所有标的的并集"""
+        dates = sorted({b.date for bars in bars_map.values() for b in bars})
+        row = {d: i for i, d in enumerate(dates)}
+        values = np.full((len(dates), len(symbols)), np.nan)
+        for j, sym in enumerate(symbols):
+            bars = bars_map.get(sym)
+            if not bars:
+                continue
+            rows = np.fromiter((row[b.date] for b in bars), dtype=np.intp, count=len(bars))
+            values[rows, j] = np.fromiter((b.close for b in bars), dtype=float, count=len(bars))
+        return cls(dates, list(symbols), values)
+
+    def complete_rows(self):
+        """所有列都有报价的日期 (布尔掩码)"""
+        return ~np.isnan(self.values).any(axis=1)
+
+    def filled(self, fallback=None, overrides=None):
+        """
+        前向填充缺失值；开头仍缺失的用 fallback (每列一个值) 补齐。
+        overrides 中非 NaN 的列 (手动定价) 整列替换为该值。
+        """
+        values = forward_fill(self.values)
+        if fallback is not None:
+            values = np.where(np.isnan(values), fallback[None, :], values)
+        if overrides is not None:
+            manual = ~np.isnan(overrides)
+            values[:, manual] = overrides[manual]
+        return values
+
+
+def forward_fill(values):
+    """沿日期轴 (axis 0) 前向填充 NaN"""
+    n = values.shape[0]
+    if n == 0:
+        return values.copy()
+    idx = np.where(np.isnan(values), 0, np.arange(n)[:, None])
+    np.maximum.accumulate(idx, axis=0, out=idx)
+    return values[idx, np.arange(values.shape[1])[None, :]]
+
+
+def matvec(matrix, vector):
+    """
+    矩阵-向量乘法，按列从左到右顺序累加。
+    与原来逐持仓 `+=` 的累加顺序一致，结果逐位相同 (BLAS 的 @ 会重排求和顺序，末位可能不同)。
+    """
+    if matrix.shape[-1] == 0:
+        return np.zeros(matrix.shape[:-1])
+    return np.cumsum(matrix * vector, axis=-1)[..., -1]
+
+
+def history_values(prices, quantities, cash=0.0):
+    """每日组合净值: prices (dates × positions) · quantities + cash"""
+    return matvec(prices, quantities) + cash
+
+
+def value_positions(price, prev, quantity, cost_basis):
+    """
+    逐持仓估值 (全部为等长数组，price 为 0 表示无报价)。
+    返回 dict: market_value / total_pnl / pnl_percent / day_pnl / day_pnl_percent
+    """
+    has_price = price != 0
+    has_prev = has_price & (prev != 0)
+    cost = cost_basis * quantity
+
+    market_value = np.where(has_price, quantity * price, 0.0)
+    total_pnl = np.where(has_price, market_value - cost, 0.0)
+    change = price - prev
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pnl_percent = np.where(has_price & (cost != 0), total_pnl / cost * 100, 0.0)
+        day_pnl_percent = np.where(has_prev, change / prev * 100, 0.0)
+    day_pnl = np.where(has_prev, change * quantity, 0.0)
+
+    return {
+        "market_value": market_value,
+        "total_pnl": total_pnl,
+        "pnl_percent": pnl_percent,
+        "day_pnl": day_pnl,
+        "day_pnl_percent": day_pnl_percent,
+    }
+
+
+def portfolio_totals(price, prev, quantity, cost_basis):
+    """
+    组合汇总: 一次矩阵-向量乘法得到 (总市值, 日盈亏, 总成本)。
+    无报价的持仓 (price 为 0) 不计入日盈亏。
+    """
+    has_prev = (price != 0) & (prev != 0)
+    legs = np.stack([price, np.where(has_prev, price - prev, 0.0), cost_basis])
+    market_value, day_pnl, total_cost = matvec(legs, quantity)
+    return float(market_value), float(day_pnl), float(total_cost)
@@ -0,0 +1,143 @@
+"""
+快照版本与增量 (delta)
+每次内容发生变化时版本号递增 (只有 updated_at 变化不算)，用于 ETag / If-None-Match；
+保留最近一段时间内的版本 (按时间窗口，覆盖客户端的轮询间隔)，
+客户端可以只拉取某个版本之后变化的持仓、组合汇总和新增的历史点。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# 版本保留窗口 (秒): 前端每 60 秒轮询 /api/delta，保留 3 个轮询周期，实时推送 (每秒发布) 时基准版本仍在
+DELTA_RETAIN = float(os.environ.get("DELTA_RETAIN", "180"))
+# 窗口内最多保留的版本数 (内存上限)
+DELTA_MAX_VERSIONS = int(os.environ.get("DELTA_MAX_VERSIONS", "512"))
+
+
+def content_digest(result):
+    """
+    快照内容摘要 (不含 updated_at)。
+    历史序列只取长度和首尾两个点: 历史由当前持仓回溯，中间的点只会随持仓一起变化 (持仓已计入摘要)，
+    每次发布不必序列化整段历史
+    """
+    data = result.get("data", {})
+    body = {k: v for k, v in data.items() if k != "updated_at"}
+    history = result.get("history") or []
+    tail = [len(history), history[0], history[-1]] if history else []
+    raw = json.dumps([body, tail], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def _without_allocation(position):
+    if position is None:
+        return None
+    return {k: v for k, v in position.items() if k != "allocation_percent"}
+
+
+class SnapshotVersions:
+    """
+    版本号格式为 "<epoch>.<n>"：epoch 每次进程启动随机生成，避免重启后旧版本号与新快照混淆。
+    retain:       版本保留的时间窗口 (秒)，窗口内的版本都可作为 delta 的基准
+    keep:         窗口外至少保留的最近版本数 (长时间无变化时不清空)
+    max_versions: 版本数上限 (高频发布时限制内存)
+    """
+
+    def __init__(self, retain=DELTA_RETAIN, keep=32, max_versions=DELTA_MAX_VERSIONS, clock=time.monotonic):
+        self.retain = retain
+        self.keep = keep
+        self.max_versions = max_versions
+        self.clock = clock
+        self.epoch = os.urandom(3).hex()
+        self._n = 0
+        self._digest = None
+        self._history = OrderedDict()   # version -> result
+        self._published = {}            # version -> 发布时间 (clock)
+        self._lock = threading.Lock()
+
+    @property
+    def current(self):
+        """(version, result)，尚无快照时为 (None, None)"""
+        with self._lock:
+            if not self._history:
+                return None, None
+            version = next(reversed(self._history))
+            return version, self._history[version]
+
+    def publish(self, result):
+        """发布新快照，返回 (version, changed)"""
+        digest = content_digest(result)
+        with self._lock:
+            if digest == self._digest and self._history:
+                # 内容未变: 版本号不变，只更新 updated_at 等元信息
+                version = next(reversed(self._history))
+                self._history[version] = result
+                return version, False
+            self._n += 1
+            version = f"{self.epoch}.{self._n}"
+            self._digest = digest
+            now = self.clock()
+            self._history[version] = result
+            self._published[version] = now
+            self._expire(now)
+            return version, True
+
+    def _expire(self, now):
+        """丢弃超出时间窗口 (且多于 keep 个) 或超出上限的最旧版本 (调用方持有 _lock)"""
+        while self._history:
+            oldest = next(iter(self._history))
+            expired = now - self._published[oldest] > self.retain and len(self._history) > self.keep
+            if not expired and len(self._history) <= self.max_versions:
+                break
+            self._history.popitem(last=False)
+            del self._published[oldest]
+
+    @staticmethod
+    def etag(version):
+        # 响应体里的 age / fresh 会变化，因此使用弱校验
+        return f'W/"{version}"'
+
+    def delta(self, since):
+        """
+        since 版本之后的变化；since 未知 (过期或来自上次启动) 时返回完整快照 (full=True)。
+        内容未变化时返回 None。
+        """
+        with self._lock:
+            if not self._history:
+                return None
+            version = next(reversed(self._history))
+            current = self._history[version]
+            base = self._history.get(since)
+
+        if since == version:
+            return None
+        if base is None:
+            return {"version": version, "full": True, "data": current["data"], "history": current["history"]}
+
+        old_positions = {p["symbol"]: p for p in base["data"].get("positions", [])}
+        new_positions = {p["symbol"]: p for p in current["data"].get("positions", [])}
+        # 占比随任一持仓市值变化而整体变化，由客户端根据市值重新计算，不单独算作变化
+        changed = [p for sym, p in new_positions.items()
+                   if _without_allocation(old_positions.get(sym)) != _without_allocation(p)]
+        removed = [sym for sym in old_positions if sym not in new_positions]
+
+        old_points = {h["date"]: h["value"] for h in base.get("history", [])}
+        history = [h for h in current.get("history", []) if old_points.get(h["date"]) != h["value"]]
+
+        return {
+            "version": version,
+            "since": since,
+            "full": False,
+            "updated_at": current["data"].get("updated_at"),
+            "portfolio": current["data"].get("portfolio"),
+            "failed_symbols": current["data"].get("failed_symbols", []),
+            # 账户汇总很小，每次整体下发
+            "accounts": current["data"].get("accounts", []),
+            "positions": changed,
+            "removed": removed,
+            "history": history,
+            # 历史窗口滚动时，客户端丢弃早于该日期的点
+            "history_start": current["history"][0]["date"] if current.get("history") else None,
+        }
@@ -2,177 +2,124 @@
 IBKR Local Dashboard - Core Engine
 功能: 读取 manual_portfolio.py 配置，通过 yfinance 获取实时行情，生成 Dashboard 数据。
 """
-import json
 import os
+import sys
+import time
 from datetime import datetime
 from collections import defaultdict
 import manual_portfolio as mp
+import numpy as np
+from engine import artifacts, fallback, fx, metrics, quotes, schedule, valuation
+from engine.holdings import from_module
+from engine.journal import open_journal
+from engine.lots import LotBook
 
-# 导入 yfinance (延迟导入以防环境问题)
-try:
-    import yfinance as yf
-    import pandas as pd
-    HAS_YF = True
-except ImportError:
-    HAS_YF = False
+# 最近一次快照使用的报价 {symbol: (现价, 昨收)}；持仓配置变化时未变化的标的可直接复用 (reuse)
+LAST_QUOTES = {}
+# LAST_QUOTES 中每个报价实际向行情源取得的时间 (time.time())；复用的报价保留原来的时间，不因复用而续期
+QUOTE_FETCHED_AT = {}
 
-def generate_snapshot_data():
-    """核逻辑：获取数据并返回字典对象，不进行文件写入"""
-    if not HAS_YF:
+def generate_snapshot_data(provider=None, deadline=None, holdings=None, reuse=None, option_params=None):
+    """
+    核逻辑：获取数据并返回字典对象，不进行文件写入
+    holdings: engine.holdings.Holdings (默认使用已导入的 manual_portfolio 模块)
+    reuse:    {symbol: (现价, 昨收)}，这些标的不再请求行情 (配置热加载后只重新取价新增 / 修改的标的)
+    option_params: 期权定价的波动率 / 利率参数源 (默认 engine.options.PARAMS)
+    """
+    # 整次刷新的截止时间 (兜底重试阶段不会超过它)
+    deadline = deadline if deadline is not None else fallback.refresh_deadline()
+    # 行情源: 默认使用进程共享的带 TTL 缓存的 yfinance 后端
+    provider = provider or quotes.get_provider()
+    if not provider.available:
         return {"error": "yfinance not installed"}
 
-    # 1. 读取持仓配置
-    positions = []
-    if hasattr(mp, 'POSITIONS'):
-        positions = [p.copy() for p in mp.POSITIONS] # Deep copy to avoid mutating original
-    else:
-        return {"error": "No POSITIONS found in manual_portfolio.py"}
+    # 1. 读取持仓配置 (每条为一个 lot，可带 account；按标的聚合，配置 dict 只读引用，不复制)
+    if holdings is None:
+        if not hasattr(mp, 'POSITIONS'):
+            return {"error": "No POSITIONS found in manual_portfolio.py"}
+        holdings = from_module(mp)
+    book = LotBook.from_positions(holdings.positions)
 
     # 2. 获取实时行情 (Yahoo Finance)
-    # 提取需要查询的 Symbol (排除有手动定价的)
-    symbols = [p['symbol'] for p in positions if 'manual_price' not in p and ' ' not in p['symbol']]
-    fetch_list = list(set(symbols + ['SPY']))
+    # 提取需要查询的 Symbol (排除有手动定价的，多账户持有的同一标的只查一次)
+    symbols = book.quote_symbols()
+    # 期权 (OCC 代码) 不直接取价，按标的价格理论定价，标的一并请求
+    chain = book.option_chain()
+    underlyings = [u for u in chain.underlyings if u not in book.symbol_index] if chain is not None else []
+    reuse = reuse or {}
+    fetch_list = [s for s in set(symbols + underlyings + ['SPY']) if s not in reuse]
     
-    # 批量获取当前数据
-    tickers_dict = {}
-    prev_closes = {}
-    current_prices = {}
+    # 批量获取当前数据 (复用的报价直接填入)
+    prev_closes = {s: q[1] for s, q in reuse.items()}
+    current_prices = {s: q[0] for s, q in reuse.items()}
     
     if fetch_list:
         try:
-            # 使用 download 获取最近5天数据，确保能拿到昨收
-            # group_by='ticker' 方便处理
-            hist = yf.download(fetch_list, period="5d", progress=False, group_by='ticker')
+            # 获取最近5天日线，确保能拿到昨收 (同一 TTL 窗口内命中缓存)
+            with metrics.span("snapshot.fetch"):
+                bars_map = provider.fetch(fetch_list, "5d")
             
-            # 遍历每个标的处理数据
             for sym in fetch_list:
-                try:
-                    # 处理单个 ticker 数据 (如果是单个标的，结构不同，需要判断)
-                    df = None
-                    if len(fetch_list) == 1:
-                        df = hist
-                    else:
-                        # 检查列是否存在 (防御性编程)
-                        if isinstance(hist.columns, pd.MultiIndex):
-                             if sym in hist.columns.levels[0]:
-                                 df = hist[sym]
-                        elif sym in hist: # 兼容非MultiIndex情况
-                             df = hist[sym]
-                    
-                    if df is None:
-                        print(f"Warning: No data found for {sym} in batch result")
-                        continue
-
-                    # 移除空行
-                    df = df.dropna()
-
-                    
-                    if not df.empty and len(df) >= 2:
-                        # 有至少两天数据
-                        current_prices[sym] = float(df['Close'].iloc[-1])
-                        prev_closes[sym] = float(df['Close'].iloc[-2])
-                    elif not df.empty:
-                        # 只有一天数据 (IPO? 或数据缺失)
-                        current_prices[sym] = float(df['Close'].iloc[-1])
-                        prev_closes[sym] = float(df['Open'].iloc[-1]) # Fallback to open
-                except Exception as e:
-                    print(f"Error parse hist for {sym}: {e}")
+                bars = bars_map.get(sym)
+                if not bars:
+                    print(f"Warning: No data found for {sym} in batch result")
+                    continue
+                # 有至少两天数据用昨收，只有一天数据 (IPO? 或数据缺失) 回退到开盘价
+                current_prices[sym], prev_closes[sym] = quotes.last_and_prev(bars)
                     
         except Exception as e:
             print(f"Batch download failed: {e}")
 
-    day_pnl_map = {}
-    
-    for p in positions:
-        sym = p['symbol']
-        current_price = 0.0
-        prev_close = 0.0
-        
-        # 手动定价优先
-        if 'manual_price' in p:
-            current_price = float(p['manual_price'])
-            prev_close = current_price
-        else:
-            # 使用批量获取的数据
-            current_price = current_prices.get(sym, 0.0)
-            prev_close = prev_closes.get(sym, 0.0)
-            
-            # 如果批量失败，尝试备用方案 (fast_info) -- 仅作为最后的防线
-            if current_price == 0:
-                try:
-                    t = yf.Ticker(sym)
-                    if hasattr(t, 'fast_info'):
-                        if hasattr(t.fast_info, 'last_price'): current_price = t.fast_info.last_price
-                        if hasattr(t.fast_info, 'previous_close'): prev_close = t.fast_info.previous_close
-                except: pass
+    # 批量结果缺失的标的: 并发重试 (有界线程池 + 单标的超时 + 整体截止时间)
+    missing = book.unpriced(current_prices) + [u for u in underlyings if u not in current_prices]
+    with metrics.span("snapshot.fallback"):
+        retried, failed = fallback.fetch_fallbacks(provider, missing, deadline=deadline)
+    metrics.set_gauge("failed_symbols", len(failed), help="Symbols without a price in the last snapshot")
+    for sym, (last, prev_close) in retried.items():
+        current_prices[sym] = last
+        prev_closes[sym] = prev_close
+    fetched_at = time.time()
+    previous = {sym: QUOTE_FETCHED_AT.get(sym, 0.0) for sym in reuse}
+    LAST_QUOTES.clear()
+    LAST_QUOTES.update((sym, (last, prev_closes.get(sym, 0.0))) for sym, last in current_prices.items())
+    QUOTE_FETCHED_AT.clear()
+    QUOTE_FETCHED_AT.update((sym, previous.get(sym, fetched_at)) for sym in LAST_QUOTES)
 
-        # 计算持仓数据
-        if current_price:
-            p['current_price'] = float(current_price)
-            p['market_value'] = p['quantity'] * current_price
-            
-            cost = p.get('cost_basis', 0) * p['quantity']
-            # P&L (Total)
-            p['total_pnl'] = p['market_value'] - cost
-            if cost != 0:
-                p['pnl_percent'] = (p['total_pnl']) / cost * 100
-            else:
-                p['pnl_percent'] = 0.0
-            
-            # Day P&L
-            if prev_close:
-                change = current_price - prev_close
-                d_pnl = change * p['quantity']
-                p['day_pnl'] = d_pnl
-                p['day_pnl_percent'] = (change / prev_close) * 100
-            else:
-                p['day_pnl'] = 0.0
-                p['day_pnl_percent'] = 0.0
-        else:
-            p['market_value'] = 0.0
-            p['total_pnl'] = 0.0
-            p['day_pnl'] = 0.0
-            p['day_pnl_percent'] = 0.0
-    
-    # Retry logic for missing data (Double Check)
-    # 如果核心持仓还是0，尝试单独下载
-    for p in positions:
-        if p.get('current_price', 0) == 0 and 'manual_price' not in p:
-             sym = p['symbol']
-             try:
-                 print(f"Retrying fetch for {sym}...")
-                 df = yf.download(sym, period="5d", progress=False)
-                 if not df.empty:
-                     p['current_price'] = float(df['Close'].iloc[-1])
-                     prev = float(df['Close'].iloc[-2]) if len(df) >= 2 else float(df['Open'].iloc[-1])
-                     p['market_value'] = p['quantity'] * p['current_price']
-                     
-                     # Recalc totals
-                     cost = p.get('cost_basis', 0) * p['quantity']
-                     p['total_pnl'] = p['market_value'] - cost
-                     p['pnl_percent'] = (p['total_pnl'] / cost * 100) if cost else 0
-                     
-                     change = p['current_price'] - prev
-                     p['day_pnl'] = change * p['quantity']
-                     p['day_pnl_percent'] = (change / prev) * 100
-             except Exception as e:
-                 print(f"Retry failed for {sym}: {e}")
+    # 期权: 全部合约一次向量化定价，理论价 (及按昨收标的价的理论价) 作为该合约的现价 / 昨收
+    greeks = None
+    if chain is not None:
+        with metrics.span("snapshot.options"):
+            greeks, prev_theo = chain.value(current_prices, prev_closes, params=option_params)
+        for i, sym in enumerate(chain.symbols):
+            if np.isnan(greeks["price"][i]):
+                failed[sym] = "no underlying price"
+                continue
+            current_prices[sym] = float(greeks["price"][i])
+            if not np.isnan(prev_theo[i]):
+                prev_closes[sym] = float(prev_theo[i])
 
-    # 3. 汇总组合数据
-    total_market_value = sum(p.get('market_value', 0) for p in positions)
-    
-    # 占比
-    for p in positions:
-        p['allocation_percent'] = (p.get('market_value', 0) / total_market_value * 100) if total_market_value else 0
+    # 非基准币种的持仓: 汇率批量取一次 (带 TTL 缓存)，换算向量在估值时乘到数量上
+    rates = fx.get_rates()
+    fx_rates = None
+    if any(c != rates.base for c in book.currency):
+        with metrics.span("snapshot.fx"):
+            fx_rates = rates.vector(book.currency)
+        for k in np.flatnonzero(np.isnan(fx_rates)).tolist():
+            failed[book.symbols[k]] = f"no FX rate for {book.currency[k]}"
+        fx_rates = np.nan_to_num(fx_rates)
 
-    cash = getattr(mp, 'TOTAL_CASH', 0.0)
+    # 3. 向量化估值 (每个标的定价一次，lot 按标的 / 账户汇总)，手动定价优先
+    with metrics.span("snapshot.valuation"):
+        book.set_prices(current_prices, prev_closes, failed, fx_rates)
+        # 4. 汇总组合数据 (含占比)
+        total_market_value, total_day_pnl, total_cost = book.market_value, book.day_pnl, book.total_cost
+
+    cash = holdings.cash
     grand_total = total_market_value + cash
     
-    total_day_pnl = sum(p.get('day_pnl', 0) for p in positions)
     yesterday_val = grand_total - total_day_pnl
     day_pnl_pct = (total_day_pnl / yesterday_val * 100) if yesterday_val else 0
     
-    total_cost = sum(p.get('cost_basis', 0) * p['quantity'] for p in positions)
     total_pnl_val = total_market_value - total_cost
     total_pnl_pct = (total_pnl_val / total_cost * 100) if total_cost else 0
     
@@ -186,51 +133,67 @@ def generate_snapshot_data():
             "total_pnl_val": total_pnl_val,
             "total_pnl_pct": total_pnl_pct
         },
-        "positions": sorted(positions, key=lambda x: x['market_value'], reverse=True)
+        "positions": book.to_positions(),
+        "accounts": book.account_rollup(),
+        "failed_symbols": sorted(failed)
     }
+    if fx_rates is not None:
+        snapshot["fx"] = rates.snapshot(book.currency)
+    if chain is not None:
+        snapshot["options"] = option_summary(book, chain, greeks, current_prices)
+        index = {sym: i for i, sym in enumerate(chain.symbols)}
+        for p in snapshot["positions"]:
+            i = index.get(p["symbol"])
+            if i is not None:
+                p["multiplier"] = float(book.multiplier[book.symbol_index[p["symbol"]]])
+                p["option"] = chain.describe(i, greeks)
     
-    # 4. 同时生成历史数据
-    history_data = generate_history_data(positions, cash, grand_total)
+    # 5. 同时生成历史数据
+    with metrics.span("snapshot.history"):
+        history_data = generate_history_data(book, cash, grand_total, provider)
     
     return {
         "data": snapshot,
         "history": history_data
     }
 
-def generate_history_data(positions, cash, current_total):
-    """基于当前持仓回溯历史数据 (纯内存计算)"""
+def option_summary(book, chain, greeks, prices):
+    """
+    data.json 的 options: 按标的汇总的 Greeks 敞口 (期权 + 正股的 delta)，以及组合合计。
+    正股的 delta 即持股数，delta_dollars 为其市值。
+    """
+    rows = np.array([book.symbol_index[s] for s in chain.symbols], dtype=np.intp)
+    by_underlying, totals = chain.exposure(greeks, book.symbol_quantity[rows], book.multiplier[rows])
+    for item in by_underlying:
+        u = item["underlying"]
+        k = book.symbol_index.get(u)
+        shares = float(book.symbol_quantity[k] * book.multiplier[k]) if k is not None else 0.0
+        item["stock_shares"] = shares
+        item["net_delta"] = item["delta"] + shares
+        item["net_delta_dollars"] = item["delta_dollars"] + shares * (prices.get(u) or 0.0)
+    totals["net_delta_dollars"] = sum(item["net_delta_dollars"] for item in by_underlying)
+    return {"contracts": len(chain), "underlyings": by_underlying, "exposure": totals}
+
+def generate_history_data(positions, cash, current_total, provider=None, period="1mo"):
+    """
+    基于当前持仓回溯历史数据 (纯内存计算)；positions 为 LotBook 或 POSITIONS 格式的列表。
+    快照内嵌的 history 为最近一个月；/api/history 按需用更长的 period (至 10y) 生成日线序列再降采样
+    """
+    provider = provider or quotes.get_provider()
+    book = positions if isinstance(positions, LotBook) else LotBook.from_positions(positions)
     history = []
     try:
-        symbols = [p['symbol'] for p in positions if 'manual_price' not in p and ' ' not in p['symbol']]
+        symbols = book.quote_symbols()
         if symbols:
-            # 下载过去30天数据
-            data = yf.download(list(set(symbols + ['SPY'])), period="1mo", progress=False)['Close']
+            # 获取 period 内的日线，对齐成 dates × 标的 价格矩阵 (同一标的的 lot 数量已合并)
+            bars_map = provider.fetch(list(set(symbols + ['SPY'])), period)
+            matrix = valuation.PriceMatrix.from_bars(bars_map, book.symbols)
             
-            for date, row in data.iterrows():
-                daily_sum = 0.0
-                for p in positions:
-                    sym = p['symbol']
-                    qty = p['quantity']
-                    price = 0.0
-                    
-                    # 尝试从历史数据获取
-                    try:
-                        if sym in row and not pd.isna(row[sym]):
-                            price = float(row[sym])
-                    except: pass
-                    
-                    # 回退逻辑
-                    if price == 0:
-                        if 'manual_price' in p: price = float(p['manual_price'])
-                        elif 'current_price' in p: price = p['current_price']
-                        
-                    daily_sum += price * qty
-                
-                daily_sum += cash
-                history.append({
-                    "date": date.strftime("%Y-%m-%d"),
-                    "value": daily_sum
-                })
+            # 缺失价格回退到手动定价 / 当前价，手动定价覆盖所有日期
+            prices = matrix.filled(book.price, book.manual_price)
+            # 期权没有日线，整列为当前理论价；数量按股数 (合约数 × 乘数)，按当前汇率换算为基准币种
+            values = valuation.history_values(prices, book.symbol_units, cash)
+            history = [{"date": d, "value": float(v)} for d, v in zip(matrix.dates, values)]
     except Exception as e:
         print(f"History error: {e}")
         return []
@@ -246,32 +209,55 @@ def generate_history_data(positions, cash, current_total):
         
     return history
 
+def save_outputs(result, dashboard_dir=None):
+    """将 generate_snapshot_data 的结果写入 dashboard/data.json 和 history.json (dashboard_dir 可覆盖输出目录)"""
+    snapshot = result['data']
+    history = result['history']
+    
+    if dashboard_dir is None:
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        dashboard_dir = os.path.join(base_dir, 'dashboard')
+    os.makedirs(dashboard_dir, exist_ok=True)
+    
+    # 紧凑 JSON + 原子写入，同时生成 .gz / .br 预压缩版本 (server.py 按 Accept-Encoding 返回)
+    with metrics.span("snapshot.write"):
+        artifacts.write_artifact(os.path.join(dashboard_dir, 'data.json'), artifacts.iter_dumps(snapshot))
+        artifacts.write_artifact(os.path.join(dashboard_dir, 'history.json'), artifacts.iter_dumps(history))
+    
+    return snapshot
+
 def main():
     """本地运行入口: 调用逻辑并保存文件"""
     print("=" * 50)
     print("   Portfolio Updater (Local / API Ready)")
     print("=" * 50)
     
-    result = generate_snapshot_data()
+    # --if-stale: 定时任务使用，快照仍在当前时段的保鲜期内 (如休市且收盘后已更新过) 时跳过，不请求上游
+    if "--if-stale" in sys.argv[1:]:
+        data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dashboard', 'data.json')
+        if os.path.exists(data_path):
+            updated_at = os.path.getmtime(data_path)
+            if time.time() - updated_at < schedule.snapshot_ttl(updated_at):
+                print(f"Snapshot still fresh (market {schedule.CALENDAR.session()}), skipping update.")
+                return
+    
+    # PROFILE_REFRESH=1 时对本次更新做 cProfile
+    with metrics.PROFILER.capture("update"), metrics.span("refresh"):
+        result = generate_snapshot_data()
+    if metrics.PROFILER.last:
+        print(metrics.PROFILER.last["stats"])
+        print(f"Profile saved: {metrics.PROFILER.last['path']}")
     
     if "error" in result:
         print(f"Error: {result['error']}")
         return
 
-    snapshot = result['data']
-    history = result['history']
-    
-    # 保存文件
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    dashboard_dir = os.path.join(base_dir, 'dashboard')
-    os.makedirs(dashboard_dir, exist_ok=True)
-    
-    with open(os.path.join(dashboard_dir, 'data.json'), 'w', encoding='utf-8') as f:
-        json.dump(snapshot, f, indent=2)
-        
-    with open(os.path.join(dashboard_dir, 'history.json'), 'w', encoding='utf-8') as f:
-        json.dump(history, f, indent=2)
-        
+    snapshot = save_outputs(result)
+    # 追加到快照日志 (.cache/journal)，保留实际记录的净值和持仓
+    journal = open_journal()
+    if journal is not None:
+        journal.append(snapshot, force=True)
+        journal.close()
     print(f"[OK] Update Complete! Total: ${snapshot['portfolio']['total_value']:,.2f}")
 
 if __name__ == "__main__":
@@ -6,6 +6,8 @@
 TOTAL_CASH = 0.00
 
 # 持仓列表
+# 每条是一个 lot，可选 "account" 字段标注账户 (如 "self" / "family")，不填归入 "default"；
+# 同一标的可在多个账户各写一条，Dashboard 中合并为一行，并在 data.json 的 accounts 中按账户汇总
 POSITIONS = [
     # --- 已知成本的持仓 (沿用之前数据或预估) ---
     {"symbol": "TSLA", "quantity": 881,  "cost_basis": 220.50}, 
@@ -22,4 +24,8 @@ POSITIONS = [
     
     # 注意: 截图里没有 SPY, 这里移除 SPY
     # 注意: 截图里没有 期权, 这里移除期权
+    # 期权按 OCC 代码填写，数量为合约数，成本为每股权利金，例如:
+    # {"symbol": "TSLA  260116C00300000", "quantity": 1, "cost_basis": 25.00, "iv": 0.55},
+    # 非美元标的的价格 / 成本按当地币种 (币种按代码后缀推断，也可写 "currency")，例如:
+    # {"symbol": "0700.HK", "quantity": 100, "cost_basis": 380.00},
 ]
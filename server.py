@@ -1,50 +1,515 @@
 import http.server
 import socketserver
-import subprocess
 import os
-import json
+import queue
 import sys
+import threading
+import time
+from datetime import date
+from urllib.parse import urlsplit, parse_qs
+
+# 估值引擎常驻内存：避免每次刷新都重新启动解释器并导入 pandas / yfinance
+import main as engine_main
+from engine import artifacts, history, metrics, quotes, risk, scenarios, schedule
+from engine.broadcast import Broadcaster, format_event
+from engine.holdings import PositionSource
+from engine.journal import open_journal, parse_time
+from engine.state import SnapshotState
 
 # 配置
 PORT = 8085
 DIRECTORY = "dashboard"
+# 快照保鲜期 (秒)：超过后读请求会在后台触发刷新
+SNAPSHOT_TTL = float(os.environ.get("SNAPSHOT_TTL", "60"))
+# 实时行情: 设为 gateway 连接本地 IBKR 网关，或直接给出 websocket 地址 (如回放服务器)
+PRICE_STREAM = os.environ.get("PRICE_STREAM", "")
+# 按交易时段调度刷新 (盘中 REFRESH_REGULAR / 盘前盘后 REFRESH_EXTENDED 秒，休市不刷新)；
+# 设为 off 时回到读请求驱动 (快照超过 SNAPSHOT_TTL 后由读请求触发刷新)
+REFRESH_SCHEDULE = os.environ.get("REFRESH_SCHEDULE", "on").lower() not in ("off", "0", "false")
+# 持仓配置检查间隔 (秒)：manual_portfolio.py 保存后自动重新加载并刷新，设为 0 关闭
+CONFIG_POLL = float(os.environ.get("CONFIG_POLL", "2"))
+
+# 持仓配置: 按修改时间 + 内容哈希热加载，不需要重启服务
+source = PositionSource()
+
+
+def quote_fresh(fetched_at, now):
+    """fetched_at 时取得的报价是否仍在快照保鲜期内 (与快照的 TTL 规则相同)"""
+    ttl = state.ttl(fetched_at) if callable(state.ttl) else state.ttl
+    return now - fetched_at < ttl
+
+
+def run_refresh():
+    """计算最新快照并写入 data.json / history.json (各阶段耗时见 /api/metrics)"""
+    holdings, change = source.poll()
+    reuse = None
+    if change is not None and source.reloads:
+        metrics.inc("config_reloads_total", help="Portfolio config reloads")
+        # 报价按实际取得的时间判断保鲜 (复用不续期): 新增 / 修改的标的和已过期的报价重新取价，其余沿用
+        if engine_main.LAST_QUOTES:
+            scope = change.added | change.changed
+            now = time.time()
+            reuse = {sym: q for sym, q in engine_main.LAST_QUOTES.items()
+                     if sym not in scope and quote_fresh(engine_main.QUOTE_FETCHED_AT.get(sym, 0.0), now)}
+            print(f"持仓配置已变化，重新取价: {sorted(scope) or '无'}，沿用报价 {len(reuse)} 个")
+    try:
+        with metrics.PROFILER.capture("refresh"), metrics.span("refresh"):
+            result = engine_main.generate_snapshot_data(holdings=holdings, reuse=reuse)
+            if "error" in result:
+                raise RuntimeError(result["error"])
+            engine_main.save_outputs(result)
+    except Exception:
+        metrics.inc("refresh_total", help="Snapshot refreshes", status="error")
+        raise
+    metrics.inc("refresh_total", help="Snapshot refreshes", status="ok")
+    return result
+
+
+def scheduled_ttl(updated_at):
+    """调度器负责按时段刷新，读请求只在调度器落后 (超过两个间隔) 时才触发刷新"""
+    return schedule.snapshot_ttl(updated_at, regular=2 * schedule.REGULAR_INTERVAL,
+                                 extended=2 * schedule.EXTENDED_INTERVAL)
+
+
+# 最近一次成功的快照；并发的刷新请求合并为一次计算，所有等待者共享结果
+state = SnapshotState(run_refresh, ttl=scheduled_ttl if REFRESH_SCHEDULE else SNAPSHOT_TTL)
+scheduler = schedule.RefreshScheduler(state) if REFRESH_SCHEDULE else None
+
+# 推送通道: 每个新版本只计算 / 序列化一次增量，再分发给所有 SSE 客户端
+broadcaster = Broadcaster(max_queue=16)
+SSE_KEEPALIVE = 15
+_pushed = {"version": None}
+_push_lock = threading.Lock()
+
+
+def push_update(version, result, source):
+    with _push_lock:
+        delta = state.versions.delta(_pushed["version"]) if _pushed["version"] else None
+        _pushed["version"] = version
+        if delta is None:
+            delta = {"version": version, "full": True, "data": result["data"], "history": result["history"]}
+        broadcaster.publish(format_event("delta", delta, event_id=delta["version"]))
+
+
+state.subscribe(push_update)
+
+# 多分辨率历史: 当日盘中净值 (每次发布快照记录一点) + 按需生成的长周期日线级别
+intraday = history.IntradaySeries()
+history_cache = history.LevelCache()
+
+
+def record_intraday(version, result, source):
+    intraday.record(result["data"]["portfolio"]["total_value"])
+
+
+state.subscribe(record_intraday)
+
+# 快照日志: 每次刷新的快照 (实时行情按 JOURNAL_INTERVAL 采样) 追加到 .cache/journal，
+# 可查询任意时刻实际记录的净值和持仓；SNAPSHOT_JOURNAL=off 关闭
+journal = open_journal()
+
+
+def record_journal(version, result, source):
+    journal.append(result["data"], force=(source == "refresh"))
+
+
+if journal is not None:
+    state.subscribe(record_journal)
+    # 重启后用日志中最近一天的记录恢复盘中序列
+    for ts, value in journal.entries(start=time.time() - 86400)[["ts", "value"]].tolist():
+        intraday.record(value, ts)
+
+
+def history_levels(days, result):
+    """覆盖 days 天的 HistoryLevels (按持仓配置和日期缓存)，最后一点随当前快照更新"""
+    data = result["data"]
+    portfolio = data["portfolio"]
+
+    def build(period):
+        with metrics.span("history.levels"):
+            return engine_main.generate_history_data(
+                data["positions"], portfolio["cash"], portfolio["total_value"], period=period)
+
+    key = (source.holdings.digest if source.holdings else None, date.today())
+    levels = history_cache.get(key, days, build)
+    levels.update_last(portfolio["total_value"])
+    return levels
+
+
+# 风险指标: 模型常驻内存，每次只喂入新增的K线；同一快照版本的结果直接复用
+_risk = {"model": None, "version": None, "report": None}
+_risk_lock = threading.Lock()
+
+
+def risk_report(version, result):
+    with _risk_lock:
+        if _risk["version"] != version or _risk["report"] is None:
+            portfolio = result["data"]["portfolio"]
+            with metrics.span("risk.update"):
+                _risk["model"], _risk["report"] = risk.compute(
+                    result["data"]["positions"], portfolio["cash"], quotes.get_provider(), _risk["model"])
+            _risk["version"] = version
+        return _risk["report"]
+
+
+# 情景分析: 协方差模型和模拟结果按快照版本缓存
+scenario_cache = scenarios.ScenarioCache()
+
+
+# /api/index 的响应主体: 每个版本只序列化 / 压缩一次
+_prepared = {"version": None, "body": None}
+_prepared_lock = threading.Lock()
+
+
+def prepared_snapshot(version, result):
+    with _prepared_lock:
+        if _prepared["version"] != version or _prepared["body"] is None:
+            _prepared["body"] = artifacts.PreparedBody(result)
+            _prepared["version"] = version
+        return _prepared["body"]
+
+
+def watch_config(interval):
+    """
+    配置文件内容变化时立即刷新，不等快照过期。
+    有调度器时在本线程同步刷新，完成后唤醒调度器，让下一轮从这次的新快照重新计时
+    (否则仍按上一次快照计时，可能紧接着再做一次完整刷新)
+    """
+    while True:
+        time.sleep(interval)
+        if not source.changed():
+            continue
+        if scheduler is None:
+            state.refresh_async()
+            continue
+        try:
+            state.refresh()
+        except Exception as e:
+            print(f"Config refresh failed: {e}")
+        scheduler.wake()
+
 
 class Handler(http.server.SimpleHTTPRequestHandler):
     def __init__(self, *args, **kwargs):
         # 设置静态文件目录
         super().__init__(*args, directory=DIRECTORY, **kwargs)
 
+    def accepts_gzip(self):
+        return 'gzip' in artifacts.accepted_encodings(self.headers.get('Accept-Encoding'))
+
+    def send_body(self, body, content_type='application/json', status=200, headers=None, encoding=None):
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, payload, status=200, headers=None):
+        body, encoding = artifacts.dumps(payload), None
+        # 小响应压缩收益不大
+        if len(body) > 1024 and self.accepts_gzip():
+            body, encoding = artifacts.compress(body, "gzip"), "gzip"
+        self.send_body(body, status=status, headers=headers, encoding=encoding)
+
+    def send_static(self):
+        """
+        静态文件: 有预压缩版本 (.br / .gz) 的按 Accept-Encoding 直接返回，
+        并支持 ETag / If-None-Match 条件请求；其余文件交给 SimpleHTTPRequestHandler
+        """
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path) or not any(os.path.exists(path + suffix) for _, suffix in artifacts.ENCODINGS):
+            super().do_GET()
+            return
+        filename, encoding = artifacts.precompressed(path, self.headers.get('Accept-Encoding'))
+        try:
+            f = open(filename, 'rb')
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+        with f:
+            # 文件以原子替换方式更新: 打开后读到的内容与 fstat 一致
+            st = os.fstat(f.fileno())
+            headers = {
+                'ETag': f'"{st.st_mtime_ns:x}-{st.st_size:x}"',
+                'Last-Modified': self.date_time_string(st.st_mtime),
+                'Vary': 'Accept-Encoding',
+                'Cache-Control': 'no-cache',
+            }
+            if self.etag_matches(headers['ETag']):
+                self.send_not_modified(headers)
+                return
+            body = f.read()
+        self.send_response(200)
+        self.send_header('Content-type', self.guess_type(path))
+        self.send_header('Content-Length', str(len(body)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def etag_matches(self, etag):
+        """If-None-Match 是否命中 (弱比较)"""
+        header = self.headers.get('If-None-Match')
+        if not header:
+            return False
+        if header.strip() == '*':
+            return True
+        strip = lambda t: t.strip().removeprefix('W/')
+        return strip(etag) in [strip(t) for t in header.split(',')]
+
+    def send_not_modified(self, headers):
+        self.send_response(304)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+
     def do_GET(self):
-        # API: 手动触发数据更新
-        if self.path == '/api/refresh':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+
+        # API: 最近一次快照 (与 Vercel /api/index 格式一致)，过期时后台刷新
+        if url.path == '/api/index':
+            version, result, age, fresh = state.get()
+            if result is None:
+                self.send_json({"error": "snapshot not ready", "refreshing": True}, status=503,
+                               headers={'Retry-After': '5'})
+                return
+            headers = {'ETag': state.versions.etag(version), 'Age': str(int(age)), 'X-Snapshot-Age': f"{age:.1f}"}
+            if self.etag_matches(headers['ETag']):
+                self.send_not_modified(headers)
+                return
+            # 快照主体按版本缓存，只追加 version / fresh / age
+            body, encoding = prepared_snapshot(version, result).render(
+                {"version": version, "fresh": fresh, "age": round(age, 1)},
+                "gzip" if self.accepts_gzip() else None)
+            self.send_body(body, headers=headers, encoding=encoding)
+            return
+
+        # API: 某版本之后的增量 (变化的持仓 / 组合汇总 / 新增历史点)，无变化返回 304
+        if url.path == '/api/delta':
+            since = query.get('since', [''])[0]
+            version, result, age, fresh = state.get()
+            if result is None:
+                self.send_json({"error": "snapshot not ready", "refreshing": True}, status=503,
+                               headers={'Retry-After': '5'})
+                return
+            delta = state.versions.delta(since)
+            headers = {'ETag': state.versions.etag(version), 'Age': str(int(age))}
+            if delta is None:
+                self.send_not_modified(headers)
+                return
+            delta["fresh"] = fresh
+            self.send_json(delta, headers=headers)
+            return
+
+        # API: 任意时间范围的历史 (日 / 周 / 月预聚合 + LTTB 降采样到 max_points 个点)
+        if url.path == '/api/history':
+            version, result, age, fresh = state.get()
+            if result is None:
+                self.send_json({"error": "snapshot not ready", "refreshing": True}, status=503,
+                               headers={'Retry-After': '5'})
+                return
+            range_text = query.get('range', [None])[0]
+            try:
+                days = history.parse_range(range_text)
+                max_points = query.get('max_points', [None])[0]
+                history.parse_max_points(max_points)
+            except ValueError as e:
+                self.send_json({"error": str(e)}, status=400)
+                return
+            levels = history_levels(days, result)
+            self.send_json(history.query(levels, range_text, max_points, intraday))
+            return
+
+        # API: 风险指标 (相对 SPY 的 beta、滚动波动率、最大回撤、持仓相关系数矩阵)
+        if url.path == '/api/risk':
+            version, result, age, fresh = state.get()
+            if result is None:
+                self.send_json({"error": "snapshot not ready", "refreshing": True}, status=503,
+                               headers={'Retry-After': '5'})
+                return
+            try:
+                report = risk_report(version, result)
+            except Exception as e:
+                self.send_json({"error": str(e)}, status=502)
+                return
+            self.send_json(report, status=500 if "error" in report else 200)
+            return
+
+        # API: 情景分析 (蒙特卡洛 VaR / CVaR + ?shock=NVDA:-20,QQQ:-10 压力测试)
+        if url.path == '/api/scenarios':
+            version, result, age, fresh = state.get()
+            if result is None:
+                self.send_json({"error": "snapshot not ready", "refreshing": True}, status=503,
+                               headers={'Retry-After': '5'})
+                return
+            try:
+                params = scenarios.parse_params(query)
+            except ValueError as e:
+                self.send_json({"error": str(e)}, status=400)
+                return
+            try:
+                report = scenario_cache.report(version, result["data"], quotes.get_provider(), params)
+            except Exception as e:
+                self.send_json({"error": str(e)}, status=502)
+                return
+            self.send_json(report)
+            return
+
+        # API: 快照日志 (实际记录的净值曲线；?at= 返回该时刻的完整快照，&symbol= 只取单个持仓)
+        if url.path == '/api/journal':
+            if journal is None:
+                self.send_json({"error": "snapshot journal disabled"}, status=404)
+                return
+            try:
+                at = parse_time(query.get('at', [None])[0])
+                start = parse_time(query.get('start', [None])[0])
+                end = parse_time(query.get('end', [None])[0])
+                max_points = history.parse_max_points(query.get('max_points', [None])[0])
+            except ValueError as e:
+                self.send_json({"error": str(e)}, status=400)
+                return
+            with metrics.span("journal.query"):
+                if at is None:
+                    points = journal.nav(start, end, max_points)
+                    self.send_json({"records": len(journal), "points": points})
+                    return
+                found = journal.at(at)
+                if found is None:
+                    self.send_json({"error": "no snapshot recorded before this time"}, status=404)
+                    return
+                ts, snapshot = found
+                symbol = query.get('symbol', [None])[0]
+                if symbol:
+                    snapshot = {"updated_at": snapshot.get("updated_at"),
+                                "positions": [p for p in snapshot.get("positions", []) if p.get("symbol") == symbol]}
+                self.send_json({"recorded_at": ts, "data": snapshot})
+            return
+
+        # API: 服务器推送 (SSE)，价格更新时广播增量，客户端无需轮询
+        if url.path == '/api/stream':
+            self.stream_events()
+            return
+
+        # API: Prometheus 指标 (各阶段耗时直方图、上游请求 / 缓存命中 / 取价失败计数)
+        if url.path == '/api/metrics':
+            self.send_metrics()
+            return
+
+        # API: 手动触发数据更新 (默认后台执行；?wait=1 等待完成；?profile=1 对该次刷新做 cProfile)
+        if url.path == '/api/refresh':
+            profile = query.get('profile', ['0'])[0] in ('1', 'true')
+            if profile:
+                metrics.PROFILER.request()
+            if query.get('wait', ['0'])[0] not in ('1', 'true'):
+                started = state.refresh_async()
+                self.send_json({
+                    "status": "accepted",
+                    "message": "已开始后台更新" if started else "更新进行中",
+                    "age": state.age,
+                }, status=202)
+                return
+
             try:
                 print("收到刷新请求，正在更新数据...")
-                # 调用 main.py 进行更新
-                # server.py 和 main.py 在同一目录
-                result = subprocess.run(
-                    [sys.executable, "main.py"], 
-                    capture_output=True, 
-                    text=True,
-                    cwd=os.getcwd() 
-                )
-                
-                if result.returncode == 0:
-                    response = {"status": "success", "message": "数据已更新", "logs": result.stdout}
-                else:
-                    response = {"status": "error", "message": "更新失败", "logs": result.stderr}
-                    
+                result, shared = state.refresh()
+                response = {
+                    "status": "success",
+                    "message": "数据已更新",
+                    "shared": shared,
+                    "updated_at": result["data"]["updated_at"],
+                    "total_value": result["data"]["portfolio"]["total_value"],
+                    "stages": {k: round(v, 4) for k, v in metrics.REGISTRY.last_spans.items()},
+                }
+                if profile and metrics.PROFILER.last:
+                    response["profile"] = metrics.PROFILER.last
             except Exception as e:
                 response = {"status": "error", "message": str(e)}
             
-            self.wfile.write(json.dumps(response).encode())
+            self.send_json(response)
             return
 
-        # 默认处理：提供静态文件
-        super().do_GET()
+        # 默认处理：提供静态文件 (data.json / history.json 等带预压缩版本)
+        self.send_static()
+
+    def send_metrics(self):
+        # 读取时刷新的瞬时值
+        age = state.age
+        if age is not None:
+            metrics.set_gauge("snapshot_age_seconds", age, help="Seconds since the last good snapshot")
+        metrics.set_gauge("sse_clients", len(broadcaster), help="Connected server-push clients")
+        metrics.set_gauge("sse_dropped_clients", broadcaster.dropped, help="Push clients dropped for falling behind")
+        current = schedule.CALENDAR.session()
+        for name in ("pre", "regular", "post", "closed"):
+            metrics.set_gauge("market_session", 1 if name == current else 0, help="Current US market session",
+                              session=name)
+        if scheduler is not None and scheduler.next_run is not None:
+            metrics.set_gauge("next_refresh_seconds", max(0.0, scheduler.next_run - time.time()),
+                              help="Seconds until the next scheduled refresh")
+        if journal is not None:
+            metrics.set_gauge("journal_records", len(journal), help="Snapshots recorded in the journal")
+        provider = quotes.get_provider()
+        if isinstance(provider, quotes.CachedProvider):
+            metrics.set_gauge("quote_cache_entries", provider.size, help="Entries in the quote cache")
+
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream_events(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.end_headers()
+
+        client = broadcaster.register()
+        try:
+            # 首条消息: 断线重连时按 Last-Event-ID 补增量，否则发送完整快照
+            version, result, age, fresh = state.get()
+            since = self.headers.get('Last-Event-ID')
+            first = state.versions.delta(since) if since else None
+            if first is None and result is not None and since != version:
+                first = {"version": version, "full": True, "data": result["data"], "history": result["history"]}
+            self.wfile.write(b"retry: 5000\n\n")
+            if first is not None:
+                first["fresh"] = fresh
+                self.wfile.write(format_event("delta", first, event_id=version))
+            self.wfile.flush()
+
+            while not client.dropped:
+                try:
+                    message = client.queue.get(timeout=SSE_KEEPALIVE)
+                except queue.Empty:
+                    message = b": ping\n\n"
+                if client.dropped:
+                    break
+                self.wfile.write(message)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            broadcaster.unregister(client)
+            self.close_connection = True
+
+
+class ThreadingServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """每个连接一个线程：刷新等待上游时静态文件请求不受影响"""
+    daemon_threads = True
+    allow_reuse_address = True
+
 
 if __name__ == "__main__":
     # 确保 dashboard 目录存在
@@ -52,11 +517,27 @@ if __name__ == "__main__":
         print(f"Error: Directory '{DIRECTORY}' not found.")
         sys.exit(1)
         
-    # 允许地址重用
-    socketserver.TCPServer.allow_reuse_address = True
+    # 先用磁盘上的快照服务读者，再在后台刷新
+    state.load_files(os.path.join(DIRECTORY, 'data.json'), os.path.join(DIRECTORY, 'history.json'))
+    state.refresh_async()
+    if scheduler is not None:
+        scheduler.start()
+    if CONFIG_POLL > 0:
+        threading.Thread(target=watch_config, args=(CONFIG_POLL,), name="config-watch", daemon=True).start()
+    
+    # 可选: 接入网关实时行情，tick 只增量更新受影响的持仓
+    if PRICE_STREAM:
+        from engine import stream
+        url = stream.DEFAULT_WS_URL if PRICE_STREAM == "gateway" else PRICE_STREAM
+        conids = stream.parse_conids(os.environ.get("GATEWAY_CONIDS", ""))
+        holdings = source.current()
+        conids.update(holdings.conids)
+        symbols = list(dict.fromkeys(p['symbol'] for p in holdings.positions))
+        rest_url = stream.DEFAULT_REST_URL if PRICE_STREAM == "gateway" else None
+        stream.attach(state, url, symbols, conids, rest_url=rest_url)
     
     # 绑定到 0.0.0.0 以允许局域网访问
-    with socketserver.TCPServer(("0.0.0.0", PORT), Handler) as httpd:
+    with ThreadingServer(("0.0.0.0", PORT), Handler) as httpd:
         # 获取本机 IP 用于提示
         try:
             import socket